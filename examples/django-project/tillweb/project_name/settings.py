@@ -32,6 +32,28 @@ TILLWEB_SINGLE_SITE=True
 TILLWEB_DATABASE=sessionmaker(bind=create_engine(
         'postgresql+psycopg2:///{}'.format(
             quicktill_database),pool_recycle=600,echo=True))
+# If there are many tillweb workers, or the database is reached
+# through PgBouncer in transaction pooling mode, use
+# quicktill.td.make_engine() to get the tillweb pool settings and
+# keepalives, and to check for statements that aren't safe with
+# transaction pooling:
+#from quicktill.td import make_engine
+#TILLWEB_DATABASE=sessionmaker(bind=make_engine(
+#        'postgresql+psycopg2://pgbouncer-host:6432/{}'.format(
+#            quicktill_database),role="tillweb",transaction_pooling=True))
+# Optionally, run reports against a replica of the till database
+# instead of the primary; views fall back to the primary if the replica
+# is unavailable or more than TILLWEB_REPLICA_MAX_LAG seconds behind
+#TILLWEB_REPLICA_DATABASE=sessionmaker(bind=create_engine(
+#        'postgresql+psycopg2://replica-host/{}'.format(
+#            quicktill_database),pool_recycle=600))
+#TILLWEB_REPLICA_MAX_LAG=60
+# Limit how long report queries may run for, and how many large
+# reports may run at once; see quicktill/tillweb/views.py
+#TILLWEB_QUERY_LIMITS={'statement_timeout': 60,
+#                      'heavy_statement_timeout': 300,
+#                      'heavy_concurrency': 2,
+#                      'heavy_queue_timeout': 10}
 TILLWEB_PUBNAME="Haymakers" # editme
 TILLWEB_LOGIN_REQUIRED=False
 TILLWEB_DEFAULT_ACCESS="R" # permission for user not in till user database
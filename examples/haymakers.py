@@ -325,6 +325,15 @@ std = {
     'all_payment_methods': all_payment_methods,
     'payment_methods': payment_methods,
     'database': 'dbname=haymakers',
+    # Reports such as "runtill totals" can use a replica database
+    #'replica_database': 'dbname=haymakers host=replica',
+    #'replica_max_lag': 60,
+    # Through PgBouncer in transaction pooling mode, with smaller
+    # connection pools
+    #'database': 'host=pgbouncer port=6432 dbname=haymakers',
+    #'database_transaction_pooling': True,
+    #'database_pool': {'till': {'pool_size': 1, 'max_overflow': 0},
+    #                  'command': {'pool_size': 1, 'max_overflow': 0}},
     'checkdigit_print': True,
     'checkdigit_on_usestock': True,
 }
@@ -402,6 +411,7 @@ global_hotkeys = {
 stockcontrol = {
     'firstpage': lambda: quicktill.stockterminal.page(
         stock_hotkeys, ["Bar"]),
+    'database_role': 'stockterminal',
 }
 
 stockcontrol_terminal = {
@@ -409,6 +419,7 @@ stockcontrol_terminal = {
     'usertoken_handler': lambda t: quicktill.stockterminal.handle_usertoken(
         t, register_hotkeys, ["Bar"], max_unattended_updates=5),
     'usertoken_listen': ('127.0.0.1', 8455),
+    'database_role': 'stockterminal',
 }
 
 config0 = {'description': "Stock-control terminal, no user"}
@@ -2,19 +2,18 @@ import requests
 from decimal import Decimal
 from . import payment, ui, tillconfig, printer, td, keyboard
 from .models import zero, penny, Payment, Transaction
-try:
-    import qrcode
-    _qrcode_available = True
-except ImportError:
-    _qrcode_available = False
 import logging
 log = logging.getLogger(__name__)
 
 APIVersion = "1.0"
 
-class Api(object):
+class Api(payment.PaymentProvider):
     """A python interface to the BTCMerch API
+
+    The methods block until the server responds; use call() to make
+    requests from the user interface.
     """
+    timeout = 30
     def __init__(self, username, password, site, base_url):
         self._base_url = base_url + site + "/"
         self._auth = (username, password)
@@ -22,7 +21,8 @@ class Api(object):
         response = requests.post(
             self._base_url + "payment.json",
             data={'ref': str(ref), 'description': description,
-                  'amount': str(amount)}, auth=self._auth)
+                  'amount': str(amount)}, auth=self._auth,
+            timeout=self.timeout)
         response.raise_for_status()
 
         return response.json(parse_float=Decimal)
@@ -30,7 +30,7 @@ class Api(object):
         response = requests.post(
             self._base_url + "totals.json",
             data={'transaction': translist},
-            auth=self._auth)
+            auth=self._auth, timeout=self.timeout)
         response.raise_for_status()
 
         return response.json(parse_float=Decimal)
@@ -38,13 +38,17 @@ class Api(object):
         response = requests.post(
             self._base_url + "totals.json",
             data={'ref': ref, 'transaction': translist},
-            auth=self._auth)
+            auth=self._auth, timeout=self.timeout)
         response.raise_for_status()
 
         return response.json(parse_float=Decimal)
 
 class btcpopup(ui.dismisspopup):
     """A window used to accept a Bitcoin payment.
+
+    Requests to the merchant service are made in the background, and
+    the service is checked again every few seconds until the payment
+    has been received or the window is dismissed.
     """
     def __init__(self, pm, reg, payment):
         self._pm = pm
@@ -54,12 +58,20 @@ class btcpopup(ui.dismisspopup):
         self.h = mh
         self.w = mh * 2
         self.response = {}
+        self._call = None
+        self._poll = None
         # Title will be drawn in "refresh()"
         ui.dismisspopup.__init__(
             self, self.h, self.w, colour=ui.colour_input, keymap={
                 keyboard.K_CASH: (self.refresh, None, False),
                 keyboard.K_PRINT: (self.printout, None, False)})
         self.refresh()
+    def dismiss(self):
+        if self._call:
+            self._call.cancel()
+        if self._poll:
+            self._poll.cancel()
+        super().dismiss()
     @staticmethod
     def qrcode_data(response):
         """Construct a bitcoin URL using pay_to_address and to_pay from a
@@ -68,7 +80,9 @@ class btcpopup(ui.dismisspopup):
         return "bitcoin:{}?amount={}".format(
             response['pay_to_address'], response['to_pay'])
     def draw_qrcode(self):
-        if not _qrcode_available:
+        try:
+            import qrcode
+        except ImportError:
             self.addstr(2, 2, "QR code library not installed. Press Print.")
             return
         q = qrcode.QRCode(border=2)
@@ -124,7 +138,8 @@ class btcpopup(ui.dismisspopup):
                     d.printline("\t" + self.response['pay_to_address'])
                     d.printline()
                     d.printline()
-    def refresh(self):
+    def _payment(self):
+        """The pending payment, or None if it is no longer pending"""
         payment = td.s.query(Payment).get(self._paymentid)
         if not payment:
             self.dismiss()
@@ -137,13 +152,33 @@ class btcpopup(ui.dismisspopup):
             ui.infopopup(["The payment has already been completed."],
                          title="Error")
             return
+        return payment
+    def refresh(self):
+        if self._call and not self._call.finished:
+            # Still waiting for the last request
+            return
+        if self._poll:
+            self._poll.cancel()
+            self._poll = None
+        payment = self._payment()
+        if not payment:
+            return
         # A pending Bitcoin payment has the GBP amount as the reference.
         amount = Decimal(payment.ref)
-        try:
-            result = self._pm._api.request_payment(
-                "p{}".format(self._paymentid),
-                "Payment {}".format(self._paymentid), amount)
-        except requests.exceptions.HTTPError as e:
+        self._status("Contacting {}...".format(self._pm.description))
+        self._call = self._pm._api.call(
+            self._pm._api.request_payment,
+            "p{}".format(self._paymentid),
+            "Payment {}".format(self._paymentid), amount,
+            result=self._response, error=self._error)
+    def _status(self, text):
+        self.addstr(self.h - 1, 3, text.ljust(self.w - 6))
+    def _poll_now(self):
+        self._poll = None
+        with td.orm_session():
+            self.refresh()
+    def _error(self, e):
+        if isinstance(e, requests.exceptions.HTTPError):
             if e.response.status_code == 409:
                 return ui.infopopup(
                     ["The {} merchant service has rejected the payment "
@@ -152,30 +187,40 @@ class btcpopup(ui.dismisspopup):
                     title="{} error".format(self._pm.description))
             return ui.infopopup([str(e)], title="{} http error".format(
                 self._pm.description))
-        except Exception as e:
-            return ui.infopopup([str(e)], title="{} error".format(
-                self._pm.description))
-        self.response = result
-        if 'to_pay_url' in result:
-            self.addstr(
-                0, 1, "{} payment of {} - press {} to recheck".format(
-                    self._pm.description, tillconfig.fc(amount),
-                    keyboard.K_CASH.keycap))
-            self.draw_qrcode()
-        self.addstr(self.h - 1, 3, "Received {} of {} {} so far".format(
+        return ui.infopopup([str(e)], title="{} error".format(
+            self._pm.description))
+    def _response(self, result):
+        with td.orm_session():
+            payment = self._payment()
+            if not payment:
+                return
+            amount = Decimal(payment.ref)
+            self.response = result
+            if 'to_pay_url' in result:
+                self.addstr(
+                    0, 1, "{} payment of {} - press {} to recheck".format(
+                        self._pm.description, tillconfig.fc(amount),
+                        keyboard.K_CASH.keycap))
+                self.draw_qrcode()
+            self._status("Received {} of {} {} so far".format(
                 result['paid_so_far'], result['amount_in_btc'],
                 self._pm._currency))
-        if result['paid']:
-            self.dismiss()
-            self._pm._finish_payment(self._reg, payment,
-                                     result['amount_in_btc'])
+            if result['paid']:
+                self.dismiss()
+                self._pm._finish_payment(self._reg, payment,
+                                         result['amount_in_btc'])
+                return
+        self._poll = tillconfig.mainloop.add_timeout(
+            self._pm._poll_interval, self._poll_now,
+            desc="bitcoin payment check")
 
 class BitcoinPayment(payment.PaymentMethod):
     def __init__(self, paytype, description,
                  username, password, site, base_url,
                  currency="BTC", min_payment=Decimal("1.00"),
-                 account_code = None):
+                 account_code = None, poll_interval=5):
         payment.PaymentMethod.__init__(self, paytype, description)
+        self._poll_interval = poll_interval
         self._api = Api(username, password, site, base_url)
         self._min_payment = min_payment
         self._currency = currency
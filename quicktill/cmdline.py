@@ -3,6 +3,18 @@
 """
 
 import argparse
+import datetime
+
+def date(s):
+    """Parse a date in YYYY-MM-DD format
+
+    Suitable for use as an argparse argument type.
+    """
+    try:
+        return datetime.datetime.strptime(s, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "'{}' is not a date in YYYY-MM-DD format".format(s))
 
 class CommandTracker(type):
     """
@@ -179,22 +179,149 @@ template = r"""
 
 import yaml
 import argparse
+import io
+from sqlalchemy import inspect
+from psycopg2.extras import execute_values
 from . import models
 from . import td
 from . import cmdline
+from . import tillconfig
 
-def setup(f):
-    t = yaml.load(f)
+# The C implementation of the YAML parser is much faster on large
+# files, but isn't always available
+_yaml_loader = getattr(yaml, "CLoader", yaml.Loader)
 
-    for m in t:
+def setup(f):
+    records = []
+    for m in yaml.load(f, Loader=_yaml_loader):
         if 'model' not in m:
             print("Missing model from %s"%m)
             continue
-        model = models.__dict__[m['model']]
-        del m['model']
+        records.append(m)
+    bulk_load(records)
+
+def merge_records(records):
+    """Add or update records one at a time using the ORM
+
+    Each record is a dict with a "model" key naming the model class;
+    the other keys are attributes of the model.
+    """
+    for m in records:
+        m = dict(m)
+        model = models.__dict__[m.pop('model')]
         td.s.merge(model(**m))
         td.s.flush()
 
+def _csv(value):
+    # An unquoted empty field is NULL; everything else is quoted
+    if value is None:
+        return ''
+    return '"' + str(value).replace('"', '""') + '"'
+
+def _quote(name):
+    return '"' + name + '"'
+
+def bulk_load(records):
+    """Add or update records in bulk
+
+    Leaves the database in the same state as merge_records(), but
+    instead of a round trip to the database per record the records
+    are grouped by table and the set of columns they set.  Records
+    whose primary key is given are inserted or updated with multi-row
+    INSERT ... ON CONFLICT statements; new records whose primary key
+    comes from a sequence have their keys allocated in a single query
+    and are loaded with COPY.  Tables are loaded parents first, so
+    foreign keys can refer to records anywhere in the file.
+
+    Records that can't be expressed as plain column values (for
+    example models with their own constructor) are passed to
+    merge_records() after everything else has been loaded.
+    """
+    upserts = {}  # table: {primary key: {column name: value}}
+    inserts = {}  # table: [{column name: value}]
+    leftovers = []
+    for m in records:
+        model = models.__dict__[m['model']]
+        mapper = inspect(model)
+        table = mapper.local_table
+        attrs = mapper.column_attrs
+        values = {}
+        for key, value in m.items():
+            if key == 'model':
+                continue
+            if key not in attrs:
+                break
+            values[attrs[key].columns[0].name] = value
+        else:
+            if '__init__' not in model.__dict__:
+                pk = tuple(values.get(c.name) for c in mapper.primary_key)
+                if None not in pk:
+                    upserts.setdefault(table, {})\
+                           .setdefault(pk, {}).update(values)
+                    continue
+                if len(pk) == 1 and mapper.primary_key[0].default is not None \
+                   and mapper.primary_key[0].default.is_sequence:
+                    inserts.setdefault(table, []).append(values)
+                    continue
+        leftovers.append(m)
+
+    td.s.flush()
+    cursor = td.s.connection().connection.cursor()
+    for table in models.metadata.sorted_tables:
+        pkcols = [c.name for c in table.primary_key.columns]
+        defaults = {c.name: c.default.arg for c in table.columns
+                    if c.default is not None and c.default.is_scalar}
+        # New records are added first, in case later records in the
+        # file refer to them by the keys they are given
+        rows = inserts.get(table)
+        if rows:
+            pk = list(table.primary_key.columns)[0]
+            cursor.execute(
+                "SELECT nextval(%s) FROM generate_series(1, %s)",
+                (pk.default.name, len(rows)))
+            for row, (id,) in zip(rows, cursor.fetchall()):
+                row[pk.name] = id
+            groups = {}
+            for row in rows:
+                groups.setdefault(frozenset(row.keys()), []).append(row)
+            for given, group in groups.items():
+                columns = sorted(given | defaults.keys())
+                data = io.StringIO()
+                for row in group:
+                    data.write(",".join(
+                        _csv(row.get(c, defaults.get(c))) for c in columns))
+                    data.write("\n")
+                data.seek(0)
+                cursor.copy_expert(
+                    "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(
+                        _quote(table.name),
+                        ", ".join(_quote(c) for c in columns)), data)
+        # Group rows by the columns they set; only those columns are
+        # updated in existing rows, as with merge()
+        groups = {}
+        for row in upserts.get(table, {}).values():
+            groups.setdefault(frozenset(row.keys()), []).append(row)
+        for given, rows in groups.items():
+            columns = sorted(given | defaults.keys())
+            update = [c for c in sorted(given) if c not in pkcols]
+            sql = "INSERT INTO {} ({}) VALUES %s ON CONFLICT ({}) ".format(
+                _quote(table.name), ", ".join(_quote(c) for c in columns),
+                ", ".join(_quote(c) for c in pkcols))
+            if update:
+                sql += "DO UPDATE SET " + ", ".join(
+                    "{0} = EXCLUDED.{0}".format(_quote(c)) for c in update)
+            else:
+                sql += "DO NOTHING"
+            execute_values(
+                cursor, sql,
+                [tuple(row.get(c, defaults.get(c)) for c in columns)
+                 for row in rows],
+                page_size=1000)
+    cursor.close()
+    # The ORM's view of the database is now out of date
+    td.s.expire_all()
+    merge_records(leftovers)
+
 class dbsetup(cmdline.command):
     """Add initial records to the database.
 
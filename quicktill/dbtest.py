@@ -0,0 +1,85 @@
+"""Support for tests that need a database
+
+The tests connect to a PostgreSQL server over its local socket as the
+current user, who must be able to create databases.  Each test class
+gets a new database, which is dropped once the tests in the class have
+finished.
+
+Benchmarks are slow and only report how long things took, so they are
+skipped unless QUICKTILL_BENCHMARKS is set in the environment.  Their
+results are logged to the "quicktill.benchmark" logger.
+"""
+
+import os
+import logging
+import unittest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from . import models
+from . import td
+
+TEST_DATABASE_NAME = "quicktill-test"
+TEST_DATABASE_URL = "postgresql+psycopg2:///{}".format(TEST_DATABASE_NAME)
+
+benchmark_log = logging.getLogger("quicktill.benchmark")
+
+def benchmark(test):
+    """Decorator for tests that are only run when benchmarks are wanted"""
+    return unittest.skipUnless(
+        os.environ.get("QUICKTILL_BENCHMARKS"),
+        "set QUICKTILL_BENCHMARKS to run benchmarks")(test)
+
+def _admin(statement):
+    engine = create_engine("postgresql+psycopg2:///postgres")
+    conn = engine.connect()
+    conn.execute('commit')
+    conn.execute(statement)
+    conn.close()
+    engine.dispose()
+
+def create_database(name=TEST_DATABASE_NAME):
+    _admin('create database "{}"'.format(name))
+
+def drop_database(name=TEST_DATABASE_NAME):
+    _admin('drop database "{}"'.format(name))
+
+class DatabaseTest(unittest.TestCase):
+    """Tests that run against a new database with all the tables
+
+    The engine for the database is available as cls._engine, and
+    cls._sm is a sessionmaker that must be given a bind.  If use_td
+    is set, td.init() is called for the database so that the tests
+    can use td.orm_session() and td.sm.
+
+    Override _connect() and _disconnect() to reach the database in
+    a different way.
+    """
+    use_td = False
+
+    @classmethod
+    def setUpClass(cls):
+        create_database()
+        cls._engine = cls._connect(TEST_DATABASE_URL)
+        models.metadata.bind = cls._engine
+        models.metadata.create_all()
+        cls._sm = sessionmaker()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._disconnect()
+        del cls._engine
+        drop_database()
+
+    @classmethod
+    def _connect(cls, url):
+        """Return an engine for the test database"""
+        if cls.use_td:
+            td.init(url)
+            return td.sm.kw['bind']
+        return create_engine(url)
+
+    @classmethod
+    def _disconnect(cls):
+        # Dispose of the connection pool, closing all checked-in
+        # connections, so that the database can be dropped
+        cls._engine.dispose()
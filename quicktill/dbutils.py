@@ -2,7 +2,11 @@
 """
 
 import os
+import re
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import DDL, CreateIndex
 from . import cmdline
+from . import migrate
 from . import td
 from . import models
 from . import tillconfig
@@ -186,7 +190,7 @@ class checkdb(cmdline.command):
                 os.unlink(current.name)
                 os.unlink(pristine.name)
 
-class add_transline_text(cmdline.command):
+class TranslineText(migrate.Migration):
     """Fill in "text" field in translines.
 
     In the past the "text" field in transaction lines was optional;
@@ -197,34 +201,419 @@ class add_transline_text(cmdline.command):
 
     In the future the "text" field will not be allowed to be null.
 
-    This command computes and stores the "text" field for all
+    This migration computes and stores the "text" field for all
     transaction lines where this field is currently null.
 
+    This migration will be removed in quicktill-0.13.
+    """
+    name = "add-transline-text"
+    help = "update old transaction lines prior to installing quicktill-0.13"
+    model = models.Transline
+    # Memory usage is proportional to batch size; batches of 2000
+    # keep real memory usage below 90Mb
+    batch_size = 2000
+
+    def query(self, s):
+        from sqlalchemy.orm import joinedload_all
+        return s.query(models.Transline)\
+                .filter(models.Transline.text == None)\
+                .options(joinedload_all('stockref.stockitem.stocktype'))
+
+    def migrate(self, s, lines):
+        for l in lines:
+            l.text = l.description
+
+class add_transline_text(cmdline.command):
+    """Fill in "text" field in translines.
+
+    This is the same as "migrate add-transline-text".
+
     This command will be removed in quicktill-0.13.
     """
     command = "add-transline-text"
     help = "update old transaction lines prior to installing quicktill-0.13"
 
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("--workers", type=int, default=1,
+                            help="number of worker processes")
+        parser.add_argument("--delay", type=float, default=0.0,
+                            help="seconds to wait between batches")
+
+    @staticmethod
+    def run(args):
+        td.init(tillconfig.database)
+        rows = migrate.run(TranslineText(), workers=args.workers,
+                           delay=args.delay)
+        print("{} lines updated.".format(rows))
+
+class PullthruIndex(migrate.SchemaMigration):
+    """Add the index used by the pull-through check.
+    """
+    name = "stockout-pullthru-key"
+    help = "add the index used by the pull-through check"
+
+    def apply(self, s):
+        if not migrate.relation_exists(s, "stockout_pullthru_key"):
+            s.execute(CreateIndex(models.stockout_pullthru_key))
+
+class StocklineSaleFunction(migrate.SchemaMigration):
+    """Replace the stockline_sale() database function.
+
+    The function now takes the pull-through age as a parameter and
+    no longer starts transactions itself.
+    """
+    name = "stockline-sale-function"
+    help = "replace the stockline_sale() database function"
+
+    def apply(self, s):
+        s.execute("DROP FUNCTION IF EXISTS stockline_sale(integer, integer, "
+                  "numeric, integer, numeric, integer, text, integer, "
+                  "integer)")
+        s.execute("DROP FUNCTION IF EXISTS stockline_sale(integer, integer, "
+                  "numeric, integer, numeric, integer, text, integer, "
+                  "integer, interval)")
+        s.execute(DDL(models.stockline_sale_ddl))
+
+class StocktypeLogTrigger(migrate.SchemaMigration):
+    """Replace the log_stocktype rules with a trigger.
+
+    The trigger only adds to stockline_stocktype_log when the
+    stockline or stocktype of a stock item changes.
+    """
+    name = "stocktype-log-trigger"
+    help = "replace the log_stocktype rules with a trigger"
+
+    def apply(self, s):
+        s.execute("DROP RULE IF EXISTS log_stocktype ON stock")
+        s.execute("DROP RULE IF EXISTS ignore_duplicate_stockline_types "
+                  "ON stockline_stocktype_log")
+        s.execute("DROP TRIGGER IF EXISTS log_stocktype ON stock")
+        s.execute(DDL(models.log_stocktype_ddl))
+
+class StatementTriggers(migrate.SchemaMigration):
+    """Make the transaction integrity triggers statement-level.
+
+    Replaces the row-level constraint triggers on sessions,
+    transactions, payments and translines.
+    """
+    name = "statement-triggers"
+    help = "make the transaction integrity triggers statement-level"
+
+    def apply(self, s):
+        for trigger, table in [
+                ("max_one_session_open", "sessions"),
+                ("close_only_if_balanced", "transactions"),
+                ("close_only_if_balanced_insert", "transactions"),
+                ("close_only_if_balanced_update", "transactions"),
+                ("no_modify_closed", "payments"),
+                ("no_modify_closed_insert", "payments"),
+                ("no_modify_closed_update", "payments"),
+                ("no_modify_closed", "translines")]:
+            s.execute('DROP TRIGGER IF EXISTS "{}" ON "{}"'.format(
+                trigger, table))
+        s.execute("DROP FUNCTION IF EXISTS check_modify_closed_trans_line()")
+        for ddl in (models.max_one_session_open_ddl,
+                    models.transaction_balances_ddl,
+                    models.payment_modify_closed_ddl,
+                    models.transline_modify_closed_ddl):
+            s.execute(DDL(ddl))
+        if not migrate.relation_exists(s, "sessions_open_key"):
+            s.execute(CreateIndex(models.sessions_open_key))
+
+class PartitionTables(migrate.SchemaMigration):
+    """Partition translines, payments and stockout.
+
+    The existing tables are renamed out of the way, the partitioned
+    tables are created and the records are copied across, so this
+    takes a while on a large database; stop the tills first.
+    Databases that already have partitioned tables just get the
+    triggers and functions that have changed since.  Sessions get
+    the columns that let queries skip old partitions, and the
+    "archived" flag.
+    """
+    name = "partition-tables"
+    help = "partition the translines, payments and stockout tables"
+
+    def apply(self, s):
+        tables = [models.Transline.__table__, models.Payment.__table__,
+                  models.StockOut.__table__]
+        partitioned = s.execute(
+            "SELECT relkind = 'p' FROM pg_class "
+            "WHERE oid = CAST('translines' AS regclass)").scalar()
+        for trigger, table in [
+                ("no_modify_closed", "translines"),
+                ("no_modify_closed", "payments"),
+                ("no_modify_closed_insert", "payments"),
+                ("no_modify_closed_update", "payments"),
+                ("voided_by_unique_insert", "translines"),
+                ("voided_by_unique_update", "translines")]:
+            s.execute('DROP TRIGGER IF EXISTS "{}" ON "{}"'.format(
+                trigger, table))
+        s.execute("DROP FUNCTION IF EXISTS check_modify_closed_trans_line()")
+        s.execute("DROP FUNCTION IF EXISTS "
+                  "add_partitions(text, text, text, bigint, text)")
+        s.execute(DDL(models.add_partitions_ddl))
+        if partitioned:
+            # voided_by used to be unique within each partition
+            for index, in s.execute(
+                    "SELECT c.relname FROM pg_inherits i "
+                    "JOIN pg_index x ON x.indrelid = i.inhrelid "
+                    "JOIN pg_class c ON c.oid = x.indexrelid "
+                    "WHERE i.inhparent = CAST('translines' AS regclass) "
+                    "AND x.indisunique AND NOT x.indisprimary").fetchall():
+                s.execute('DROP INDEX "{}"'.format(index))
+            if not migrate.relation_exists(s, "translines_voided_by_key"):
+                s.execute(CreateIndex(models.translines_voided_by_key))
+            s.execute(DDL(models.transline_modify_closed_ddl))
+            s.execute(DDL(models.transline_voided_by_unique_ddl))
+            s.execute(DDL(models.payment_modify_closed_ddl))
+        else:
+            for table in tables:
+                old = table.name + "_unpartitioned"
+                s.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(
+                    table.name, old))
+                for index, in s.execute(
+                        "SELECT c.relname FROM pg_index x "
+                        "JOIN pg_class c ON c.oid = x.indexrelid "
+                        "WHERE x.indrelid = CAST(:table AS regclass)",
+                        {'table': old}).fetchall():
+                    s.execute('ALTER INDEX "{}" RENAME TO "{}"'.format(
+                        index, index + "_unpartitioned"))
+            # Creates the indexes and triggers too
+            for table in tables:
+                table.create(s.connection())
+            s.execute("SELECT add_partitions()")
+            for table in tables:
+                seq = table.primary_key.columns.values()[0].default.name
+                columns = ", ".join('"{}"'.format(c.name)
+                                    for c in table.columns)
+                s.execute('ALTER SEQUENCE "{}" OWNED BY NONE'.format(seq))
+                s.execute('ALTER TABLE "{}" DISABLE TRIGGER USER'.format(
+                    table.name))
+                s.execute('INSERT INTO "{0}" ({1}) '
+                          'SELECT {1} FROM "{0}_unpartitioned"'.format(
+                              table.name, columns))
+                s.execute('ALTER TABLE "{}" ENABLE TRIGGER USER'.format(
+                    table.name))
+            for table in reversed(tables):
+                s.execute('DROP TABLE "{}_unpartitioned"'.format(table.name))
+
+        if not s.execute(
+                "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+                "WHERE table_name = 'sessions' "
+                "AND column_name = 'translines_from')").scalar():
+            s.execute("ALTER TABLE sessions "
+                      "ADD COLUMN translines_from integer, "
+                      "ADD COLUMN payments_from integer, "
+                      "ADD COLUMN archived boolean NOT NULL DEFAULT false")
+            # The open session may yet have deferred transactions
+            # moved into it, so it doesn't get a bound
+            s.execute("""
+UPDATE sessions s SET translines_from = x.lo
+  FROM (SELECT t.sessionid, min(tl.translineid) AS lo
+        FROM translines tl JOIN transactions t ON t.transid = tl.transid
+        GROUP BY t.sessionid) x
+  WHERE s.sessionid = x.sessionid AND s.endtime IS NOT NULL""")
+            s.execute("""
+UPDATE sessions s SET payments_from = x.lo
+  FROM (SELECT t.sessionid, min(p.paymentid) AS lo
+        FROM payments p JOIN transactions t ON t.transid = p.transid
+        GROUP BY t.sessionid) x
+  WHERE s.sessionid = x.sessionid AND s.endtime IS NOT NULL""")
+            s.execute("UPDATE sessions "
+                      "SET translines_from = coalesce(translines_from, 0), "
+                      "payments_from = coalesce(payments_from, 0) "
+                      "WHERE translines_from IS NULL OR payments_from IS NULL")
+            s.execute("ALTER TABLE sessions "
+                      "ALTER COLUMN translines_from SET NOT NULL, "
+                      "ALTER COLUMN payments_from SET NOT NULL")
+        s.execute("DROP TRIGGER IF EXISTS set_partition_bounds ON sessions")
+        s.execute(DDL(models.session_partition_bounds_ddl))
+
+class OutboxBatchKey(migrate.SchemaMigration):
+    """Add the batch_key column to the accounts outbox.
+
+    Databases that don't have the accounts_outbox table yet get the
+    new column when the missing tables are added.
+    """
+    name = "accounts-outbox-batch-key"
+    help = "add the batch_key column to the accounts outbox"
+
+    def apply(self, s):
+        if migrate.relation_exists(s, "accounts_outbox"):
+            s.execute("ALTER TABLE accounts_outbox "
+                      "ADD COLUMN IF NOT EXISTS batch_key "
+                      "character varying(36)")
+
+class StocklineSaleContinuousLocking(migrate.SchemaMigration):
+    """Replace the stockline_sale() database function.
+
+    Sales from continuous stocklines now lock only the stock items
+    they take from, waiting for other sales instead of skipping them.
+    """
+    name = "stockline-sale-continuous-locking"
+    help = "replace the stockline_sale() database function"
+
+    def apply(self, s):
+        s.execute(DDL(models.stockline_sale_ddl))
+
+_partition_bound_re = re.compile(r"FOR VALUES FROM \((\d+)\) TO \((\d+)\)")
+
+# For each partitioned table, a query that is true if any of the rows
+# in a partition must stay in the live table.  Stock usage is only
+# archived once the stock item has finished, so that the amount
+# remaining of items still in stock is not affected.  Transaction
+# lines are only archived once no live stock usage refers to them;
+# :archived lists the stock usage partitions that have just been (or
+# would be) archived.
+_archive_blockers = {
+    'stockout': """
+SELECT EXISTS (SELECT 1 FROM "{}" so
+  JOIN stock si ON si.stockid = so.stockid
+  WHERE so.time >= :before
+    OR si.finished IS NULL
+    OR si.finished >= :before)""",
+    'payments': """
+SELECT EXISTS (SELECT 1 FROM "{}" p
+  JOIN transactions t ON t.transid = p.transid
+  LEFT JOIN sessions s ON s.sessionid = t.sessionid
+  WHERE NOT t.closed
+    OR s.endtime IS NULL
+    OR s.sessiondate >= :before)""",
+    'translines': """
+SELECT EXISTS (SELECT 1 FROM "{}" tl
+  JOIN transactions t ON t.transid = tl.transid
+  LEFT JOIN sessions s ON s.sessionid = t.sessionid
+  WHERE NOT t.closed
+    OR s.endtime IS NULL
+    OR s.sessiondate >= :before
+    OR EXISTS (SELECT 1 FROM stockout so
+               WHERE so.translineid = tl.translineid
+                 AND so.tableoid <> ALL(CAST(:archived AS regclass[]))))""",
+}
+
+# Mark the sessions that have records in a partition that is being
+# archived, so that their totals can be shown as incomplete
+_archive_sessions = {
+    'payments': """
+UPDATE sessions SET archived = true
+  WHERE sessionid IN (SELECT t.sessionid FROM "{}" p
+                      JOIN transactions t ON t.transid = p.transid)""",
+    'translines': """
+UPDATE sessions SET archived = true
+  WHERE sessionid IN (SELECT t.sessionid FROM "{}" tl
+                      JOIN transactions t ON t.transid = tl.transid)""",
+}
+
+def partitions(s, table):
+    """List the range partitions of a table
+
+    Returns a list of (name, lower bound, upper bound) tuples in order
+    of lower bound.  The default partition is not included.
+    """
+    r = []
+    for name, bound in s.execute(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+            "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:table AS regclass)",
+            {'table': table}):
+        m = _partition_bound_re.match(bound)
+        if m:
+            r.append((name, int(m.group(1)), int(m.group(2))))
+    r.sort(key=lambda x: x[1])
+    return r
+
+def archive_partitions(s, before, dryrun=False):
+    """Move old partitions to the archive schema
+
+    Detaches all the partitions of the partitioned tables that only
+    contain records from sessions before the specified date, drops
+    their foreign key constraints and moves them to the "archive"
+    schema.  If dryrun is set, nothing is changed and no locks are
+    taken other than those needed to read the partitions.
+
+    Returns a list of (partition name, error) tuples; error is None
+    if the partition was (or would be) archived.
+    """
+    if not dryrun:
+        s.execute("CREATE SCHEMA IF NOT EXISTS archive")
+    results = []
+    archived = []
+    # Stock usage refers to transaction lines, so must be archived
+    # before them
+    for table, key, seq, size in reversed(models.partitioned_tables):
+        last = s.execute('SELECT last_value FROM "{}"'.format(seq)).scalar()
+        for name, lower, upper in partitions(s, table):
+            if last + 1 < upper:
+                # New records may still be added to this partition
+                continue
+            if s.execute(_archive_blockers[table].format(name),
+                         {'before': before, 'archived': archived}).scalar():
+                continue
+            if dryrun:
+                archived.append(name)
+                results.append((name, None))
+                continue
+            sp = s.begin_nested()
+            try:
+                if table in _archive_sessions:
+                    s.execute(_archive_sessions[table].format(name))
+                s.execute('ALTER TABLE "{}" DETACH PARTITION "{}"'.format(
+                    table, name))
+                for conname, in s.execute(
+                        "SELECT conname FROM pg_constraint "
+                        "WHERE conrelid = CAST(:name AS regclass) "
+                        "AND contype = 'f'", {'name': name}).fetchall():
+                    s.execute('ALTER TABLE "{}" DROP CONSTRAINT "{}"'.format(
+                        name, conname))
+                s.execute('ALTER TABLE "{}" SET SCHEMA archive'.format(name))
+                sp.commit()
+                results.append((name, None))
+            except DBAPIError as e:
+                sp.rollback()
+                results.append((name, str(e.orig).strip()))
+    return results
+
+class archive(cmdline.command):
+    """Move old records out of the live tables.
+
+    The translines, payments and stockout tables are partitioned by
+    ranges of their IDs.  This command detaches the partitions that
+    only contain records from sessions before the specified date and
+    moves them to the "archive" schema.  The archived records can
+    still be queried there, but the till and web interface no longer
+    see them: the sessions they belonged to are marked as archived,
+    and their totals are shown as incomplete.
+
+    Stock usage records are only archived once the stock items they
+    refer to have finished.
+
+    Detaching a partition briefly locks the whole table, so run this
+    when the tills are quiet.
+    """
+    help = "move old records to the archive schema"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("--before", type=cmdline.date, required=True,
+                            help="archive records from sessions before "
+                            "this date (YYYY-MM-DD)")
+        parser.add_argument("--dry-run", action="store_true", dest="dryrun",
+                            help="report what would be archived without "
+                            "changing anything")
+
     @staticmethod
     def run(args):
-        from sqlalchemy.orm import joinedload_all
         td.init(tillconfig.database)
         with td.orm_session():
-            q = td.s.query(models.Transline)\
-                    .filter(models.Transline.text == None)
-            total = q.count()
-            print("There are {} lines to update.".format(total))
-            # Memory usage is proportional to batch size; batches of 2000
-            # keep real memory usage below 90Mb
-            q = q.limit(2000)\
-                 .options(joinedload_all('stockref.stockitem.stocktype'))
-            c = 0
-            done = 1
-            while done > 0:
-                lines = q.all()
-                done = len(lines)
-                for l in lines:
-                    l.text = l.description
-                td.s.commit()
-                c += done
-                print("{} out of {} updated".format(c, total))
+            results = archive_partitions(td.s, args.before,
+                                         dryrun=args.dryrun)
+        if not results:
+            print("There are no partitions to archive.")
+        for name, error in results:
+            if error:
+                print("{}: not archived: {}".format(name, error))
+            else:
+                print("{}: {}".format(
+                    name, "would be archived" if args.dryrun else "archived"))
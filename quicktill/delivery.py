@@ -1,10 +1,12 @@
 from . import ui, stock, td, keyboard, printer, tillconfig, stocktype
-from . import user, usestock
-from decimal import Decimal
+from . import user, usestock, cmdline
+from decimal import Decimal, InvalidOperation
 from .models import Delivery, Supplier, StockUnit, StockItem, StockType
 from .models import penny
 from .plugins import InstancePluginMount
 import datetime
+import argparse
+import csv
 
 import logging
 log = logging.getLogger(__name__)
@@ -494,21 +496,37 @@ class stockitem(ui.basicpopup):
             self.func(self.item)
         else:
             qty = int(self.qtyfield.f)
-            costper = (cost/qty).quantize(penny) if cost else None
-            remaining_cost = cost
-            for i in range(qty):
-                thiscost = remaining_cost if i == (qty - 1) else costper
-                remaining_cost = remaining_cost - thiscost if cost else None
-                item = StockItem()
-                item.deliveryid = self.deliveryid
-                item.stocktype = stocktype
-                item.stockunit = stockunit
-                item.costprice = thiscost
-                item.bestbefore = self.bestbeforefield.read()
+            if qty == 1:
+                item = StockItem(
+                    deliveryid=self.deliveryid, stocktype=stocktype,
+                    stockunit=stockunit, costprice=cost,
+                    bestbefore=self.bestbeforefield.read())
                 td.s.add(item)
                 td.s.flush()
+                items = [item]
+            else:
+                # Many items may be entered at once, so add them with
+                # a single INSERT
+                td.s.flush()
+                items = td.stock_create(
+                    td.s.query(Delivery).get(self.deliveryid),
+                    stocktype, stockunit, split_cost(cost, qty),
+                    self.bestbeforefield.read())
+            for item in items:
                 self.func(item)
 
+def split_cost(cost, qty):
+    """Split the cost of several items
+
+    Returns a list of qty costs.  The items cost the same, except
+    that the last one absorbs any rounding error so that the total is
+    exactly cost.  If cost is None, all the items have cost None.
+    """
+    if cost is None:
+        return [None] * qty
+    costper = (cost / qty).quantize(penny)
+    return [costper] * (qty - 1) + [cost - costper * (qty - 1)]
+
 def createsupplier(field, name):
     # Called by the select supplier field if it decides we need to create
     # a new supplier record.
@@ -600,3 +618,124 @@ class DeliveryHooks(metaclass=InstancePluginMount):
     def confirmed(self, deliveryid):
         """Called when a delivery has been confirmed."""
         pass
+
+class import_delivery(cmdline.command):
+    """Create a delivery from a supplier's invoice in CSV format.
+
+    The first row of the file must name the columns.  Each subsequent
+    row adds one or more identical items to the delivery.  The columns
+    are:
+
+    stocktype: the stock type number; if absent, the stock type is
+    found by exact match on the manufacturer and name columns
+
+    stockunit: the stock unit, eg. "firkin" or "case24"
+
+    qty: the number of items (optional, default 1)
+
+    cost: the total cost of the items ex-VAT (optional)
+
+    bestbefore: the best before date as YYYY-MM-DD (optional)
+
+    Every row is checked before anything is created, and the delivery
+    is created in a single transaction, so either the whole delivery
+    is imported or none of it is.  The new delivery is not confirmed;
+    check it on the till and confirm it there.
+    """
+    command = "import-delivery"
+    help = "create a delivery from a CSV supplier invoice"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("supplier", help="Supplier name")
+        parser.add_argument("docnumber", help="Document number")
+        parser.add_argument("csvfile", type=argparse.FileType('r'),
+                            help="CSV file")
+        parser.add_argument("--date", dest="date", type=cmdline.date,
+                            metavar="YYYY-MM-DD",
+                            help="Delivery date (default today)")
+
+    @staticmethod
+    def run(args):
+        td.init(tillconfig.database)
+        with td.orm_session():
+            supplier = td.s.query(Supplier)\
+                           .filter(Supplier.name == args.supplier)\
+                           .first()
+            if not supplier:
+                print("Supplier '{}' not found".format(args.supplier))
+                return 1
+            lines = []
+            errors = []
+            stocktypes = {}
+            stockunits = {su.id: su for su in td.s.query(StockUnit).all()}
+            with args.csvfile as f:
+                for row in csv.DictReader(f):
+                    lineno = len(lines) + len(errors) + 2
+                    try:
+                        lines.append(import_delivery._line(
+                            row, stocktypes, stockunits))
+                    except ValueError as e:
+                        errors.append("Line {}: {}".format(lineno, e))
+            if errors:
+                for e in errors:
+                    print(e)
+                print("Nothing imported.")
+                return 1
+            d = Delivery(
+                supplier=supplier, docnumber=args.docnumber,
+                date=args.date or datetime.date.today())
+            td.s.add(d)
+            td.s.flush()
+            count = 0
+            for st, su, qty, cost, bestbefore in lines:
+                count += len(td.stock_create(
+                    d, st, su, split_cost(cost, qty), bestbefore))
+            print("Delivery {} created with {} items.".format(d.id, count))
+
+    @staticmethod
+    def _line(row, stocktypes, stockunits):
+        """Interpret a row of the CSV file
+
+        Returns (StockType, StockUnit, qty, cost, bestbefore) or
+        raises ValueError.  stocktypes is a cache of stock types
+        already looked up.
+        """
+        if row.get('stocktype'):
+            key = int(row['stocktype'])
+            if key not in stocktypes:
+                stocktypes[key] = td.s.query(StockType).get(key)
+        else:
+            key = (row.get('manufacturer'), row.get('name'))
+            if key not in stocktypes:
+                stocktypes[key] = td.s.query(StockType)\
+                                      .filter_by(manufacturer=key[0],
+                                                 name=key[1])\
+                                      .first()
+        st = stocktypes[key]
+        if not st:
+            raise ValueError("stock type {} not found".format(key))
+        su = stockunits.get(row.get('stockunit'))
+        if not su:
+            raise ValueError("stock unit '{}' not found".format(
+                row.get('stockunit')))
+        if su.unit_id != st.unit_id:
+            raise ValueError("stock unit '{}' can't be used for {}".format(
+                su.id, st.format()))
+        qty = int(row.get('qty') or 1)
+        if qty < 1:
+            raise ValueError("qty must be at least 1")
+        cost = None
+        if row.get('cost'):
+            try:
+                cost = Decimal(row['cost']).quantize(penny)
+            except InvalidOperation:
+                raise ValueError("cost '{}' is not a number".format(
+                    row['cost']))
+        bestbefore = None
+        if row.get('bestbefore'):
+            try:
+                bestbefore = cmdline.date(row['bestbefore'])
+            except argparse.ArgumentTypeError as e:
+                raise ValueError(str(e))
+        return (st, su, qty, cost, bestbefore)
@@ -1,4 +1,6 @@
 import selectors
+import collections
+import os
 import time
 import logging
 
@@ -32,6 +34,14 @@ class SelectorsMainLoop:
         self.exit_code = None
         # Future events: key is wrapper object, value is time
         self._timeouts = {}
+        # Functions passed to call_from_thread() that are waiting to
+        # be called.  Other threads wake us up by writing to a pipe.
+        self._calls = collections.deque()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self.add_fd(self._wakeup_r, self._run_calls,
+                    desc="call_from_thread wakeup")
 
     def shutdown(self, code):
         self.exit_code = code
@@ -91,6 +101,29 @@ class SelectorsMainLoop:
         self._timeouts[wrapper] = call_at
         return wrapper
 
+    def call_from_thread(self, func, desc=None):
+        """Call a function from the main loop as soon as possible
+
+        This is the only method that may be called from threads other
+        than the one running the main loop.
+        """
+        self._calls.append(func)
+        try:
+            os.write(self._wakeup_w, b"\0")
+        except BlockingIOError:
+            # The pipe is full, so we are going to wake up anyway
+            pass
+
+    def _run_calls(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._calls:
+            with timeout_time_guard:
+                self._calls.popleft()()
+
     def iterate(self):
         # Work out what the earliest timeout is
         timeout = None
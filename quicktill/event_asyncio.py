@@ -0,0 +1,208 @@
+from .event import doread_time_guard, dowrite_time_guard, timeout_time_guard
+import asyncio
+import collections.abc
+import http.client
+import io
+import sys
+import urllib.parse
+
+class AsyncioMainLoop:
+    """Event loop based on asyncio
+
+    As well as the callback interface shared with the other main
+    loops, this one can run coroutines using run_coroutine().  They
+    can await non-blocking I/O, for example using http_request() or
+    asyncio.open_connection(), without holding up the rest of the
+    till.
+
+    iterate() returns once at least one callback, or one step of a
+    coroutine, has run, so that the display can be updated.
+    """
+    def __init__(self):
+        self.exit_code = None
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._exc_info = None
+
+    def shutdown(self, code):
+        self.exit_code = code
+
+    def iterate(self):
+        self._exc_info = None
+        self._loop.run_forever()
+        if self._exc_info:
+            raise self._exc_info[0].with_traceback(
+                self._exc_info[1], self._exc_info[2])
+
+    def _wake(self):
+        # Return from iterate() at the end of this pass through the
+        # asyncio loop
+        self._loop.stop()
+
+    def _call(self, guard, func, *args):
+        try:
+            with guard:
+                func(*args)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._wake()
+
+    class _asyncio_fd_watch:
+        def __init__(self, mainloop, fd, read, write, desc):
+            self._mainloop = mainloop
+            self._fd = fd
+            self.description = desc
+            self._read = read
+            self._write = write
+            if read:
+                mainloop._loop.add_reader(
+                    fd, mainloop._call, doread_time_guard, read)
+            if write:
+                mainloop._loop.add_writer(
+                    fd, mainloop._call, dowrite_time_guard, write)
+
+        def remove(self):
+            if self._read:
+                self._mainloop._loop.remove_reader(self._fd)
+            if self._write:
+                self._mainloop._loop.remove_writer(self._fd)
+            del self._read, self._write
+
+    def add_fd(self, fd, read=None, write=None, desc=None):
+        """Start watching a fd
+
+        Call read or write as appropriate when the fd is ready
+
+        Returns an object with a "remove" method that can be used to
+        cancel the watch.
+        """
+        return self._asyncio_fd_watch(self, fd, read, write, desc)
+
+    class _asyncio_timeout:
+        def __init__(self, mainloop, timeout, func, desc):
+            self.description = desc
+            self._handle = mainloop._loop.call_later(
+                timeout, mainloop._call, timeout_time_guard, func)
+
+        def cancel(self):
+            self._handle.cancel()
+            del self._handle
+
+    def add_timeout(self, timeout, func, desc=None):
+        """Add a callback for an amount of time in the future
+
+        Returns an object that can be used to cancel the callback.
+        """
+        return self._asyncio_timeout(self, timeout, func, desc)
+
+    def call_from_thread(self, func, desc=None):
+        """Call a function from the main loop as soon as possible
+
+        This is the only method that may be called from threads other
+        than the one running the main loop.
+        """
+        self._loop.call_soon_threadsafe(
+            self._call, timeout_time_guard, func)
+
+    def run_coroutine(self, coro, result=None, error=None):
+        """Run a coroutine on the main loop
+
+        When it finishes, result is called with its return value, or
+        if it raised an exception error is called with the exception.
+        If there is no error function, the exception is raised from
+        iterate().
+
+        Returns an asyncio.Task that can be used to cancel the
+        coroutine.
+        """
+        task = self._loop.create_task(_waking_coroutine(self, coro))
+        def done(task):
+            if task.cancelled():
+                return
+            e = task.exception()
+            if e is None:
+                if result:
+                    result(task.result())
+            elif error:
+                error(e)
+            else:
+                raise e
+        task.add_done_callback(
+            lambda task: self._call(timeout_time_guard, done, task))
+        return task
+
+class _waking_coroutine(collections.abc.Coroutine):
+    """Make iterate() return each time a coroutine runs
+
+    This is so that the display is updated after each step.
+    """
+    def __init__(self, mainloop, coro):
+        self._mainloop = mainloop
+        self._coro = coro
+
+    def send(self, value):
+        try:
+            return self._coro.send(value)
+        finally:
+            self._mainloop._wake()
+
+    def throw(self, *args):
+        try:
+            return self._coro.throw(*args)
+        finally:
+            self._mainloop._wake()
+
+    def close(self):
+        self._coro.close()
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+async def http_request(url, method="GET", body=None, headers={}, timeout=30):
+    """Make an HTTP request without blocking
+
+    body, if present, must be bytes.  Returns a tuple of (status,
+    headers, body).  Raises asyncio.TimeoutError if there is no
+    complete response within timeout seconds.
+    """
+    u = urllib.parse.urlsplit(url)
+    secure = u.scheme == "https"
+    port = u.port or (443 if secure else 80)
+    path = u.path or "/"
+    if u.query:
+        path = path + "?" + u.query
+
+    async def request():
+        reader, writer = await asyncio.open_connection(
+            u.hostname, port, ssl=True if secure else None)
+        try:
+            h = {"Host": u.netloc, "Connection": "close",
+                 "User-Agent": "quicktill"}
+            h.update(headers)
+            if body is not None:
+                h["Content-Length"] = str(len(body))
+            # HTTP/1.0 so that the response isn't chunked; we read
+            # until the server closes the connection
+            request = "{} {} HTTP/1.0\r\n".format(method, path) \
+                      + "".join("{}: {}\r\n".format(k, v)
+                                for k, v in h.items()) + "\r\n"
+            writer.write(request.encode('iso-8859-1'))
+            if body is not None:
+                writer.write(body)
+            await writer.drain()
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, data = response.partition(b"\r\n\r\n")
+        statusline, _, rest = head.partition(b"\r\n")
+        status = int(statusline.split()[1])
+        return status, http.client.parse_headers(
+            io.BytesIO(rest + b"\r\n\r\n")), data
+
+    return await asyncio.wait_for(request(), timeout)
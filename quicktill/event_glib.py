@@ -77,5 +77,16 @@ class GLibMainLoop:
     def add_timeout(self, timeout, func, desc=None):
         return self._glib_timeout(self, timeout, func, desc)
 
+    def call_from_thread(self, func, desc=None):
+        # GLib.idle_add() may be called from any thread
+        GLib.idle_add(self._call_from_thread, func)
+
+    def _call_from_thread(self, func):
+        try:
+            func()
+        except Exception as e:
+            self._exc_info = sys.exc_info()
+        return False
+
 if GLib is None:
     GLibMainLoop = None
@@ -1,7 +1,5 @@
 from . import ui, keyboard, tillconfig, user, cmdline
-import twython
 import time, datetime
-from requests_oauthlib import OAuth1Session
 
 ### Reminders at particular times of day
 class reminderpopup:
@@ -57,6 +55,8 @@ class twitter_auth(cmdline.command):
 
     @staticmethod
     def run(args):
+        import twython
+        from requests_oauthlib import OAuth1Session
         if not args.consumer_key:
             args.consumer_key = input("Consumer key: ")
         if not args.consumer_secret:
@@ -101,6 +101,8 @@ class twitter_auth(cmdline.command):
                 args.consumer_key, args.consumer_secret))
 
 def twitter_api(token, token_secret, consumer_key, consumer_secret):
+    # twython is only imported by tills that use Twitter
+    import twython
     return twython.Twython(
         app_key=consumer_key,
         app_secret=consumer_secret,
@@ -6,6 +6,11 @@ import sys
 import traceback
 import datetime
 import hashlib
+import importlib.util
+import marshal
+import os
+import threading
+import time
 import logging
 from . import ui, keyboard, td, printer, tillconfig, pdrivers, user
 from .models import zero, penny
@@ -14,6 +19,165 @@ log=logging.getLogger(__name__)
 
 kitchenprinter=pdrivers.nullprinter(name="default_kitchenprinter")
 menuurl=None
+# Don't check for a new menu more often than this, in seconds
+menu_check_interval=30
+
+class _menucache:
+    """The food menu module
+
+    The menu is fetched from menuurl the first time it is needed.
+    After that the popup opens straight away using the menu we
+    already have, and we check for a new menu in the background using
+    a conditional request.  The menu is compiled in the background
+    too; only running the compiled module happens on the main thread.
+
+    The compiled menu is also saved in tillconfig.cache_dir, so it is
+    available straight away after the till restarts.
+    """
+    def __init__(self):
+        self.module = None
+        self.url = None
+        self.hash = None
+        self.etag = None
+        self.last_modified = None
+        self.checked = None
+        self.checking = False
+
+    @staticmethod
+    def _cachefile():
+        if tillconfig.cache_dir:
+            return os.path.join(tillconfig.cache_dir, "foodmenu")
+
+    @staticmethod
+    def _fetch(url, etag, last_modified):
+        """Fetch and compile the menu
+
+        Returns None if it has not changed, otherwise a tuple of
+        (hash, code, etag, last_modified).  May be called from any
+        thread.
+        """
+        request = urllib.request.Request(url)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if last_modified:
+            request.add_header('If-Modified-Since', last_modified)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as f:
+                source = f.read()
+                headers = f.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return
+            raise
+        return (hashlib.sha1(source).hexdigest(), compile(source, url, 'exec'),
+                headers.get('ETag'), headers.get('Last-Modified'))
+
+    def _install(self, url, hash, code, etag, last_modified, save=True):
+        """Start using a new menu
+
+        Returns True if the menu is different from the one we had.
+        """
+        self.etag = etag
+        self.last_modified = last_modified
+        if url == self.url and hash == self.hash:
+            return False
+        log.debug("creating new menu module - oldhash %s, newhash %s",
+                  self.hash, hash)
+        module = imp.new_module("foodmenu")
+        exec(code, module.__dict__)
+        self.module = module
+        self.url = url
+        self.hash = hash
+        if save:
+            self._save(code)
+        return True
+
+    def _save(self, code):
+        cachefile = self._cachefile()
+        if not cachefile:
+            return
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            with open(cachefile + ".new", "wb") as f:
+                marshal.dump((importlib.util.MAGIC_NUMBER, self.url,
+                              self.hash, self.etag, self.last_modified,
+                              code), f)
+            os.replace(cachefile + ".new", cachefile)
+        except OSError as e:
+            log.warning("Unable to save the food menu cache: %s", e)
+
+    def _load(self, url):
+        """Load the menu saved by a previous run, if it is for url"""
+        cachefile = self._cachefile()
+        if not cachefile or not os.path.exists(cachefile):
+            return
+        try:
+            with open(cachefile, "rb") as f:
+                magic, cached_url, hash, etag, last_modified, code \
+                    = marshal.load(f)
+            if magic != importlib.util.MAGIC_NUMBER or cached_url != url:
+                return
+            self._install(url, hash, code, etag, last_modified, save=False)
+        except Exception:
+            log.exception("Unable to load the food menu cache")
+
+    def get(self, url):
+        """Return the menu module
+
+        If we don't have a menu yet, wait for it to be fetched;
+        otherwise return the one we have and check for a new one in
+        the background.
+        """
+        if self.url != url:
+            self._load(url)
+        if self.url != url:
+            result = self._fetch(url, None, None)
+            self.checked = time.monotonic()
+            self._install(url, *result)
+            return self.module
+        self.check(url)
+        return self.module
+
+    def check(self, url):
+        """Check for a new menu in the background"""
+        if self.checking or (
+                self.checked and
+                time.monotonic() - self.checked < menu_check_interval):
+            return
+        self.checking = True
+        etag, last_modified = self.etag, self.last_modified
+        def run():
+            try:
+                result = self._fetch(url, etag, last_modified)
+            except Exception as e:
+                tillconfig.mainloop.call_from_thread(
+                    lambda e=e: self._check_failed(e))
+                return
+            tillconfig.mainloop.call_from_thread(
+                lambda: self._checked(url, result))
+        threading.Thread(target=run, name="foodmenu", daemon=True).start()
+
+    def _checked(self, url, result):
+        self.checking = False
+        self.checked = time.monotonic()
+        if not result:
+            return
+        try:
+            updated = self._install(url, *result)
+        except Exception:
+            log.exception("New food menu failed to load")
+            ui.toast("There is a problem with the new food menu; "
+                     "still using the old one.")
+            return
+        if updated:
+            ui.toast("Food menu updated.")
+
+    def _check_failed(self, e):
+        self.checking = False
+        self.checked = time.monotonic()
+        log.warning("Unable to check for a new food menu: %s", e)
+
+_menu = _menucache()
 
 class fooditem(ui.lrline):
     def __init__(self,name,price,dept=None):
@@ -259,33 +423,18 @@ class edititem(ui.dismisspopup):
 
 class popup(user.permission_checked,ui.basicpopup):
     permission_required=('kitchen-order','Send an order to the kitchen')
-    menu_hash=None
-    menu_module=None
     def __init__(self,func,ordernumberfunc=td.foodorder_ticket,transid=None):
         if menuurl is None:
             ui.infopopup(["No menu has been set!"],title="Error")
             return
         try:
-            f=urllib.request.urlopen(menuurl)
-            g=f.read()
-            f.close()
-        except:
+            foodmenu=_menu.get(menuurl)
+        except OSError:
             ui.infopopup(["Unable to read the menu!"],title="Error")
             return
-        hash=hashlib.sha1(g).hexdigest()
-        if hash!=self.menu_hash:
-            log.debug("creating new menu module - oldhash %s, newhash %s",
-                      self.menu_hash,hash)
-            try:
-                self.__class__.menu_module=imp.new_module("foodmenu")
-                exec(g,self.menu_module.__dict__)
-                self.__class__.menu_hash=hash
-            except:
-                self.__class__.menu_hash=None
-                self.__class__.menu_module=None
-                ui.popup_exception("There is a problem with the menu")
-                return
-        foodmenu=self.menu_module
+        except:
+            ui.popup_exception("There is a problem with the menu")
+            return
         if "menu" not in foodmenu.__dict__:
             ui.infopopup(["The menu file was read succesfully, but did not "
                           "contain a menu definition."],
@@ -0,0 +1,276 @@
+"""Resumable data migrations
+
+A data migration fills in or fixes up data in the existing rows of a
+table, for example after a schema change.  Rows are processed in
+batches in order of their primary key, so each batch is a short index
+range scan however far through the table the migration has got.  The
+last ID processed is recorded in the migration_progress table in the
+same database transaction as the batch itself, so an interrupted
+migration carries on from where it left off when it is run again.
+
+The table can be split into several ranges of IDs that are processed
+in parallel by separate worker processes.  A delay between batches
+limits the load on the database while the tills are in use.
+
+Migrations only deal with rows that exist when they are first run;
+code that adds new rows must already be filling in the new data.
+
+A schema migration brings the schema of a database created by an
+earlier version of the till software up to date, for example by
+adding an index or replacing a trigger.  It is applied in a single
+database transaction, and recorded in migration_progress so that it
+is only applied once.  Schema migrations must also be safe to apply
+to a database that was created with the new schema.
+"""
+
+import abc
+import time
+import datetime
+import multiprocessing
+from sqlalchemy import func, inspect
+from . import td
+from . import models
+from . import cmdline
+from . import tillconfig
+from .plugins import ClassPluginMount
+
+import logging
+log = logging.getLogger(__name__)
+
+class _MigrationMount(ClassPluginMount, abc.ABCMeta):
+    pass
+
+class Migration(metaclass=_MigrationMount):
+    """A data migration
+
+    Subclasses must set name and model, and override migrate().  The
+    model must have a single integer primary key.
+    """
+    name = None
+    help = None
+    model = None
+    batch_size = 2000
+
+    def query(self, s):
+        """Rows that may need migrating
+
+        Override this to filter the rows, or to add loader options.
+        """
+        return s.query(self.model)
+
+    @abc.abstractmethod
+    def migrate(self, s, rows):
+        """Migrate a batch of rows"""
+
+class SchemaMigration(metaclass=_MigrationMount):
+    """A schema migration
+
+    Subclasses must set name and override apply().
+    """
+    name = None
+    help = None
+
+    @abc.abstractmethod
+    def apply(self, s):
+        """Change the schema using database session s"""
+
+def migrations():
+    """Dict of all the migrations, by name"""
+    return {m.name: m for m in Migration.plugins + SchemaMigration.plugins
+            if not m.__abstractmethods__}
+
+def relation_exists(s, name):
+    """Does a table, index or sequence exist?"""
+    return s.execute("SELECT to_regclass(:name)",
+                     {'name': name}).scalar() is not None
+
+def apply_schema(migration):
+    """Apply a schema migration if it has not been applied already
+
+    Returns True if it was applied.
+    """
+    with td.orm_session():
+        done = td.s.query(models.MigrationProgress)\
+                   .filter(models.MigrationProgress.migration
+                           == migration.name)\
+                   .with_for_update()\
+                   .one_or_none()
+        if done:
+            return False
+        migration.apply(td.s)
+        td.s.add(models.MigrationProgress(
+            migration=migration.name, start=0, end=0, rows=0,
+            finished=datetime.datetime.now()))
+    log.info("%s: applied", migration.name)
+    return True
+
+def _key(migration):
+    return inspect(migration.model).primary_key[0]
+
+def plan(migration, workers=1):
+    """Split the IDs to be migrated into ranges
+
+    The ranges are only worked out the first time a migration is run;
+    after that the existing ranges are used whatever the number of
+    workers.  Returns a list of the start IDs of the ranges that
+    haven't finished.
+    """
+    with td.orm_session():
+        ranges = td.s.query(models.MigrationProgress)\
+                     .filter(models.MigrationProgress.migration
+                             == migration.name)\
+                     .order_by(models.MigrationProgress.start)\
+                     .all()
+        if not ranges:
+            key = _key(migration)
+            lo, hi = td.s.query(func.min(key), func.max(key)).one()
+            if lo is None:
+                lo, hi = 0, 0
+            hi += 1
+            step = -(-(hi - lo) // workers)
+            for start in range(lo, hi, step):
+                ranges.append(models.MigrationProgress(
+                    migration=migration.name, start=start,
+                    end=min(start + step, hi), rows=0))
+            td.s.add_all(ranges)
+        return [r.start for r in ranges if not r.finished]
+
+def migrate_range(migration, start, delay=0.0):
+    """Process a range of IDs in batches
+
+    Returns the number of rows processed.  If another process is
+    already working on the range, returns immediately.
+    """
+    key = _key(migration)
+    processed = 0
+    while True:
+        with td.orm_session():
+            progress = td.s.query(models.MigrationProgress)\
+                           .filter(models.MigrationProgress.migration
+                                   == migration.name)\
+                           .filter(models.MigrationProgress.start == start)\
+                           .with_for_update(skip_locked=True)\
+                           .one_or_none()
+            if not progress or progress.finished:
+                return processed
+            after = progress.position if progress.position is not None \
+                    else progress.start - 1
+            rows = migration.query(td.s)\
+                            .filter(key > after)\
+                            .filter(key < progress.end)\
+                            .order_by(key)\
+                            .limit(migration.batch_size)\
+                            .all()
+            if rows:
+                migration.migrate(td.s, rows)
+                progress.position = inspect(rows[-1]).identity[0]
+                progress.rows += len(rows)
+                log.info("%s: range %d-%d at %d", migration.name,
+                         progress.start, progress.end, progress.position)
+            else:
+                progress.finished = datetime.datetime.now()
+        if not rows:
+            return processed
+        processed += len(rows)
+        if delay:
+            time.sleep(delay)
+
+def _init_worker(database):
+    td.init(database)
+
+def _migrate_range_worker(name, start, delay):
+    return migrate_range(migrations()[name](), start, delay)
+
+def run(migration, workers=1, delay=0.0, database=None):
+    """Run a migration to completion
+
+    With more than one worker, the ranges are processed in separate
+    processes, each with its own connection to the database.
+    Returns the number of rows processed; this is always zero for
+    schema migrations.
+    """
+    if isinstance(migration, SchemaMigration):
+        apply_schema(migration)
+        return 0
+    starts = plan(migration, workers)
+    if workers > 1 and len(starts) > 1:
+        # Connections must not be shared with the worker processes
+        td.sm.kw['bind'].dispose()
+        with multiprocessing.Pool(
+                min(workers, len(starts)), initializer=_init_worker,
+                initargs=(database or tillconfig.database,)) as pool:
+            return sum(pool.starmap(
+                _migrate_range_worker,
+                [(migration.name, start, delay) for start in starts]))
+    return sum(migrate_range(migration, start, delay) for start in starts)
+
+def status(name):
+    """Progress of a migration
+
+    Returns (rows processed, number of ranges, number of ranges
+    finished), or None if the migration has not been started.
+    """
+    with td.orm_session():
+        ranges = td.s.query(models.MigrationProgress)\
+                     .filter(models.MigrationProgress.migration == name)\
+                     .all()
+        if not ranges:
+            return None
+        return (sum(r.rows for r in ranges), len(ranges),
+                len([r for r in ranges if r.finished]))
+
+class migrate_command(cmdline.command):
+    """Run a data or schema migration.
+
+    With no arguments, list the available migrations and how far each
+    of them has got.
+
+    Data migrations can be interrupted and will carry on from where
+    they left off when run again.  The number of workers is only used
+    the first time a migration is run.  Schema migrations are applied
+    in a single transaction; running one again does nothing.
+
+    """
+    command = "migrate"
+    help = "run a data or schema migration"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("name", nargs="?", help="migration to run")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="number of worker processes")
+        parser.add_argument("--delay", type=float, default=0.0,
+                            help="seconds to wait between batches")
+
+    @staticmethod
+    def run(args):
+        td.init(tillconfig.database)
+        available = migrations()
+        if not args.name:
+            for name, m in sorted(available.items()):
+                s = status(name)
+                if issubclass(m, SchemaMigration):
+                    state = "applied" if s else "not applied"
+                elif s is None:
+                    state = "not started"
+                else:
+                    rows, ranges, finished = s
+                    state = "{} rows processed, {} of {} ranges finished"\
+                            .format(rows, finished, ranges)
+                print("{}: {}".format(name, m.help or ""))
+                print("    {}".format(state))
+            return
+        if args.name not in available:
+            print("Unknown migration '{}'".format(args.name))
+            return 1
+        m = available[args.name]()
+        if isinstance(m, SchemaMigration):
+            if apply_schema(m):
+                print("Migration '{}' applied.".format(args.name))
+            else:
+                print("Migration '{}' was already applied.".format(
+                    args.name))
+            return
+        rows = run(m, workers=args.workers, delay=args.delay)
+        print("{} rows processed; migration '{}' finished.".format(
+            rows, args.name))
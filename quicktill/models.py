@@ -1,6 +1,7 @@
 from sqlalchemy.ext.declarative import declarative_base,declared_attr
 from sqlalchemy import Column,Integer,String,DateTime,Date,ForeignKey,Numeric,CHAR,Boolean,Text,Interval
 from sqlalchemy.schema import Sequence,Index,MetaData,DDL,CheckConstraint,Table
+from sqlalchemy.schema import FetchedValue
 from sqlalchemy.sql.expression import text, alias, case
 from sqlalchemy.orm import relationship,backref,object_session,sessionmaker
 from sqlalchemy.orm import subqueryload_all,joinedload,subqueryload,lazyload
@@ -159,6 +160,19 @@ class Session(Base):
     starttime = Column(DateTime, nullable=False)
     endtime = Column(DateTime)
     date = Column('sessiondate', Date, nullable=False)
+    # No transaction lines or payments in this session have IDs lower
+    # than these.  Including them in queries on a session lets
+    # PostgreSQL skip the older partitions of translines and payments.
+    # They are set when the session is created; see
+    # set_session_partition_bounds() below.
+    translines_from = Column(Integer, nullable=False,
+                             server_default=FetchedValue())
+    payments_from = Column(Integer, nullable=False,
+                           server_default=FetchedValue())
+    archived = Column(Boolean, nullable=False, server_default=text('false'),
+                      doc="Some of this session's transaction lines or "
+                      "payments have been moved to the archive schema, so "
+                      "its totals are incomplete")
 
     def __init__(self, date):
         self.date=date
@@ -184,6 +198,7 @@ class Session(Base):
             select_from(Session).\
             filter(Session.id == self.id).\
             join(Transaction, Transline, Department).\
+            filter(Transline.id >= self.translines_from).\
             order_by(Department.id).\
             group_by(Department).all()
     @property
@@ -199,6 +214,7 @@ class Session(Base):
                   select_from(Transline.__table__).\
                   join(Transaction).\
                   filter(Transaction.sessionid == self.id).\
+                  filter(Transline.id >= self.translines_from).\
                   filter(Transline.dept_id == Department.id)
         tot_closed = tot_all.filter(Transaction.closed)
         totals = object_session(self).\
@@ -216,6 +232,7 @@ class Session(Base):
                 Transline.items*Transline.amount)).\
             filter(Transaction.sessionid == self.id).\
             join(Transline, Transaction).\
+            filter(Transline.id >= self.translines_from).\
             order_by(desc(func.sum(
                 Transline.items * Transline.amount))).\
             group_by(User).all()
@@ -227,6 +244,7 @@ class Session(Base):
             select_from(Session).\
             filter(Session.id == self.id).\
             join(Transaction, Payment, PayType).\
+            filter(Payment.id >= self.payments_from).\
             group_by(PayType).all()
     # total and closed_total are declared after Transline
     # actual_total is declared after SessionTotal
@@ -249,11 +267,49 @@ class Session(Base):
             select_from(Session).\
             filter(Session.id == self.id).\
             join(Transaction, Transline, Department, VatBand).\
+            filter(Transline.id >= self.translines_from).\
             order_by(VatBand.band).\
             group_by(VatBand).\
             all()
         vt=[(a.at(self.date), b) for a, b in vt]
         return [(a, b, a.inc_to_exc(b), a.inc_to_vat(b)) for a, b in vt]
+    @classmethod
+    def vatband_totals_for_sessions(cls, session, sessions):
+        """Transaction lines broken down by Session and VatBand.
+
+        Equivalent to calling vatband_totals on each of a list of
+        Session objects, but uses a constant number of queries
+        however many sessions there are.  Returns a dict of session
+        ID to list of (VatRate, amount, ex-vat amount, vat).
+        """
+        dates = {x.id: x.date for x in sessions}
+        if not dates:
+            return {}
+        vt = session.\
+            query(Transaction.sessionid, Department.vatband,
+                  func.sum(Transline.items * Transline.amount)).\
+            select_from(Transaction).\
+            join(Transline, Department).\
+            filter(Transaction.sessionid.in_(list(dates.keys()))).\
+            filter(Transline.id >= min(x.translines_from for x in sessions)).\
+            group_by(Transaction.sessionid, Department.vatband).\
+            order_by(Transaction.sessionid, Department.vatband).\
+            all()
+        # The VAT tables are small, so we resolve Vat.at() here
+        # instead of making a query per session
+        bands = {b.band: b for b in session.query(VatBand).all()}
+        rates = session.query(VatRate).order_by(desc(VatRate.active)).all()
+        def at(band, date):
+            for r in rates:
+                if r.band == band and r.active <= date:
+                    return r
+            return bands[band]
+        result = {x: [] for x in dates.keys()}
+        for sessionid, band, amount in vt:
+            a = at(band, dates[sessionid])
+            result[sessionid].append(
+                (a, amount, a.inc_to_exc(amount), a.inc_to_vat(amount)))
+        return result
     # It may become necessary to add a further query here that returns
     # transaction lines broken down by Business.  Must take into
     # account multiple VAT rates per business - probably best to do
@@ -269,6 +325,7 @@ class Session(Base):
             join(Transline).\
             join(Transaction).\
             filter(Transaction.sessionid == self.id).\
+            filter(Transline.id >= self.translines_from).\
             options(lazyload(StockType.department)).\
             options(contains_eager(StockType.unit)).\
             group_by(StockType, UnitType).\
@@ -314,7 +371,7 @@ class Session(Base):
             .first()
         return self._prevsession
 
-add_ddl(Session.__table__, """
+max_one_session_open_ddl = """
 CREATE OR REPLACE FUNCTION check_max_one_session_open() RETURNS trigger AS $$
 BEGIN
   IF (SELECT count(*) FROM sessions WHERE endtime IS NULL)>1 THEN
@@ -323,14 +380,44 @@ BEGIN
   RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
-CREATE CONSTRAINT TRIGGER max_one_session_open
+CREATE TRIGGER max_one_session_open
   AFTER INSERT OR UPDATE ON sessions
-  FOR EACH ROW EXECUTE PROCEDURE check_max_one_session_open();
-""", """
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_max_one_session_open();
+"""
+add_ddl(Session.__table__, max_one_session_open_ddl, """
 DROP TRIGGER max_one_session_open ON sessions;
 DROP FUNCTION check_max_one_session_open();
 """)
 
+# Everything in a new session is either added after it starts, or is
+# in a deferred transaction that will be moved into it
+session_partition_bounds_ddl = """
+CREATE OR REPLACE FUNCTION set_session_partition_bounds() RETURNS trigger AS $$
+BEGIN
+  NEW.translines_from := least(
+    (SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END
+       FROM translines_seq),
+    (SELECT min(tl.translineid) FROM translines tl
+       JOIN transactions t ON t.transid=tl.transid
+       WHERE t.sessionid IS NULL));
+  NEW.payments_from := least(
+    (SELECT CASE WHEN is_called THEN last_value + 1 ELSE last_value END
+       FROM payments_seq),
+    (SELECT min(p.paymentid) FROM payments p
+       JOIN transactions t ON t.transid=p.transid
+       WHERE t.sessionid IS NULL));
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER set_partition_bounds
+  BEFORE INSERT ON sessions
+  FOR EACH ROW EXECUTE PROCEDURE set_session_partition_bounds();
+"""
+add_ddl(Session.__table__, session_partition_bounds_ddl, """
+DROP TRIGGER set_partition_bounds ON sessions;
+DROP FUNCTION set_session_partition_bounds();
+""")
+
 class SessionTotal(Base):
     __tablename__ = 'sessiontotals'
     sessionid = Column(Integer, ForeignKey('sessions.sessionid'),
@@ -395,23 +482,43 @@ class Transaction(Base):
     def __repr__(self):
         return "<Transaction(%s,%s,%s)>" % (self.id, self.sessionid, self.closed)
 
-add_ddl(Transaction.__table__, """
+# The integrity checks on transactions, translines and payments are
+# statement-level triggers that look at all the rows changed by a
+# statement at once using transition tables, so a statement that
+# changes many rows (for example moving all the lines of a transaction
+# to another one) is checked with a single query.  Transition tables
+# can only be used by triggers for a single event, hence the separate
+# insert and update triggers.
+transaction_balances_ddl = """
 CREATE OR REPLACE FUNCTION check_transaction_balances() RETURNS trigger AS $$
+DECLARE
+  v_transid integer;
 BEGIN
-  IF NEW.closed=true
-    AND (SELECT sum(amount*items) FROM translines
-      WHERE transid=NEW.transid)!=
-      (SELECT sum(amount) FROM payments WHERE transid=NEW.transid)
-  THEN RAISE EXCEPTION 'transaction %% does not balance', NEW.transid;
+  SELECT t.transid INTO v_transid
+    FROM new_transactions t
+    WHERE t.closed
+      AND (SELECT sum(amount*items) FROM translines
+        WHERE transid=t.transid)!=
+        (SELECT sum(amount) FROM payments WHERE transid=t.transid)
+    LIMIT 1;
+  IF FOUND
+  THEN RAISE EXCEPTION 'transaction %% does not balance', v_transid;
   END IF;
   RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
-CREATE CONSTRAINT TRIGGER close_only_if_balanced
-  AFTER INSERT OR UPDATE ON transactions
-  FOR EACH ROW EXECUTE PROCEDURE check_transaction_balances();
-""", """
-DROP TRIGGER close_only_if_balanced ON transactions;
+CREATE TRIGGER close_only_if_balanced_insert
+  AFTER INSERT ON transactions
+  REFERENCING NEW TABLE AS new_transactions
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_transaction_balances();
+CREATE TRIGGER close_only_if_balanced_update
+  AFTER UPDATE ON transactions
+  REFERENCING NEW TABLE AS new_transactions
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_transaction_balances();
+"""
+add_ddl(Transaction.__table__, transaction_balances_ddl, """
+DROP TRIGGER close_only_if_balanced_insert ON transactions;
+DROP TRIGGER close_only_if_balanced_update ON transactions;
 DROP FUNCTION check_transaction_balances();
 """)
 
@@ -526,6 +633,7 @@ payments_seq = Sequence('payments_seq', start=1)
 
 class Payment(Base):
     __tablename__ = 'payments'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (paymentid)'}
     id = Column('paymentid', Integer, payments_seq, nullable=False,
                 primary_key=True)
     transid = Column(
@@ -550,20 +658,34 @@ class Payment(Base):
         return "<Payment(%s,%s,%s,'%s')>" % (
             self.id, self.transid, self.amount, self.paytype_id)
 
-add_ddl(Payment.__table__, """
+payment_modify_closed_ddl = """
 CREATE OR REPLACE FUNCTION check_modify_closed_trans_payment() RETURNS trigger AS $$
+DECLARE
+  v_transid integer;
 BEGIN
-  IF (SELECT closed FROM transactions WHERE transid=NEW.transid)=true
-  THEN RAISE EXCEPTION 'attempt to modify closed transaction %% payment', NEW.transid;
+  SELECT p.transid INTO v_transid
+    FROM new_payments p
+    JOIN transactions t ON t.transid=p.transid
+    WHERE t.closed
+    LIMIT 1;
+  IF FOUND
+  THEN RAISE EXCEPTION 'attempt to modify closed transaction %% payment', v_transid;
   END IF;
   RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
-CREATE CONSTRAINT TRIGGER no_modify_closed
-  AFTER INSERT OR UPDATE ON payments
-  FOR EACH ROW EXECUTE PROCEDURE check_modify_closed_trans_payment();
-""", """
-DROP TRIGGER no_modify_closed ON payments;
+CREATE TRIGGER no_modify_closed_insert
+  AFTER INSERT ON payments
+  REFERENCING NEW TABLE AS new_payments
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_modify_closed_trans_payment();
+CREATE TRIGGER no_modify_closed_update
+  AFTER UPDATE ON payments
+  REFERENCING NEW TABLE AS new_payments
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_modify_closed_trans_payment();
+"""
+add_ddl(Payment.__table__, payment_modify_closed_ddl, """
+DROP TRIGGER no_modify_closed_insert ON payments;
+DROP TRIGGER no_modify_closed_update ON payments;
 DROP FUNCTION check_modify_closed_trans_payment();
 """)
 
@@ -602,6 +724,7 @@ translines_seq = Sequence('translines_seq', start=1)
 
 class Transline(Base):
     __tablename__ = 'translines'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (translineid)'}
     id = Column('translineid', Integer, translines_seq, nullable=False,
                 primary_key=True)
     transid = Column(
@@ -614,10 +737,12 @@ class Transline(Base):
                      nullable=False)
     user_id = Column('user', Integer, ForeignKey('users.id'), nullable=True,
                      doc="User who created this transaction line")
+    # voided_by is unique; this is checked by a trigger, see
+    # check_transline_voided_by_unique() below
     voided_by_id = Column(
         'voided_by', Integer,
         ForeignKey('translines.translineid', ondelete="SET NULL"),
-        nullable=True, unique=True,
+        nullable=True,
         doc="Transaction line that voids this one")
     transcode = Column(CHAR(1), ForeignKey('transcodes.transcode'),
                        nullable=False)
@@ -647,7 +772,7 @@ class Transline(Base):
     @property
     def description(self):
         # We aim to transition to self.text being nullable=False with
-        # the release of 0.13.0; see the add-transline-text command in
+        # the release of 0.13.0; see the add-transline-text migration in
         # dbutils.py.  This property will then just return self.text
         if self.text is not None:
             return self.text
@@ -700,41 +825,85 @@ class Transline(Base):
         """
         if self.voided_by:
             return
+        v = self._reversal(transaction, user)
+        self.voided_by = v
+        return v
+
+    def _reversal(self, transaction, user):
         v = Transline(transaction=transaction, items=-self.items,
                       amount=self.amount, department=self.department,
                       user=user, transcode='V', text=self.text)
-        self.voided_by = v
         for stockout in self.stockref:
             v.stockref.append(StockOut(
                 stockitem=stockout.stockitem, qty=-stockout.qty,
                 removecode=stockout.removecode))
         return v
 
+    @staticmethod
+    def void_lines(session, lines, transaction, user):
+        """Void several transaction lines
+
+        As void(), but the voided_by column of all the lines is
+        filled in by a single UPDATE statement, so the triggers on
+        translines run once rather than once per line.  Lines that
+        have already been voided are skipped.  Returns the list of
+        new transaction lines, which have been flushed.
+        """
+        lines = [l for l in lines if not l.voided_by]
+        voids = [l._reversal(transaction, user) for l in lines]
+        if not voids:
+            return voids
+        session.add_all(voids)
+        session.flush()
+        translines = Transline.__table__
+        session.execute(
+            translines.update().\
+            where(translines.c.translineid.in_([l.id for l in lines])).\
+            values(voided_by=case(
+                {l.id: v.id for l, v in zip(lines, voids)},
+                value=translines.c.translineid)))
+        for l in lines:
+            session.expire(l, ['voided_by_id', 'voided_by'])
+        for v in voids:
+            session.expire(v, ['voids'])
+        return voids
+
 # This trigger permits null columns (text or user) to be set to
 # not-null in closed transactions but subsequently prevents
-# modification
-add_ddl(Transline.__table__, """
+# modification.  Lines whose translineid has changed can't be matched
+# up with their old versions, so are treated as modified.
+transline_modify_closed_ddl = """
 CREATE FUNCTION check_modify_closed_trans_line() RETURNS trigger AS $$
+DECLARE
+  v_transid integer;
 BEGIN
-  IF (SELECT closed FROM transactions WHERE transid=NEW.transid)=true
-    AND (OLD.translineid != NEW.translineid
-      OR OLD.transid != NEW.transid
-      OR OLD.items != NEW.items
-      OR OLD.amount != NEW.amount
-      OR OLD.dept != NEW.dept
-      OR OLD.user != NEW.user
-      OR OLD.transcode != NEW.transcode
-      OR OLD.time != NEW.time
-      OR OLD.text != NEW.text)
-    THEN RAISE EXCEPTION 'attempt to modify closed transaction %% line', NEW.transid;
+  SELECT n.transid INTO v_transid
+    FROM new_lines n
+    JOIN transactions t ON t.transid=n.transid
+    LEFT JOIN old_lines o ON o.translineid=n.translineid
+    WHERE t.closed
+      AND (o.translineid IS NULL
+        OR o.transid != n.transid
+        OR o.items != n.items
+        OR o.amount != n.amount
+        OR o.dept != n.dept
+        OR o."user" != n."user"
+        OR o.transcode != n.transcode
+        OR o.time != n.time
+        OR o.text != n.text)
+    LIMIT 1;
+  IF FOUND
+    THEN RAISE EXCEPTION 'attempt to modify closed transaction %% line', v_transid;
   END IF;
   RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
-CREATE CONSTRAINT TRIGGER no_modify_closed
-  AFTER INSERT OR UPDATE ON translines
-  FOR EACH ROW EXECUTE PROCEDURE check_modify_closed_trans_line();
-""", """
+CREATE TRIGGER no_modify_closed
+  AFTER UPDATE ON translines
+  REFERENCING OLD TABLE AS old_lines NEW TABLE AS new_lines
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_modify_closed_trans_line();
+"""
+add_ddl(Transline.__table__, transline_modify_closed_ddl, """
 DROP TRIGGER no_modify_closed ON translines;
 DROP FUNCTION check_modify_closed_trans_line();
 """)
@@ -745,7 +914,8 @@ Session.total = column_property(
     select([func.coalesce(func.sum(Transline.items * Transline.amount),
                           zero)],
            whereclause=and_(Transline.transid == Transaction.id,
-                            Transaction.sessionid == Session.id)).\
+                            Transaction.sessionid == Session.id,
+                            Transline.id >= Session.translines_from)).\
         correlate(Session.__table__).\
         label('total'),
     deferred=True,
@@ -755,7 +925,8 @@ Session.closed_total = column_property(
                           zero)],
            whereclause=and_(Transline.transid == Transaction.id,
                             Transaction.closed,
-                            Transaction.sessionid == Session.id)).\
+                            Transaction.sessionid == Session.id,
+                            Transline.id >= Session.translines_from)).\
         correlate(Session.__table__).\
         label('closed_total'),
     deferred=True,
@@ -1007,17 +1178,151 @@ class StockLine(Base):
                 sm.append((i, move, newdisplayqty, instock_after_move))
         return sm
 
-    def continuous_stockonsale(self):
-        return object_session(self)\
+    @classmethod
+    def calculate_restock_for_lines(cls, session, stocklines, target=None):
+        """Prepare lists of stock movements for many stocklines
+
+        Equivalent to calling calculate_restock(target) on each of
+        the display stocklines in the list, but works out all the
+        movements in a single query.  Returns a dict of stockline ID
+        to list of (stockitem, fetchqty, newdisplayqty, qtyremain)
+        tuples; stocklines with nothing to move are omitted.
+        """
+        ids = [x.id for x in stocklines if x.linetype == "display"]
+        if not ids:
+            return {}
+        dq = func.coalesce(StockItem.displayqty, 0)
+        ondisplay = dq - StockItem.used
+        instock = StockUnit.size - dq
+        capacity = StockLine.capacity if target is None else target
+        items = session.query(
+            StockItem.id.label('stockid'),
+            StockItem.stocklineid.label('stocklineid'),
+            ondisplay.label('ondisplay'),
+            instock.label('instock'),
+            (capacity - func.sum(ondisplay).over(
+                partition_by=StockItem.stocklineid)).label('needed'),
+            # Same order as the stockonsale backref
+            func.row_number().over(
+                partition_by=StockItem.stocklineid,
+                order_by=(desc(dq), StockItem.id)).label('seq'),
+            # Stock available to fetch from items earlier in the list
+            (func.sum(instock).over(
+                partition_by=StockItem.stocklineid,
+                order_by=(desc(dq), StockItem.id))
+             - instock).label('instock_before'),
+            # Stock on display from items later in the list
+            (func.sum(ondisplay).over(
+                partition_by=StockItem.stocklineid,
+                order_by=(dq, desc(StockItem.id)))
+             - ondisplay).label('ondisplay_after'))\
+            .select_from(StockItem)\
+            .join(StockUnit, StockUnit.id == StockItem.stockunit_id)\
+            .join(StockLine, StockLine.id == StockItem.stocklineid)\
+            .filter(StockItem.stocklineid.in_(ids))\
+            .subquery()
+        move = case(
+            [(items.c.needed > 0,
+              func.greatest(0, func.least(
+                  items.c.instock,
+                  items.c.needed - items.c.instock_before))),
+             (items.c.needed < 0,
+              -func.greatest(0, func.least(
+                  items.c.ondisplay,
+                  -items.c.needed - items.c.ondisplay_after)))],
+            else_=0)
+        plan = session.query(StockItem, move)\
+                      .join(items, items.c.stockid == StockItem.id)\
+                      .filter(move != 0)\
+                      .order_by(items.c.stocklineid,
+                                case([(items.c.needed < 0, -items.c.seq)],
+                                     else_=items.c.seq))\
+                      .all()
+        result = {}
+        for item, move in plan:
+            newdisplayqty = item.displayqty_or_zero + move
+            result.setdefault(item.stocklineid, []).append(
+                (item, move, newdisplayqty,
+                 int(item.stockunit.size) - newdisplayqty))
+        return result
+
+    @classmethod
+    def auto_allocate_plan(cls, session, deliveryid=None):
+        """Work out which stock can go on display stocklines
+
+        Finds unallocated stock in checked deliveries (optionally
+        only in one delivery) whose stocktype is sold through a
+        display stockline, joined to those stocklines in a single
+        query.  Returns a list of (stockitem, list of stocklines)
+        tuples, soonest best-before date first and then in order of
+        stock number.  Where the list has exactly one stockline, the
+        item can be allocated automatically.
+        """
+        q = session.query(StockItem, StockLine)\
+                   .join(Delivery)\
+                   .join(StockLine, and_(
+                       StockLine.stocktype_id == StockItem.stocktype_id,
+                       StockLine.linetype == "display"))\
+                   .filter(StockItem.finished == None)\
+                   .filter(Delivery.checked == True)\
+                   .filter(StockItem.stocklineid == None)\
+                   .options(undefer('used'))\
+                   .options(joinedload('stocktype'))\
+                   .order_by(StockItem.bestbefore.nullslast(),
+                             StockItem.id, StockLine.id)
+        if deliveryid:
+            q = q.filter(Delivery.id == deliveryid)
+        plan = []
+        for item, line in q.all():
+            if plan and plan[-1][0] is item:
+                plan[-1][1].append(line)
+            else:
+                plan.append((item, [line]))
+        return plan
+
+    def _continuous_stockonsale_query(self, session):
+        # The stockline_sale() database function chooses stock in the
+        # same way; keep them in step
+        return session\
             .query(StockItem)\
             .join(Delivery)\
             .filter(Delivery.checked == True)\
             .filter(StockItem.stocktype == self.stocktype)\
             .filter(StockItem.finished == None)\
             .filter(StockItem.stockline == None)\
-            .options(undefer('remaining'))\
-            .order_by(StockItem.id)\
-            .all()
+            .order_by(StockItem.id)
+
+    def continuous_stockonsale(self):
+        """Stock items available for sale on a continuous stockline"""
+        return self._continuous_stockonsale_query(object_session(self))\
+                   .options(undefer('remaining'))\
+                   .all()
+
+    def _lock_continuous_stock(self, item):
+        """Lock a stock item that is about to be sold from this stockline
+
+        The lock is held until the end of the transaction, so that
+        concurrent sales from the same stock (for example two
+        registers selling the same wine) can't both take the last of
+        an item.  If another sale holds the lock we wait for it.
+        Returns the item with its remaining stock read again once the
+        lock is held, or None if it is no longer available.
+        """
+        session = object_session(self)
+        locked = self._continuous_stockonsale_query(session)\
+                     .filter(StockItem.id == item.id)\
+                     .with_entities(StockItem.id)\
+                     .with_for_update(of=StockItem)\
+                     .first()
+        if not locked:
+            return None
+        # "remaining" must be read in a new statement to include any
+        # sale that we had to wait for
+        return session.query(StockItem)\
+                      .filter(StockItem.id == item.id)\
+                      .options(undefer('remaining'))\
+                      .populate_existing()\
+                      .one()
 
     def calculate_sale(self, qty):
         """Work out a plan to remove a quantity of stock from the stock line.
@@ -1064,18 +1369,31 @@ class StockLine(Base):
                 # There's no unfinished stock of the appropriate type
                 # at all - we can't do anything.
                 return ([], qty, Decimal("0.0"))
+            # Only the items we take from are locked, in order of
+            # stock number so that sales can't deadlock
             unallocated = qty
             sell = []
             remaining = Decimal("0.0")
             for item in stock:
-                sellqty = min(unallocated, max(item.remaining, Decimal("0.0")))
-                unallocated = unallocated - sellqty
+                sellqty = Decimal("0.0")
+                if unallocated > Decimal("0.0") \
+                   and item.remaining > Decimal("0.0"):
+                    item = self._lock_continuous_stock(item)
+                    if not item:
+                        continue
+                    sellqty = min(unallocated,
+                                  max(item.remaining, Decimal("0.0")))
+                    unallocated = unallocated - sellqty
                 remaining += item.remaining - sellqty
                 if sellqty > Decimal("0.0"):
                     sell.append((item, sellqty))
             # If there wasn't enough, sell some more of the last item
-            # anyway putting it into negative "remaining"
+            # anyway putting it into negative "remaining".  Every item
+            # with stock has been locked and emptied by now.
             if unallocated > Decimal("0.0"):
+                item = self._lock_continuous_stock(stock[-1])
+                if not item:
+                    return (sell, unallocated, remaining)
                 sell.append((item, unallocated))
                 remaining -= unallocated
                 unallocated = Decimal("0.0")
@@ -1483,6 +1801,7 @@ stockout_seq = Sequence('stockout_seq')
 
 class StockOut(Base):
     __tablename__ = 'stockout'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (stockoutid)'}
     id = Column('stockoutid', Integer, stockout_seq,
                 nullable=False, primary_key=True)
     stockid = Column(Integer, ForeignKey('stock.stockid'), nullable=False)
@@ -1501,6 +1820,203 @@ class StockOut(Base):
     def __repr__(self):
         return "<StockOut(%s,%s)>" % (self.id, self.stockid)
 
+# Sell from a stockline in a single round trip to the database.  This
+# does the same stock allocation as StockLine.calculate_sale(), the
+# pull-through check from td.stock_checkpullthru(), and adds the
+# transaction line and stockout rows to transaction transid, which
+# must already exist.  The pull-through check is only made if
+# pullthru_age is not NULL: the caller skips it when it already knows
+# the item was sold recently.  If repeat_translineid is not NULL and
+# the sale is of one more of the same item from the same stock item,
+# that transaction line is extended instead of a new one being added.
+#
+# Returns one row per stockout row, or a single row with a NULL
+# sale_stockid if nothing could be sold (in which case nothing is
+# changed).
+stockline_sale_ddl = """
+CREATE OR REPLACE FUNCTION stockline_sale(
+  p_transid integer, p_stocklineid integer, p_qty numeric, p_items integer,
+  p_amount numeric, p_dept integer, p_text text, p_user integer,
+  p_repeat_translineid integer, p_pullthru_age interval)
+RETURNS TABLE(sale_translineid integer,
+  sale_stockid integer, sale_qty numeric, sale_unallocated numeric,
+  sale_remaining numeric, sale_instock numeric, sale_pullthru boolean,
+  sale_repeated boolean) AS $$
+DECLARE
+  v_line RECORD;
+  v_item RECORD;
+  v_translineid integer;
+  v_unallocated numeric := p_qty * p_items;
+  v_sellqty numeric;
+  v_itemremaining numeric;
+  v_stockids integer[] := '{}';
+  v_qtys numeric[] := '{}';
+  v_remaining numeric := 0.0;
+  v_ondisplay numeric := 0.0;
+  v_instock numeric;
+  v_pullthru boolean := false;
+  v_repeated boolean := false;
+  v_last integer;
+  v_stockout RECORD;
+BEGIN
+  SELECT * INTO v_line FROM stocklines WHERE stocklineid = p_stocklineid;
+  IF v_line.linetype = 'regular' THEN
+    SELECT s.stockid, su.size - coalesce(
+        (SELECT sum(so.qty) FROM stockout so WHERE so.stockid = s.stockid),
+        0.0) AS remaining
+      INTO v_item
+      FROM stock s JOIN stockunits su ON su.stockunit = s.stockunit
+      WHERE s.stocklineid = p_stocklineid
+      ORDER BY coalesce(s.displayqty, 0) DESC, s.stockid
+      LIMIT 1;
+    IF FOUND THEN
+      v_stockids := ARRAY[v_item.stockid];
+      v_qtys := ARRAY[v_unallocated];
+      v_remaining := v_item.remaining - v_unallocated;
+      v_unallocated := 0.0;
+      IF v_line.pullthru IS NOT NULL AND p_pullthru_age IS NOT NULL THEN
+        SELECT coalesce(now() - max(so.time) > p_pullthru_age, false)
+          INTO v_pullthru
+          FROM stockout so
+          WHERE so.stockid = v_item.stockid
+            AND so.removecode IN ('sold', 'pullthru');
+      END IF;
+    END IF;
+  ELSIF v_line.linetype = 'display' THEN
+    FOR v_item IN
+      SELECT s.stockid, coalesce(s.displayqty, 0) - u.used AS ondisplay,
+             su.size - u.used AS remaining
+        FROM stock s
+        JOIN stockunits su ON su.stockunit = s.stockunit,
+        LATERAL (SELECT coalesce(sum(so.qty), 0.0) AS used
+                 FROM stockout so WHERE so.stockid = s.stockid) u
+        WHERE s.stocklineid = p_stocklineid
+        ORDER BY coalesce(s.displayqty, 0) DESC, s.stockid
+    LOOP
+      v_sellqty := least(v_unallocated, greatest(v_item.ondisplay, 0.0));
+      v_unallocated := v_unallocated - v_sellqty;
+      v_ondisplay := v_ondisplay + v_item.ondisplay - v_sellqty;
+      v_remaining := v_remaining + v_item.remaining - v_sellqty;
+      IF v_sellqty > 0.0 THEN
+        v_stockids := v_stockids || v_item.stockid;
+        v_qtys := v_qtys || v_sellqty;
+      END IF;
+    END LOOP;
+    v_instock := v_remaining - v_ondisplay;
+    v_remaining := v_ondisplay;
+  ELSIF v_line.linetype = 'continuous' THEN
+    -- Allocate stock as StockLine.calculate_sale() does.  The
+    -- candidates are those of StockLine.continuous_stockonsale(), and
+    -- only the items the sale takes from are locked, in order of
+    -- stock number, waiting for any other sale that holds them.
+    FOR v_item IN
+      SELECT s.stockid, su.size - coalesce(
+          (SELECT sum(so.qty) FROM stockout so WHERE so.stockid = s.stockid),
+          0.0) AS remaining
+        FROM stock s
+        JOIN deliveries d ON d.deliveryid = s.deliveryid
+        JOIN stockunits su ON su.stockunit = s.stockunit
+        WHERE d.checked AND s.stocktype = v_line.stocktype
+          AND s.finished IS NULL AND s.stocklineid IS NULL
+        ORDER BY s.stockid
+    LOOP
+      v_last := v_item.stockid;
+      v_sellqty := 0.0;
+      v_itemremaining := v_item.remaining;
+      IF v_unallocated > 0.0 AND v_itemremaining > 0.0 THEN
+        PERFORM 1 FROM stock s
+          JOIN deliveries d ON d.deliveryid = s.deliveryid
+          WHERE s.stockid = v_item.stockid
+            AND d.checked AND s.stocktype = v_line.stocktype
+            AND s.finished IS NULL AND s.stocklineid IS NULL
+          FOR UPDATE OF s;
+        CONTINUE WHEN NOT FOUND;
+        -- Read again to include any sale we had to wait for
+        SELECT su.size - coalesce(
+            (SELECT sum(so.qty) FROM stockout so
+             WHERE so.stockid = s.stockid), 0.0)
+          INTO v_itemremaining
+          FROM stock s JOIN stockunits su ON su.stockunit = s.stockunit
+          WHERE s.stockid = v_item.stockid;
+        v_sellqty := least(v_unallocated, greatest(v_itemremaining, 0.0));
+        v_unallocated := v_unallocated - v_sellqty;
+      END IF;
+      v_remaining := v_remaining + v_itemremaining - v_sellqty;
+      IF v_sellqty > 0.0 THEN
+        v_stockids := v_stockids || v_item.stockid;
+        v_qtys := v_qtys || v_sellqty;
+      END IF;
+    END LOOP;
+    -- If there wasn't enough, sell some more of the last item anyway
+    -- putting it into negative "remaining".  Every item with stock
+    -- has been locked and emptied by now.
+    IF v_last IS NOT NULL AND v_unallocated > 0.0 THEN
+      PERFORM 1 FROM stock s
+        JOIN deliveries d ON d.deliveryid = s.deliveryid
+        WHERE s.stockid = v_last
+          AND d.checked AND s.stocktype = v_line.stocktype
+          AND s.finished IS NULL AND s.stocklineid IS NULL
+        FOR UPDATE OF s;
+      IF FOUND THEN
+        v_stockids := v_stockids || v_last;
+        v_qtys := v_qtys || v_unallocated;
+        v_remaining := v_remaining - v_unallocated;
+        v_unallocated := 0.0;
+      END IF;
+    END IF;
+  END IF;
+
+  IF v_unallocated > 0.0 OR array_length(v_stockids, 1) IS NULL THEN
+    RETURN QUERY SELECT NULL::integer, NULL::integer,
+      NULL::numeric, v_unallocated, v_remaining, v_instock, v_pullthru,
+      false;
+    RETURN;
+  END IF;
+
+  IF p_repeat_translineid IS NOT NULL
+     AND array_length(v_stockids, 1) = 1 THEN
+    SELECT so.stockoutid, so.qty / tl.items AS qty INTO v_stockout
+      FROM translines tl JOIN stockout so
+        ON so.translineid = tl.translineid
+      WHERE tl.translineid = p_repeat_translineid
+        AND tl.transid = p_transid
+        AND so.stockid = v_stockids[1]
+        AND (SELECT count(*) FROM stockout so2
+             WHERE so2.translineid = tl.translineid) = 1;
+    IF FOUND AND v_stockout.qty = v_qtys[1] THEN
+      UPDATE stockout SET qty = qty + v_stockout.qty
+        WHERE stockoutid = v_stockout.stockoutid;
+      UPDATE translines SET items = items + 1
+        WHERE translineid = p_repeat_translineid;
+      v_translineid := p_repeat_translineid;
+      v_repeated := true;
+    END IF;
+  END IF;
+
+  IF NOT v_repeated THEN
+    INSERT INTO translines (translineid, transid, items, amount, dept,
+                            "user", transcode, text)
+      VALUES (nextval('translines_seq'), p_transid, p_items, p_amount,
+              p_dept, p_user, 'S', p_text)
+      RETURNING translineid INTO v_translineid;
+    INSERT INTO stockout (stockoutid, stockid, qty, removecode, translineid)
+      SELECT nextval('stockout_seq'), x.stockid, x.qty, 'sold',
+             v_translineid
+      FROM unnest(v_stockids, v_qtys) WITH ORDINALITY AS x(stockid, qty, n)
+      ORDER BY x.n;
+  END IF;
+
+  RETURN QUERY SELECT v_translineid, x.stockid, x.qty, 0.0,
+    v_remaining, v_instock, v_pullthru, v_repeated
+    FROM unnest(v_stockids, v_qtys) AS x(stockid, qty);
+END;
+$$ LANGUAGE plpgsql;
+"""
+add_ddl(StockOut.__table__, stockline_sale_ddl, """
+DROP FUNCTION stockline_sale(integer, integer, numeric, integer, numeric,
+  integer, text, integer, integer, interval);
+""")
+
 # These are added to the StockItem class here because they refer
 # directly to the StockOut class, defined just above.
 StockItem.used = column_property(
@@ -1665,24 +2181,209 @@ class StockLineTypeLog(Base):
         return "<StockLineTypeLog(%s,%s)>" % (
             self.stocklineid, self.stocktype_id)
 
-add_ddl(StockLineTypeLog.__table__, """
-CREATE OR REPLACE RULE ignore_duplicate_stockline_types AS
-       ON INSERT TO stockline_stocktype_log
-       WHERE (NEW.stocklineid,NEW.stocktype)
-       IN (SELECT stocklineid,stocktype FROM stockline_stocktype_log)
-       DO INSTEAD NOTHING
-""", """
-DROP RULE ignore_duplicate_stockline_types ON stockline_stocktype_log
+# Record the stocktype of stock put on a stockline.  The trigger only
+# fires when the stockline or stocktype of an item actually changes,
+# not on every update of a stock item on a stockline (for example
+# changes of displayqty while restocking).
+log_stocktype_ddl = """
+CREATE OR REPLACE FUNCTION log_stocktype() RETURNS trigger AS $$
+BEGIN
+  INSERT INTO stockline_stocktype_log (stocklineid, stocktype)
+    VALUES (NEW.stocklineid, NEW.stocktype)
+    ON CONFLICT DO NOTHING;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER log_stocktype
+  AFTER UPDATE OF stocklineid, stocktype ON stock
+  FOR EACH ROW
+  WHEN (NEW.stocklineid IS NOT NULL
+        AND (OLD.stocklineid IS DISTINCT FROM NEW.stocklineid
+             OR OLD.stocktype IS DISTINCT FROM NEW.stocktype))
+  EXECUTE PROCEDURE log_stocktype();
+"""
+add_ddl(metadata, log_stocktype_ddl, """
+DROP TRIGGER log_stocktype ON stock;
+DROP FUNCTION log_stocktype();
 """)
 
-add_ddl(metadata, """
-CREATE OR REPLACE RULE log_stocktype AS ON UPDATE TO stock
-       WHERE NEW.stocklineid is not null
-       DO ALSO
-       INSERT INTO stockline_stocktype_log VALUES
-       (NEW.stocklineid,NEW.stocktype);
+class MigrationProgress(Base):
+    """Progress of a data migration through a range of IDs
+
+    See migrate.py.  A row is added for each range of IDs when a
+    migration is first run; position is the last ID processed.
+    """
+    __tablename__ = 'migration_progress'
+    migration = Column(String(), nullable=False, primary_key=True)
+    start = Column(Integer, nullable=False, primary_key=True,
+                   autoincrement=False)
+    end = Column(Integer, nullable=False,
+                 doc="End of this range of IDs; not included in the range")
+    position = Column(Integer, nullable=True,
+                      doc="Last ID processed; null if not started")
+    rows = Column(Integer, nullable=False, default=0,
+                  doc="Number of rows processed")
+    finished = Column(DateTime, nullable=True)
+    def __repr__(self):
+        return "<MigrationProgress('{}',{},{})>".format(
+            self.migration, self.start, self.end)
+
+accounts_outbox_seq = Sequence('accounts_outbox_seq')
+
+class AccountsOutbox(Base):
+    """A document waiting to be sent to the accounting system
+
+    The document is built when the entry is created, so that sending
+    it doesn't need anything from the rest of the database.  Entries
+    are sent in the background, and retried until they succeed or
+    are rejected by the accounting system; the idempotency key is
+    sent with every attempt so that a retry of a request that
+    actually succeeded does not create a duplicate.
+    """
+    __tablename__ = 'accounts_outbox'
+    id = Column(Integer, accounts_outbox_seq, nullable=False,
+                primary_key=True)
+    kind = Column(String(10), nullable=False,
+                  doc="Type of document: invoice, payments or bill")
+    sessionid = Column(Integer, ForeignKey('sessions.sessionid'),
+                       nullable=True)
+    deliveryid = Column(Integer, ForeignKey('deliveries.deliveryid'),
+                        nullable=True)
+    depends_on_id = Column(
+        'depends_on', Integer, ForeignKey('accounts_outbox.id'),
+        nullable=True, doc="Entry that must be sent before this one")
+    payload = Column(Text, nullable=False)
+    idempotency_key = Column(String(36), nullable=False, unique=True)
+    user_id = Column('user', Integer, ForeignKey('users.id'), nullable=True,
+                     doc="User who created this entry")
+    created = Column(DateTime, nullable=False,
+                     server_default=func.current_timestamp())
+    state = Column(String(10), nullable=False, default='pending',
+                   doc="pending, done or failed")
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=False,
+                          server_default=func.current_timestamp())
+    last_error = Column(Text, nullable=True)
+    result = Column(String(), nullable=True,
+                    doc="ID of the document in the accounting system")
+    batch_key = Column(String(36), nullable=True,
+                       doc="Idempotency key of the batch this entry was "
+                       "sent in, if the accounting system hasn't yet "
+                       "answered it")
+    session = relationship(Session)
+    delivery = relationship(Delivery)
+    depends_on = relationship("AccountsOutbox", remote_side=[id],
+                              backref="dependants")
+    user = relationship(User)
+    __table_args__ = (
+        CheckConstraint("state IN ('pending', 'done', 'failed')",
+                        name="state_name_valid"),
+    )
+    def __repr__(self):
+        return "<AccountsOutbox({},'{}','{}')>".format(
+            self.id, self.kind, self.state)
+
+Index('accounts_outbox_pending_key', AccountsOutbox.next_attempt,
+      postgresql_where=AccountsOutbox.state == 'pending')
+
+# translines, payments and stockout are partitioned by ranges of
+# their IDs, which are allocated in order so each partition holds the
+# records from a span of time.  Old partitions can be detached by the
+# "archive" command.  add_partitions() makes sure there is a partition
+# for the current range of IDs and the next one; it is called at the
+# start of every session.  Any rows outside the ranges of the
+# partitions end up in the default partition, where they are safe but
+# can't be archived.
+#
+# (table, partition key, sequence, rows per partition)
+partitioned_tables = [
+    ('translines', 'translineid', 'translines_seq', 1000000),
+    ('payments', 'paymentid', 'payments_seq', 500000),
+    ('stockout', 'stockoutid', 'stockout_seq', 1000000),
+]
+
+add_partitions_ddl = """
+CREATE OR REPLACE FUNCTION add_partitions(
+  p_table text, p_key text, p_seq text, p_size bigint)
+RETURNS void AS $$
+DECLARE
+  v_last bigint;
+  v_n bigint;
+  v_name text;
+  v_misplaced boolean;
+BEGIN
+  IF to_regclass(p_table || '_default') IS NULL THEN
+    EXECUTE format('CREATE TABLE %%I PARTITION OF %%I DEFAULT',
+                   p_table || '_default', p_table);
+  END IF;
+  EXECUTE format('SELECT last_value FROM %%I', p_seq) INTO v_last;
+  FOR v_n IN 0 .. v_last / p_size + 1 LOOP
+    v_name := p_table || '_' || v_n;
+    CONTINUE WHEN to_regclass(v_name) IS NOT NULL
+      OR to_regclass('archive.' || v_name) IS NOT NULL;
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %%I WHERE %%I >= %%s AND %%I < %%s)',
+                   p_table || '_default', p_key, v_n * p_size,
+                   p_key, (v_n + 1) * p_size)
+      INTO v_misplaced;
+    IF v_misplaced THEN
+      RAISE WARNING 'rows for partition %% are in %%_default', v_name, p_table;
+      CONTINUE;
+    END IF;
+    EXECUTE format('CREATE TABLE %%I PARTITION OF %%I FOR VALUES FROM (%%s) TO (%%s)',
+                   v_name, p_table, v_n * p_size, (v_n + 1) * p_size);
+  END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION add_partitions() RETURNS void AS $$
+BEGIN
+""" + "".join("""  PERFORM add_partitions('{}', '{}', '{}', {});
+""".format(table, key, seq, size)
+              for table, key, seq, size in partitioned_tables) + """
+END;
+$$ LANGUAGE plpgsql;
+"""
+add_ddl(metadata, add_partitions_ddl + """
+SELECT add_partitions();
 """, """
-DROP RULE log_stocktype ON stock
+DROP FUNCTION add_partitions();
+DROP FUNCTION add_partitions(text, text, text, bigint);
+""")
+
+# A unique constraint on translines would have to include the
+# partition key, so the uniqueness of voided_by is checked by these
+# triggers instead.  A line is only ever voided by a line created in
+# the same database transaction, so concurrent transactions can't
+# both get past the check with the same voided_by.
+transline_voided_by_unique_ddl = """
+CREATE OR REPLACE FUNCTION check_transline_voided_by_unique() RETURNS trigger AS $$
+DECLARE
+  v_voided_by integer;
+BEGIN
+  SELECT n.voided_by INTO v_voided_by
+    FROM new_lines n
+    JOIN translines tl ON tl.voided_by=n.voided_by
+      AND tl.translineid!=n.translineid
+    LIMIT 1;
+  IF FOUND
+    THEN RAISE EXCEPTION 'transaction line %% voids more than one line',
+      v_voided_by USING ERRCODE = 'unique_violation';
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE TRIGGER voided_by_unique_insert
+  AFTER INSERT ON translines
+  REFERENCING NEW TABLE AS new_lines
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_transline_voided_by_unique();
+CREATE TRIGGER voided_by_unique_update
+  AFTER UPDATE ON translines
+  REFERENCING NEW TABLE AS new_lines
+  FOR EACH STATEMENT EXECUTE PROCEDURE check_transline_voided_by_unique();
+"""
+add_ddl(Transline.__table__, transline_voided_by_unique_ddl, """
+DROP TRIGGER voided_by_unique_insert ON translines;
+DROP TRIGGER voided_by_unique_update ON translines;
+DROP FUNCTION check_transline_voided_by_unique();
 """)
 
 # Add indexes here
@@ -1693,9 +2394,22 @@ Index('stock_annotations_stockid_key', StockAnnotation.stockid)
 Index('stockout_stockid_key', StockOut.stockid)
 Index('stockout_translineid_key', StockOut.translineid)
 Index('translines_time_key', Transline.time)
+# Used by the check_transline_voided_by_unique() trigger
+translines_voided_by_key = Index('translines_voided_by_key',
+                                 Transline.voided_by_id)
+# Used by the check_max_one_session_open() trigger
+sessions_open_key = Index('sessions_open_key', Session.id,
+                          postgresql_where=Session.endtime == None)
 
 # The "find free drinks on this day" function is speeded up
 # considerably by an index on stockout.time::date.
 Index('stockout_date_key', func.cast(StockOut.time, Date))
 
+# The pull-through check looks for the most recent sale or pull-through
+# of a stock item; with this index that's a single lookup however many
+# times the item has been sold.
+stockout_pullthru_key = Index(
+    'stockout_pullthru_key', StockOut.stockid, StockOut.time,
+    postgresql_where=StockOut.removecode_id.in_(['sold', 'pullthru']))
+
 foodorder_seq = Sequence('foodorder_seq', metadata=metadata)
@@ -1,6 +1,7 @@
 from . import ui, tillconfig, td
 from .models import PayType, Payment, zero
 import datetime
+import concurrent.futures
 
 class DuplicatePayType(Exception):
     pass
@@ -127,3 +128,72 @@ class PaymentMethod(object):
         unsupported, returns None or raises an exception.
         """
         return
+
+class PaymentProvider:
+    """A remote service that payments are taken through
+
+    Requests to a payment provider over the network can take several
+    seconds, and the till must carry on redrawing and taking input
+    while they are made.  Subclasses implement requests as ordinary
+    blocking methods; the user interface makes them using call(),
+    which runs them on a worker thread and passes the result back
+    through the main loop.
+
+    Request methods run on worker threads, so they must not use the
+    database or the user interface.
+    """
+    # Shared by all providers
+    max_workers = 4
+    _executor = None
+
+    def call(self, method, *args, result=None, error=None, **kwargs):
+        """Make a request on a worker thread
+
+        When the request finishes, result is called from the main
+        loop with its return value, or if it raised an exception
+        error is called with the exception.  There is no database
+        session when they are called; they must start one if they
+        need it.
+
+        Returns a ProviderCall that can be used to cancel the
+        callbacks, for example when the window waiting for the result
+        is dismissed.
+        """
+        if not PaymentProvider._executor:
+            PaymentProvider._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="payment-provider")
+        c = ProviderCall(result, error)
+        self._executor.submit(method, *args, **kwargs)\
+                      .add_done_callback(c._done)
+        return c
+
+class ProviderCall:
+    """A request to a payment provider that may not have finished yet"""
+    def __init__(self, result, error):
+        self._result = result
+        self._error = error
+        self.finished = False
+        self.cancelled = False
+
+    def cancel(self):
+        """Don't call the callbacks when the request finishes"""
+        self.cancelled = True
+
+    def _done(self, future):
+        # Called on the worker thread
+        tillconfig.mainloop.call_from_thread(
+            lambda: self._deliver(future), desc="payment provider result")
+
+    def _deliver(self, future):
+        self.finished = True
+        if self.cancelled:
+            return
+        e = future.exception()
+        if e:
+            if self._error:
+                self._error(e)
+            else:
+                ui.infopopup([str(e)], title="Payment provider error")
+        elif self._result:
+            self._result(future.result())
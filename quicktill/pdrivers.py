@@ -7,20 +7,30 @@ import subprocess
 import fcntl
 import array
 import sys
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import toLength
-from reportlab.lib.pagesizes import A4
-import cups
 import glob
-try:
-    import qrcode
-    _qrcode_supported = True
-except ImportError:
-    _qrcode_supported = False
+import functools
+import threading
+import time
+import concurrent.futures
+from . import tillconfig
 
 import logging
 log = logging.getLogger(__name__)
 
+# reportlab, cups and qrcode are slow to import and most tills only
+# need some of them, so they are imported when they are first used.
+
+# The same as reportlab.lib.pagesizes.A4
+A4 = (595.2755905511812, 841.8897637795277)
+
+def _qrcode():
+    """Return the qrcode module, or None if it is not installed"""
+    try:
+        import qrcode
+    except ImportError:
+        return
+    return qrcode
+
 class PrinterError(Exception):
     def __init__(self,printer,desc):
         self.printer=printer
@@ -32,6 +42,27 @@ class PrinterError(Exception):
 # created; they must only attempt to claim them when __enter__ is
 # called.
 
+# Printers and protocols keep state while a document is being
+# printed, so one instance can't be printing two documents at once.
+# fresh() makes a new instance, that is not part way through anything,
+# from the arguments the original was created with.
+class _reconfigurable(object):
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        self._config = (args, kwargs)
+        return self
+
+    def fresh(self):
+        """A new instance configured like this one
+
+        Any printers or protocols among the arguments are fresh too.
+        """
+        def f(x):
+            return x.fresh() if isinstance(x, _reconfigurable) else x
+        args, kwargs = self._config
+        return type(self)(*[f(x) for x in args],
+                          **{k: f(v) for k, v in kwargs.items()})
+
 # We break most printer definitions up into two classes: a connection
 # and a protocol.  The connection object defines how we connect to the
 # printer (USB, parallel, network etc.) and is passed an instance of a
@@ -79,7 +110,7 @@ def wrap(l,width):
     if len(w)==0: w=[""]
     return w
 
-class nullprinter(object):
+class nullprinter(_reconfigurable):
     """
     A "dummy" printer that just writes to the log.
 
@@ -131,7 +162,7 @@ class badprinter(nullprinter):
     def __enter__(self):
         raise PrinterError(self,"badprinter is always offline!")
 
-class fileprinter(object):
+class fileprinter(_reconfigurable):
     """Print to a file.  The file may be a device file!
 
     """
@@ -205,7 +236,7 @@ class linux_lpprinter(fileprinter):
         except IOError as e:
             return str(e)
 
-class netprinter(object):
+class netprinter(_reconfigurable):
     """
     Print to a network socket.  connection is a (hostname,port) tuple.
 
@@ -250,7 +281,7 @@ class netprinter(object):
         self._socket.close()
         self._socket=None
 
-class tmpfileprinter(object):
+class tmpfileprinter(_reconfigurable):
     """
     Print to a temporary file.  Call the "finish" method with the
     filename before the file is deleted.  This method does nothing in
@@ -302,13 +333,170 @@ class commandprinter(tmpfileprinter):
             r=subprocess.call(self._printcmd%filename,
                               shell=True,stdout=null,stderr=null)
 
-class cupsprinter(object):
+# How long the state of a CUPS printer is cached for, in seconds
+cups_state_ttl = 30
+
+class _cupsconnection:
+    """A connection to a CUPS server that is made when it is needed
+
+    If the connection fails it is made again the next time it is
+    used.  pycups connections must not be used by two threads at
+    once; hold lock while using it.
+    """
+    def __init__(self, cups, connect_kwargs):
+        self._cups = cups
+        self._connect_kwargs = connect_kwargs
+        self._connection = None
+        self.lock = threading.RLock()
+
+    def call(self, method, *args, retry=True):
+        """Call a method of the connection, connecting if necessary
+
+        If the server can't be reached, the connection is made again
+        and the call retried once if retry is True.
+        """
+        cups = self._cups
+        with self.lock:
+            while True:
+                try:
+                    if not self._connection:
+                        self._connection = cups.Connection(
+                            **self._connect_kwargs)
+                    return getattr(self._connection, method)(*args)
+                except (RuntimeError, cups.HTTPError):
+                    # RuntimeError is raised when pycups can't connect
+                    self._connection = None
+                    if not retry:
+                        raise
+                    retry = False
+
+class _cupsclient:
+    """Long-lived connections to a CUPS server
+
+    There is one of these per server, shared by all the cupsprinters
+    that use it.
+
+    Jobs are sent to the server by a background thread, in the order
+    they were submitted.  Printer states are looked up on a separate
+    connection, so that they never wait for a job to be sent.  They
+    are cached for cups_state_ttl seconds; after that the cached
+    state is still returned, and refreshed by another background
+    thread.
+
+    Problems sending a job are reported from the main loop.  Commands
+    other than "start" don't have a main loop, so cupsprinter waits
+    for the job to be sent and problems are raised as before.
+    """
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, connect_kwargs):
+        key = tuple(sorted(connect_kwargs.items()))
+        with cls._clients_lock:
+            client = cls._clients.get(key)
+            if not client:
+                client = cls._clients[key] = cls(connect_kwargs)
+            return client
+
+    def __init__(self, connect_kwargs):
+        import cups
+        self._cups = cups
+        self._jobs = _cupsconnection(cups, connect_kwargs)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cups")
+        self._status = _cupsconnection(cups, connect_kwargs)
+        self._status_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="cups-status")
+        # printername: (time, state)
+        self._states = {}
+        self._refreshing = set()
+
+    def state(self, printername):
+        """Why the printer is offline, or None if it is available"""
+        cached = self._states.get(printername)
+        if cached is None:
+            return self._refresh(printername)
+        fetched, state = cached
+        if time.monotonic() - fetched > cups_state_ttl \
+           and printername not in self._refreshing:
+            self._refreshing.add(printername)
+            self._status_executor.submit(self._refresh, printername)
+        return state
+
+    def _refresh(self, printername):
+        cups = self._cups
+        try:
+            accepting = self._status.call(
+                "getPrinterAttributes", printername)\
+                            ['printer-is-accepting-jobs']
+            state = None if accepting else \
+                "'{}' is not accepting jobs at the moment".format(printername)
+        except (cups.IPPError, cups.HTTPError, RuntimeError) as e:
+            state = str(e)
+        self._states[printername] = (time.monotonic(), state)
+        self._refreshing.discard(printername)
+        return state
+
+    def submit(self, printername, options, mimetype, data):
+        """Queue a document to be printed
+
+        Returns a concurrent.futures.Future for the job.
+        """
+        future = self._executor.submit(
+            self._print, printername, options, mimetype, data)
+        future.add_done_callback(
+            lambda f: self._printed(printername, f))
+        return future
+
+    def _print(self, printername, options, mimetype, data):
+        jobs = self._jobs
+        # Nothing else may use the connection part way through a job
+        with jobs.lock:
+            job = jobs.call("createJob", printername, "quicktill output",
+                            options)
+            # Once the job has been created it isn't safe to retry
+            jobs.call("startDocument", printername, job, "quicktill",
+                      mimetype, 1, retry=False)
+            jobs.call("writeRequestData", data, len(data), retry=False)
+            jobs.call("finishDocument", printername, retry=False)
+            return job
+
+    def _printed(self, printername, future):
+        e = future.exception()
+        if not e:
+            return
+        self._states[printername] = (time.monotonic(), str(e))
+        # Commands other than "start" don't have a main loop; the
+        # exception is raised by cupsprinter instead
+        mainloop = getattr(tillconfig, 'mainloop', None)
+        if mainloop:
+            mainloop.call_from_thread(
+                lambda: self._report(printername, e))
+
+    @staticmethod
+    def _report(printername, e):
+        from . import ui
+        log.error("Failed to print to CUPS printer '%s': %s",
+                  printername, e)
+        ui.infopopup(["There was a problem printing to '{}': {}".format(
+            printername, e)], title="Printer problem")
+
+    def wait(self):
+        """Wait for the jobs and state refreshes submitted so far"""
+        self._executor.submit(lambda: None).result()
+        self._status_executor.submit(lambda: None).result()
+
+class cupsprinter(_reconfigurable):
     """Print to a CUPS printer.
 
     If host, port and/or encryption are specified they are passed to
     the cups.Connection() constructor.  encryption should be
     cups.HTTP_ENCRYPT_ALWAYS, cups.HTTP_ENCRYPT_IF_REQUESTED,
     cups.HTTP_ENCRYPT_NEVER or cups.HTTP_ENCRYPT_REQUIRED.
+
+    When the till is running, documents are sent to CUPS in the
+    background and problems are reported in a popup.
     """
     def __init__(self, printername, driver, options={}, description=None,
                  host=None, port=None, encryption=None):
@@ -326,6 +514,9 @@ class cupsprinter(object):
             self._connect_kwargs['encryption'] = encryption
         self._file = None
 
+    def _client(self):
+        return _cupsclient.get(self._connect_kwargs)
+
     def __str__(self):
         x = self._description or "Print to '{}'".format(self._printername)
         o = self.offline()
@@ -334,16 +525,7 @@ class cupsprinter(object):
         return x
 
     def offline(self):
-        try:
-            conn = cups.Connection(**self._connect_kwargs)
-            accepting = conn.getPrinterAttributes(
-                self._printername)['printer-is-accepting-jobs']
-            if accepting:
-                return
-            return "'{}' is not accepting jobs at the moment".format(
-                self._printername)
-        except cups.IPPError as e:
-            return str(e)
+        return self._client().state(self._printername)
 
     def __enter__(self):
         if self._file:
@@ -359,17 +541,13 @@ class cupsprinter(object):
             self._driver.end()
         except:
             pass
-        self._file.flush()
-        connection = cups.Connection(**self._connect_kwargs)
-        job = connection.createJob(self._printername, "quicktill output",
-                                   self._options)
-        doc = connection.startDocument(self._printername, job, "quicktill",
-                                       self._driver.mimetype, 1)
         b = self._file.getvalue()
-        connection.writeRequestData(b, len(b))
-        connection.finishDocument(self._printername)
         self._file.close()
         self._file = None
+        future = self._client().submit(
+            self._printername, self._options, self._driver.mimetype, b)
+        if not getattr(tillconfig, 'mainloop', None):
+            future.result()
 
 def ep_2d_cmd(*params):
     """Assemble an ESC/POS 2d barcode command.
@@ -382,7 +560,7 @@ def ep_2d_cmd(*params):
     pH = (len(p) >> 8) & 0xff
     return bytes([29, ord('('), ord('k'), pL, pH]) + p
 
-class escpos(object):
+class escpos(_reconfigurable):
     """The ESC/POS protocol for controlling receipt printers.
     """
     filesuffix = ".dat"
@@ -568,7 +746,8 @@ class escpos(object):
         self._printed = True
         if self.native_qrcode_support:
             return self.printqrcode_native(data)
-        if not _qrcode_supported:
+        qrcode = _qrcode()
+        if not qrcode:
             self.printline("qrcode library not installed")
             return
         q = qrcode.QRCode(border=2,
@@ -642,7 +821,7 @@ class Epson_TM_T20_driver(escpos):
                         lines_before_cut=0,default_font=0,
                         native_qrcode_support=True)
 
-class pdf_driver(object):
+class pdf_driver(_reconfigurable):
     """A driver that outputs to PDF and supports the same calls as the
     ESC/POS driver.
 
@@ -663,6 +842,7 @@ class pdf_driver(object):
         self.pitches=pitches
         self.leftmargin=40
     def start(self,fileobj,interface):
+        from reportlab.pdfgen import canvas
         self._f=fileobj
         self.c=canvas.Canvas(self._f,pagesize=self.pagesize)
         self.colour=0
@@ -740,21 +920,71 @@ class pdf_driver(object):
     def kickout(self):
         pass
 
-# XXX this depends on an implementation detail of reportlab.pdfgen
-class PageSizeCanvas(canvas.Canvas):
-    def getPageSize(self):
-        return self._pagesize
+@functools.lru_cache()
+def _canvas_classes():
+    """Return the PageSizeCanvas and LabelCanvas classes
+
+    They are defined on first use so that reportlab is only imported
+    when it is needed.
+    """
+    from reportlab.pdfgen import canvas
+
+    # XXX this depends on an implementation detail of reportlab.pdfgen
+    class PageSizeCanvas(canvas.Canvas):
+        def getPageSize(self):
+            return self._pagesize
+
+    # XXX this depends on an implementation detail of reportlab.pdfgen
+    class LabelCanvas(canvas.Canvas):
+        def __init__(self,labellist,labelsize,*args,**kwargs):
+            self._labellist=labellist
+            self._labelsize=labelsize
+            canvas.Canvas.__init__(self,*args,**kwargs)
+            self._startpage()
+        def _startpage(self):
+            self._cpll=list(self._labellist)
+            self.saveState()
+            self._nextlabel()
+        def _nextlabel(self):
+            self.restoreState()
+            if self._cpll:
+                self.saveState()
+                lpos=self._cpll.pop(0)
+                self.translate(*lpos)
+            else:
+                canvas.Canvas.showPage(self)
+                self._startpage()
+        def getPageSize(self):
+            return self._labelsize
+        def showPage(self):
+            self._nextlabel()
+        def _end(self):
+            if len(self._cpll)==len(self._labellist):
+                # We haven't drawn a label on this page yet - the code
+                # will just be the save and transform for the first label.
+                # Drop it.
+                self._code = []
+            else:
+                # We need to flush the current page explicitly before
+                # saving, because the save() method calls showPage() which
+                # we have overridden.
+                canvas.Canvas.showPage(self)
+            self.save()
+
+    return PageSizeCanvas, LabelCanvas
 
-class pdf_page(object):
+class pdf_page(_reconfigurable):
     """A driver that presents as a PDF canvas, extended to make the page
     size readable via a getPageSize() method.
 
     """
     filesuffix = ".pdf"
     mimetype = "application/pdf"
+    labels_per_page = 1
     def __init__(self,pagesize=A4):
         self._pagesize=pagesize
     def start(self,fileobj,interface):
+        PageSizeCanvas, LabelCanvas = _canvas_classes()
         self._canvas=PageSizeCanvas(fileobj,pagesize=self._pagesize)
         self._canvas.setAuthor("quicktill")
         return self._canvas
@@ -766,44 +996,7 @@ class pdf_page(object):
                   colour=None, font=None, emph=None, underline=None):
         pass
 
-# XXX this depends on an implementation detail of reportlab.pdfgen
-class LabelCanvas(canvas.Canvas):
-    def __init__(self,labellist,labelsize,*args,**kwargs):
-        self._labellist=labellist
-        self._labelsize=labelsize
-        canvas.Canvas.__init__(self,*args,**kwargs)
-        self._startpage()
-    def _startpage(self):
-        self._cpll=list(self._labellist)
-        self.saveState()
-        self._nextlabel()
-    def _nextlabel(self):
-        self.restoreState()
-        if self._cpll:
-            self.saveState()
-            lpos=self._cpll.pop(0)
-            self.translate(*lpos)
-        else:
-            canvas.Canvas.showPage(self)
-            self._startpage()
-    def getPageSize(self):
-        return self._labelsize
-    def showPage(self):
-        self._nextlabel()
-    def _end(self):
-        if len(self._cpll)==len(self._labellist):
-            # We haven't drawn a label on this page yet - the code
-            # will just be the save and transform for the first label.
-            # Drop it.
-            self._code = []
-        else:
-            # We need to flush the current page explicitly before
-            # saving, because the save() method calls showPage() which
-            # we have overridden.
-            canvas.Canvas.showPage(self)
-        self.save()
-
-class pdf_labelpage(object):
+class pdf_labelpage(_reconfigurable):
     """A driver that prints onto laser label paper.  It presents as a PDF
     canvas, extended to make the page size readable via a
     getPageSize() method.  Each individual label is treated as a
@@ -819,9 +1012,20 @@ class pdf_labelpage(object):
                  labelwidth,labelheight,
                  horizlabelgap,vertlabelgap,
                  pagesize=A4):
+        self._labels=(labelsacross,labelsdown,labelwidth,labelheight,
+                      horizlabelgap,vertlabelgap)
+        self._pagesize=pagesize
+        self.labels_per_page=labelsacross*labelsdown
+        self.ll=None
+    def _layout(self):
+        # Lengths are converted using reportlab, which we don't
+        # import until the first time something is printed
+        from reportlab.lib.units import toLength
+        labelsacross,labelsdown,labelwidth,labelheight,\
+            horizlabelgap,vertlabelgap=self._labels
+        pagesize=self._pagesize
         self.width=toLength(labelwidth)
         self.height=toLength(labelheight)
-        self._pagesize=pagesize
         horizlabelgap=toLength(horizlabelgap)
         vertlabelgap=toLength(vertlabelgap)
         pagewidth=pagesize[0]
@@ -843,6 +1047,9 @@ class pdf_labelpage(object):
                       -self.height)
                 self.ll.append((xpos,ypos))
     def start(self,fileobj,interface):
+        if self.ll is None:
+            self._layout()
+        PageSizeCanvas, LabelCanvas = _canvas_classes()
         self._canvas=LabelCanvas(self.ll,(self.width,self.height),
                                  fileobj,pagesize=self._pagesize)
         self._canvas.setAuthor("quicktill")
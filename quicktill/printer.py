@@ -4,6 +4,9 @@ from .models import Delivery,VatBand,Business,Transline,Transaction
 from .models import zero,penny
 
 import datetime
+import concurrent.futures
+import logging
+log = logging.getLogger(__name__)
 now = datetime.datetime.now
 
 # XXX should be in tillconfig?
@@ -152,6 +155,8 @@ def print_sessiontotals(s):
             d.printline("Printed %s"%ui.formattime(now()))
         else:
             d.printline("  Ended %s"%ui.formattime(s.endtime))
+        if s.archived:
+            d.printline("Records archived: till totals incomplete")
         d.printline("Till total:\t\tActual total:")
         ttt = Decimal("0.00")
         att = Decimal("0.00")
@@ -191,43 +196,113 @@ def label_print_delivery(p,delivery):
     d=td.s.query(Delivery).get(delivery)
     stocklabel_print(p,d.items)
 
-def stock_label(f,d):
-    """Draw a stock label (d) on a PDF canvas (f).
+class stocklabel:
+    """The details printed on a stock label
 
+    These are read from a StockItem so that the label can be drawn
+    without a database session.
+    """
+    def __init__(self, item):
+        self.descriptions = tuple(item.stocktype.descriptions)
+        self.supplier = item.delivery.supplier.name
+        self.date = ui.formatdate(item.delivery.date)
+        self.unit = item.stockunit.name
+        self.checkdigits = item.checkdigits \
+                           if tillconfig.checkdigit_print else None
+        self.id = item.id
+
+    @property
+    def common(self):
+        """The details that many items in a delivery have in common"""
+        return (self.descriptions, self.supplier, self.date, self.unit)
+
+def stock_label(f, label, layouts=None):
+    """Draw a stock label on a PDF canvas (f).
+
+    label is a stocklabel.  Many items in a delivery have the same
+    details apart from their stock number; if layouts is a dict, the
+    lines worked out for one label are kept in it and reused for the
+    others.
     """
     (width,height)=f.getPageSize()
     fontsize=12
     margin=12
     pitch=fontsize+2
     fontname="Times-Roman"
+    key=(label.common,width)
+    lines=layouts.get(key) if layouts is not None else None
+    if not lines:
+        def fits(s):
+            sw=f.stringWidth(s,fontname,fontsize)
+            return sw<(width-(2*margin))
+        # Use the longest description that fits, as StockType.format() does
+        d=label.descriptions
+        while len(d)>1 and not fits(d[0]):
+            d=d[1:]
+        lines=[d[0],label.supplier,label.date,label.unit]
+        if layouts is not None:
+            layouts[key]=lines
+    if label.checkdigits:
+        lines=lines+["Check digits: %s"%(label.checkdigits,)]
     f.setFont(fontname,fontsize)
-    def fits(s):
-        sw=f.stringWidth(s,fontname,fontsize)
-        return sw<(width-(2*margin))
     y=height-margin-fontsize
-    f.drawCentredString(width/2,y,d.stocktype.format(fits))
-    y=y-pitch
-    f.drawCentredString(width/2,y,d.delivery.supplier.name)
-    y=y-pitch
-    f.drawCentredString(width/2,y,ui.formatdate(d.delivery.date))
-    y=y-pitch
-    f.drawCentredString(width/2,y,d.stockunit.name)
-    if tillconfig.checkdigit_print:
+    f.drawCentredString(width/2,y,lines[0])
+    for line in lines[1:]:
         y=y-pitch
-        f.drawCentredString(width/2,y,"Check digits: %s"%(d.checkdigits,))
+        f.drawCentredString(width/2,y,line)
     f.setFont(fontname,y-margin)
-    f.drawCentredString(width/2,margin,str(d.id))
+    f.drawCentredString(width/2,margin,str(label.id))
     f.showPage()
 
+# Stock labels are drawn and printed one delivery at a time on a
+# single background thread, so that a large delivery doesn't hold up
+# the till.  They are sent to the printer as separate jobs of this
+# many pages, so the printer can start on the first pages while the
+# rest are being drawn.  Printers and their drivers keep state while
+# a document is being printed, so the background thread uses a fresh
+# printer configured like the one asked for.
+label_job_pages = 10
+_label_executor = None
+
+def _labels_per_page(p):
+    return getattr(getattr(p, '_driver', None), 'labels_per_page', 1)
+
+def _print_labels(p, labels):
+    per_job = label_job_pages * _labels_per_page(p)
+    layouts = {}
+    for i in range(0, len(labels), per_job):
+        with p as d:
+            for label in labels[i:i + per_job]:
+                stock_label(d, label, layouts)
+    return layouts
+
+def _labels_printed(p, future):
+    try:
+        future.result()
+    except Exception as e:
+        log.error("Failed to print labels on %s", p, exc_info=True)
+        ui.infopopup(["There was a problem printing labels on {}: {}"
+                      .format(p, e)], title="Printer problem")
+
 def stocklabel_print(p,sl):
-    """Print stock labels for a list of stock numbers to the specified
+    """Print stock labels for a list of stock items to the specified
     printer.
 
+    The details of the items are read straight away; the labels are
+    printed in the background.  Returns a concurrent.futures.Future
+    for the print job.
     """
+    global _label_executor
     td.s.add_all(sl)
-    with p as d:
-        for sd in sl:
-            stock_label(d,sd)
+    labels = [stocklabel(sd) for sd in sl]
+    if not _label_executor:
+        _label_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="labels")
+    future = _label_executor.submit(_print_labels, p.fresh(), labels)
+    future.add_done_callback(
+        lambda f: tillconfig.mainloop.call_from_thread(
+            lambda: _labels_printed(p, f)))
+    return future
 
 def print_restock_list(rl):
     """
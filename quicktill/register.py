@@ -43,7 +43,7 @@ log = logging.getLogger(__name__)
 from . import foodorder
 from .models import Transline, Transaction, Session, StockOut, Transline, penny
 from .models import Payment, zero, User, Department, desc, RemoveCode
-from .models import StockType
+from .models import StockType, StockItem
 from sqlalchemy.sql import func
 from decimal import Decimal
 from sqlalchemy.orm.exc import ObjectDeletedError
@@ -54,6 +54,10 @@ import uuid
 
 max_transline_modify_age = datetime.timedelta(minutes=1)
 
+# Offer to record a pull-through when an item on a regular stockline
+# with a pull-through amount hasn't been sold for this long
+pullthru_age = datetime.timedelta(hours=11)
+
 # Permissions checked for explicitly in this module
 user.action_descriptions['override-price'] = "Override the sale price of an item"
 user.action_descriptions['nosale'] = "Open the cash drawer with no payment"
@@ -352,6 +356,7 @@ def no_saleprice_popup(user, stocktype):
 def record_pullthru(stockid, qty):
     td.s.add(StockOut(stockid=stockid, qty=qty, removecode_id='pullthru'))
     td.s.flush()
+    td.stock_recordsale(stockid)
 
 class repeatinfo(object):
     """Information for repeat keypresses."""
@@ -883,36 +888,24 @@ class page(ui.basicpage):
         if explicitprice:
             sale.price = explicitprice
 
-        total_qty = items * sale.qty
-        sell, unallocated, remaining = stockline.calculate_sale(
-            total_qty)
-
-        # This _should_ only be the case with display stocklines.
-        if unallocated > 0:
-            ui.infopopup(
-                ["There are fewer than {} items of {} on display.  "
-                 "If you have recently put more stock on display you "
-                 "must tell the till about it using the 'Use Stock' "
-                 "button after dismissing this message.".format(
-                        total_qty, stockline.name)],
-                title="Not enough stock on display")
-            return
-        if len(sell) == 0:
-            log.info("linekey: no stock in use for %s", stockline.name)
-            ui.infopopup(
-                ["No stock is registered for {}.".format(stockline.name),
-                 "To tell the till about stock on sale, "
-                 "press the '{}' button after "
-                 "dismissing this message.".format(keyboard.K_USESTOCK.keycap)],
-                title="{} has no stock".format(stockline.name))
-            return
-
         # NB get_open_trans() may call _clear() and will zap self.repeat when
         # it creates a new transaction!
         may_repeat = self.repeat and hasattr(self.repeat, 'stocklineid') \
                      and self.repeat.stocklineid == stockline.id \
                      and self.repeat.mod == mod
 
+        if tillconfig.server_side_sales:
+            return self._sell_stockline_server(
+                stockline, sale, items, mod, may_repeat)
+
+        total_qty = items * sale.qty
+        sell, unallocated, remaining = stockline.calculate_sale(
+            total_qty)
+
+        if unallocated > 0 or len(sell) == 0:
+            self._stockline_sale_failed(stockline, unallocated, total_qty)
+            return
+
         trans = self.get_open_trans()
         if trans is None:
             return # Will already be displaying an error.
@@ -948,24 +941,9 @@ class page(ui.basicpage):
             # pullthrough; the lastsale time will change once we start
             # committing StockOut objects to the database.
             item = sell[0][0]
-            if td.stock_checkpullthru(item.id, '11:00:00'):
-                ui.infopopup(
-                    ["According to the till records, {} hasn't been "
-                     "sold or pulled through in the last 11 hours.  "
-                     "Would you like to record that you've pulled "
-                     "through {} {}s?".format(
-                         item.stocktype.format(),
-                         stockline.pullthru,
-                         item.stocktype.unit.name),
-                     "",
-                     "Press '{}' if you do, or {} if you don't.".format(
-                         keyboard.K_WASTE.keycap,
-                         keyboard.K_CLEAR.keycap)],
-                    title="Pull through?", colour=ui.colour_input,
-                    keymap={
-                        keyboard.K_WASTE:
-                        (record_pullthru, (item.id, stockline.pullthru),
-                         True)})
+            if td.stock_checkpullthru(item.id, pullthru_age):
+                self._pullthru_popup(stockline, item)
+            td.stock_recordsale(item.id)
 
         if not repeated:
             tl = Transline(
@@ -989,21 +967,67 @@ class page(ui.basicpage):
 
         self.repeat = repeatinfo(stocklineid=stockline.id, mod=mod)
 
+        self._stockline_sale_done(trans, stockline, sell[0][0], remaining)
+
+    def _stockline_sale_failed(self, stockline, unallocated, total_qty):
+        # This _should_ only be the case with display stocklines.
+        if unallocated > 0:
+            ui.infopopup(
+                ["There are fewer than {} items of {} on display.  "
+                 "If you have recently put more stock on display you "
+                 "must tell the till about it using the 'Use Stock' "
+                 "button after dismissing this message.".format(
+                        total_qty, stockline.name)],
+                title="Not enough stock on display")
+            return
+        log.info("linekey: no stock in use for %s", stockline.name)
+        ui.infopopup(
+            ["No stock is registered for {}.".format(stockline.name),
+             "To tell the till about stock on sale, "
+             "press the '{}' button after "
+             "dismissing this message.".format(keyboard.K_USESTOCK.keycap)],
+            title="{} has no stock".format(stockline.name))
+
+    def _pullthru_popup(self, stockline, item):
+        ui.infopopup(
+            ["According to the till records, {} hasn't been "
+             "sold or pulled through in the last {} hours.  "
+             "Would you like to record that you've pulled "
+             "through {} {}s?".format(
+                 item.stocktype.format(),
+                 int(pullthru_age.total_seconds() // 3600),
+                 stockline.pullthru,
+                 item.stocktype.unit.name),
+             "",
+             "Press '{}' if you do, or {} if you don't.".format(
+                 keyboard.K_WASTE.keycap,
+                 keyboard.K_CLEAR.keycap)],
+            title="Pull through?", colour=ui.colour_input,
+            keymap={
+                keyboard.K_WASTE:
+                (record_pullthru, (item.id, stockline.pullthru),
+                 True)})
+
+    def _stockline_sale_done(self, trans, stockline, stockitem, remaining):
+        """Update the display after a sale from a stockline
+
+        For regular stocklines stockitem is the item sold and
+        remaining is the amount left in it; for display stocklines
+        remaining is (ondisplay, instock); for continuous stocklines
+        it is the total amount left.
+        """
         if stockline.linetype == "regular":
-            # We are using the last value of so from either the
-            # previous for loop, or the handling of may_repeat
-            stockitem = so.stockitem
             self.prompt = "{}: {} {}s of {} remaining".format(
-                stockline.name, stockitem.remaining,
+                stockline.name, remaining,
                 stockitem.stocktype.unit.name, stockitem.stocktype.format())
-            if stockitem.remaining < Decimal("0.0"):
+            if remaining < Decimal("0.0"):
                 ui.infopopup([
                     "There appears to be {} {}s of {} left!  Please "
                     "check that you're still using stock item {}; if you've "
                     "started using a new item, tell the till about it "
                     "using the '{}' button after dismissing this "
                     "message.".format(
-                        stockitem.remaining,
+                        remaining,
                         stockitem.stocktype.unit.name,
                         stockitem.stocktype.format(),
                         stockitem.id,
@@ -1041,6 +1065,63 @@ class page(ui.basicpage):
         self.cursor_off()
         self._redraw()
 
+    def _sell_stockline_server(self, stockline, sale, items, mod, may_repeat):
+        """Sell from a stockline using the stockline_sale() database function
+
+        Used instead of the rest of _sell_stockline() when
+        tillconfig.server_side_sales is set: the stock allocation,
+        pull-through check and new transaction line are all dealt
+        with in one call to the database.
+        """
+        trans = self.get_open_trans()
+        if trans is None:
+            return
+        repeat_translineid = None
+        if may_repeat and len(self.dl) > 0 \
+           and self.dl[-1].age() < max_transline_modify_age:
+            repeat_translineid = self.dl[-1].transline
+
+        # Regular stocklines only ever sell from their first item; if
+        # we know it was sold recently the database needn't check
+        check_pullthru = None
+        if stockline.linetype == "regular" and stockline.pullthru \
+           and not (stockline.stockonsale and td.stock_recentsale(
+               stockline.stockonsale[0].id, pullthru_age)):
+            check_pullthru = pullthru_age
+
+        result = td.stockline_sale(
+            trans.id, stockline.id, sale.qty, items,
+            sale.price, sale.stocktype.dept_id, sale.description,
+            self.user.dbuser.id, repeat_translineid, check_pullthru)
+        r = result[0]
+        if r.sale_unallocated > 0 or r.sale_stockid is None:
+            self._stockline_sale_failed(
+                stockline, r.sale_unallocated, items * sale.qty)
+            return
+
+        stockitem = td.s.query(StockItem).get(r.sale_stockid)
+        if r.sale_pullthru:
+            self._pullthru_popup(stockline, stockitem)
+        if stockline.linetype == "regular" and stockline.pullthru:
+            td.stock_recordsale(stockitem.id)
+
+        if r.sale_repeated:
+            otl = td.s.query(Transline).get(r.sale_translineid)
+            td.s.expire(otl, ['items'])
+            for so in otl.stockref:
+                td.s.expire(so, ['qty'])
+            log.info("linekey: updated transline %d", otl.id)
+            self.dl[-1].update()
+        else:
+            self.dl.append(tline(r.sale_translineid))
+
+        self.repeat = repeatinfo(stocklineid=stockline.id, mod=mod)
+
+        self._stockline_sale_done(
+            trans, stockline, stockitem,
+            (r.sale_remaining, r.sale_instock)
+            if stockline.linetype == "display" else r.sale_remaining)
+
     def deptlines(self, lines):
         """Accept multiple transaction lines from an external source.
 
@@ -1712,11 +1793,7 @@ class page(ui.basicpage):
             return
         trans = self._gettrans()
         tll = [ td.s.query(Transline).get(l.transline) for l in ll ]
-        voidlines = [ transline.void(trans, self.user.dbuser)
-                      for transline in tll ]
-        voidlines = [ x for x in voidlines if x ]
-        td.s.add_all(voidlines)
-        td.s.flush() # get transline IDs, fill in voided_by
+        voidlines = Transline.void_lines(td.s, tll, trans, self.user.dbuser)
         for ntl in voidlines:
             self.dl.append(tline(ntl.id))
         for l in ll:
@@ -2035,8 +2112,16 @@ class page(ui.basicpage):
                            .format(
                                othertrans.id, othertrans.notes or "no notes",
                                self.user.fullname)
-        for line in list(trans.lines):
-            line.transaction = othertrans
+        # Move all the lines in a single statement, so the database
+        # integrity checks on translines run once rather than per line
+        lines = list(trans.lines)
+        td.s.query(Transline)\
+            .filter(Transline.transid == trans.id)\
+            .update({Transline.transid: othertrans.id},
+                    synchronize_session=False)
+        for line in lines:
+            td.s.expire(line)
+        td.s.expire(trans, ['lines'])
         td.s.delete(trans)
         td.s.flush()
         td.s.expire(othertrans)
@@ -0,0 +1,62 @@
+"""Routing of read-only database work to a replica
+
+Reports run from the web interface or the command line can be
+expensive.  If a replica of the till database is available (a
+PostgreSQL hot standby, or for testing simply a second database on
+the same server) they can be run there instead of on the primary
+database used by the tills.
+
+The replica is only used if it is reachable and is not lagging too
+far behind the primary; otherwise we fall back to the primary.
+"""
+
+from sqlalchemy.exc import DBAPIError
+
+import logging
+log = logging.getLogger(__name__)
+
+# Zero if the server is not a hot standby, or if it has replayed
+# everything it has received.  Otherwise the age of the most recently
+# replayed transaction, in seconds.
+_lag_query = """
+SELECT CASE
+  WHEN NOT pg_is_in_recovery() THEN 0
+  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+  ELSE coalesce(extract(epoch from
+                now() - pg_last_xact_replay_timestamp()), 0)
+END
+"""
+
+def replica_lag(session):
+    """How far behind the primary is the database in session?
+
+    Returns the lag in seconds.
+    """
+    return session.execute(_lag_query).scalar()
+
+def readonly_session(primary, replica=None, max_lag=None):
+    """Start an ORM session for read-only work
+
+    primary and replica are sessionmakers.  If replica is None, or
+    the replica can't be contacted, or it is more than max_lag seconds
+    behind the primary, a session on the primary is returned.
+
+    The transaction started on the replica is read-only: attempts to
+    write will fail even if the replica database would accept them.
+    """
+    if replica is None:
+        return primary()
+    s = replica()
+    try:
+        s.execute("SET TRANSACTION READ ONLY")
+        lag = replica_lag(s)
+    except DBAPIError as e:
+        log.warning("Replica database unavailable, using primary: %s", e)
+        s.close()
+        return primary()
+    if max_lag is not None and lag > max_lag:
+        log.info("Replica database is %.1fs behind (limit %.1fs), "
+                 "using primary", lag, max_lag)
+        s.close()
+        return primary()
+    return s
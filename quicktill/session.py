@@ -59,6 +59,7 @@ class ssdialog(ui.dismisspopup):
         td.s.flush()
         deferred = trans_restore()
         td.foodorder_reset()
+        td.add_partitions()
         log.info("Started session number %d", sc.id)
         printer.kickout()
         if deferred:
@@ -392,6 +393,9 @@ def totalpopup(sessionid):
         l.append(" Session is still open. ")
     else:
         l.append(" Ended {:%Y-%m-%d %H:%M:%S} ".format(s.endtime))
+    if s.archived:
+        l.append(" Some records have been archived; ")
+        l.append(" the till totals are incomplete. ")
     l.append("")
     tf = ui.tableformatter(" l pr  r ")
     l.append(tf("", "Till:", "Actual:"))
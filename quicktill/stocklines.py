@@ -11,11 +11,10 @@ def restock_list(stockline_list):
     # Print out list of things to fetch and put on display
     # Display prompt: have you fetched them all?
     # If yes, update records.  If no, don't.
-    sl=[]
     for i in stockline_list:
         td.s.add(i)
-        r=i.calculate_restock()
-        if len(r)>0: sl.append((i,r))
+    moves=StockLine.calculate_restock_for_lines(td.s, stockline_list)
+    sl=[(i,moves[i.id]) for i in stockline_list if i.id in moves]
     if sl==[]:
         ui.infopopup(["There is no stock to be put on display."],
                      title="Stock movement")
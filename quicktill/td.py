@@ -6,11 +6,14 @@
 # implementing them in the database itself.
 
 import datetime
+import time
+import re
 
 from sqlalchemy import create_engine
 from sqlalchemy.pool import Pool
 from sqlalchemy import event,exc
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session as ORMSession
 from sqlalchemy.orm import subqueryload_all,joinedload,subqueryload
 from sqlalchemy.orm import undefer
 from sqlalchemy.sql.expression import tuple_,func,null
@@ -18,6 +21,7 @@ from sqlalchemy.sql import select,not_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import distinct
 from . import models
+from . import replica
 from .models import *
 
 import logging
@@ -27,11 +31,24 @@ log=logging.getLogger(__name__)
 s=None
 # Sessionmaker, set up during init()
 sm=None
+# Sessionmaker for the replica database, if there is one
+replica_sm=None
+# Maximum acceptable replica lag in seconds, or None for no limit
+replica_max_lag=None
 class SessionLifecycleError(Exception):
     pass
 class orm_session(object):
-    @staticmethod
-    def __enter__():
+    """
+    Context manager for td.s
+
+    If readonly is True and a replica database was passed to init(),
+    the session may be started on the replica instead of the primary
+    database.
+
+    """
+    def __init__(self, readonly=False):
+        self._readonly = readonly
+    def __enter__(self):
         """
         Change td.s from None to an active session object, or raise an
         exception if td.s is not None.
@@ -39,7 +56,10 @@ class orm_session(object):
         """
         global s,sm
         if s is not None: raise SessionLifecycleError()
-        s=sm()
+        if self._readonly:
+            s=replica.readonly_session(sm, replica_sm, replica_max_lag)
+        else:
+            s=sm()
         log.debug("Start session")
     @staticmethod
     def __exit__(type,value,traceback):
@@ -85,14 +105,127 @@ def stocktype_completename(m,n):
 
 ### Functions related to the stock,stockout tables
 
+# When each stock item was last sold or pulled through, as far as this
+# process knows, in time.monotonic() seconds; see stock_checkpullthru().
+# Sales seen in a database transaction are kept in the session's info
+# dict under "lastsale" and only added here when the transaction
+# commits, so that a sale that is rolled back isn't remembered.
+_lastsale={}
+
+def _note_lastsale(session,stockid,when):
+    pending=session.info.setdefault('lastsale',{})
+    pending[stockid]=max(when,pending.get(stockid,when))
+
+@event.listens_for(ORMSession,"after_commit")
+def _commit_lastsale(session):
+    for stockid,when in session.info.pop('lastsale',{}).items():
+        _lastsale[stockid]=max(when,_lastsale.get(stockid,when))
+
+@event.listens_for(ORMSession,"after_rollback")
+def _rollback_lastsale(session):
+    session.info.pop('lastsale',None)
+
+def stock_recentsale(stockid,maxtime):
+    """Has this process seen a stock item sold recently?
+
+    Returns True if the item has been sold or pulled through within
+    maxtime (a datetime.timedelta) according to stock_recordsale()
+    and earlier calls to stock_checkpullthru() in this process.  The
+    database isn't consulted.
+    """
+    seen=[t for t in (_lastsale.get(stockid),
+                      s.info.get('lastsale',{}).get(stockid))
+          if t is not None]
+    return bool(seen) and time.monotonic()-max(seen)<maxtime.total_seconds()
+
 def stock_checkpullthru(stockid,maxtime):
-    """Did this stock item require pulling through?"""
+    """Did this stock item require pulling through?
+
+    maxtime is a datetime.timedelta.  Returns True if the item hasn't
+    been sold or pulled through for longer than maxtime, or None if it
+    has never been sold.
+
+    If this process has seen the item sold or pulled through within
+    maxtime (see stock_recentsale()) the database isn't consulted at
+    all.  Otherwise the most recent sale is found in the
+    stockout_pullthru_key index, which is a single index lookup no
+    matter how many times the item has been sold.
+    """
     global s
-    return s.execute(
-        select([func.now()-func.max(StockOut.time)>maxtime]).\
+    if stock_recentsale(stockid,maxtime):
+        return False
+    age=s.execute(
+        select([func.now()-func.max(StockOut.time)]).\
             where(StockOut.stockid==stockid).\
             where(StockOut.removecode_id.in_(['sold','pullthru']))
         ).scalar()
+    if age is None:
+        return None
+    _note_lastsale(s,stockid,time.monotonic()-age.total_seconds())
+    return age>maxtime
+
+def stock_recordsale(stockid):
+    """Note that a stock item has just been sold or pulled through
+
+    This takes effect when the current database transaction commits.
+    """
+    _note_lastsale(s,stockid,time.monotonic())
+
+def stockline_sale(transid,stocklineid,qty,items,amount,dept_id,text,
+                   user_id,repeat_translineid=None,pullthru_age=None):
+    """Sell from a stockline using the stockline_sale() database function
+
+    Allocates the stock, checks whether a pull-through is needed and
+    adds the transaction line and stockout rows to transaction
+    transid in a single round trip to the database; see models.py for
+    details.  The pull-through check is only made if pullthru_age (a
+    datetime.timedelta) is not None.  Returns the list of result rows.
+    """
+    global s
+    s.flush()
+    result=s.execute(
+        "SELECT * FROM stockline_sale(:transid,:stocklineid,:qty,:items,"
+        ":amount,:dept,:text,:user,:repeat,:pullthru_age)",
+        {'transid': transid, 'stocklineid': stocklineid, 'qty': qty,
+         'items': items, 'amount': amount, 'dept': dept_id, 'text': text,
+         'user': user_id, 'repeat': repeat_translineid,
+         'pullthru_age': pullthru_age}).fetchall()
+    # The ORM doesn't know about the new stockout rows
+    for r in result:
+        if r.sale_stockid is None:
+            continue
+        item=s.identity_map.get(s.identity_key(StockItem,r.sale_stockid))
+        if item is not None:
+            s.expire(item,['used','sold','remaining','firstsale','lastsale'])
+    return result
+
+def stock_create(delivery,stocktype,stockunit,costprices,bestbefore=None):
+    """Add several items of the same type to a delivery
+
+    One stock item is created for each entry in costprices (entries
+    may be None), using a single multi-row INSERT instead of adding
+    and flushing each StockItem separately.  Returns the new StockItem
+    objects in order of stock number.
+    """
+    global s
+    if not costprices:
+        return []
+    t=StockItem.__table__
+    ids=[x[0] for x in s.execute(
+        t.insert().\
+        values([{'stockid': stock_seq.next_value(),
+                 'deliveryid': delivery.id,
+                 'stocktype': stocktype.id,
+                 'stockunit': stockunit.id,
+                 'costprice': cost,
+                 'bestbefore': bestbefore} for cost in costprices]).\
+        returning(t.c.stockid))]
+    # The ORM doesn't know about the new rows
+    s.expire(delivery,['items','costprice'])
+    return s.query(StockItem).\
+        filter(StockItem.id.in_(ids)).\
+        order_by(StockItem.id).\
+        all()
 
 def foodorder_reset():
     foodorder_seq.drop()
@@ -102,17 +235,103 @@ def foodorder_ticket():
     global s
     return s.execute(select([foodorder_seq.next_value()])).scalar()
 
+def add_partitions():
+    """Make sure the partitioned tables have partitions for new records
+    """
+    global s
+    s.execute("select add_partitions()")
+
 def db_version():
     global s
     return s.execute("select version()").scalar()
 
-# This is "pessimistic disconnect handling" as described in the
-# sqlalchemy documentation.  A "ping" select is issued on every
-# connection checkout before the connection is used, and a failure of
-# the ping causes a reconnection.  This enables the till software to
-# keep running even after a database restart.
+# Connections that have been idle in the pool for more than this many
+# seconds are checked with a "ping" select before they are used, as
+# described under "pessimistic disconnect handling" in the sqlalchemy
+# documentation; a failure of the ping causes a reconnection.  This
+# enables the till software to keep running even after a database
+# restart.
+#
+# Connections that were in use more recently than this are handed out
+# without a round trip to the server.  If the server has gone away in
+# the meantime, the error is noticed when the connection is first
+# used: sqlalchemy recognises it as a disconnection and invalidates
+# the whole pool, so only that one operation fails and the next one
+# gets a fresh connection.  Set to 0 to ping on every checkout.
+ping_idle_time=30
+
+# TCP keepalive settings passed to libpq, so that connections to a
+# server that has disappeared (for example when a VPN link drops)
+# are noticed and closed while they are idle in the pool rather
+# than hanging when they are next used.
+keepalive_args={
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3,
+}
+
+# Connection pool settings for each kind of process, passed to
+# create_engine().  Tills and stock terminals do one thing at a time
+# and command-line tools are short-lived, so they need very few
+# connections; tillweb serves several requests at once.  Tills also
+# keep a connection busy in the background while the accounts outbox
+# is being sent (see xero.XeroIntegration), so they get one more.
+# Threads that want a connection when the pool and its overflow are
+# all in use wait for one, for up to pool_timeout (default 30)
+# seconds.  With a dozen terminals and some web workers the defaults
+# for the pool sizes quickly add up to the server's max_connections,
+# so they can be overridden per role in pool_options (usually from
+# the "database_pool" key in the configuration file).
+pool_defaults={
+    'till': {'pool_size': 2, 'max_overflow': 2},
+    'stockterminal': {'pool_size': 1, 'max_overflow': 2},
+    'tillweb': {'pool_size': 5, 'max_overflow': 5},
+    'command': {'pool_size': 1, 'max_overflow': 1},
+}
+pool_options={}
+
+# Set to True if the database is reached through a pooler such as
+# PgBouncer in transaction pooling mode.  In this mode each
+# transaction may run on a different server connection, so anything
+# that leaves state behind in the server session after the
+# transaction ends is unsafe: SET (other than SET LOCAL), LISTEN,
+# session-level advisory locks, temporary tables, prepared statements
+# and cursors WITH HOLD.  None of these are used by the till;
+# statement timeouts are set with SET LOCAL, and sequences such as
+# foodorder_seq are not affected because nextval() doesn't depend on
+# the session.  When this is set, engines check each statement and
+# raise TransactionPoolingError for any that would break.
+transaction_pooling=False
+
+class TransactionPoolingError(Exception):
+    """A statement is unsafe behind a transaction pooler."""
+    pass
+
+_session_state_re=re.compile(
+    r"^\s*(SET\s+(?!LOCAL\b|TRANSACTION\b|CONSTRAINTS\b)|RESET\b|"
+    r"LISTEN\b|PREPARE\b|CREATE\s+(TEMP|TEMPORARY)\b)"
+    r"|\bWITH\s+HOLD\b|\bpg_(try_)?advisory_lock(_shared)?\s*\(",
+    re.IGNORECASE)
+
+def _check_transaction_pooling(conn, cursor, statement, parameters,
+                               context, executemany):
+    if _session_state_re.search(statement):
+        raise TransactionPoolingError(
+            "Statement not safe with transaction pooling: {}".format(
+                statement))
+
+@event.listens_for(Pool, "connect")
+@event.listens_for(Pool, "checkin")
+def _record_last_used(dbapi_connection, connection_record):
+    connection_record.info['last_used']=time.monotonic()
+
 @event.listens_for(Pool, "checkout")
 def ping_connection(dbapi_connection, connection_record, connection_proxy):
+    last_used=connection_record.info.get('last_used')
+    if last_used is not None and \
+       time.monotonic()-last_used<ping_idle_time:
+        return
     cursor=dbapi_connection.cursor()
     try:
         cursor.execute("SELECT 1")
@@ -144,20 +363,49 @@ def parse_database_name(database):
         database = libpq_to_sqlalchemy(database)
     return database
 
-def init(database):
+def make_engine(database, role="command", transaction_pooling=None):
+    """
+    Create a sqlalchemy engine for a process of the given role.
+
+    database can be a libpq connection string or a sqlalchemy URL.
+    role is one of the keys of pool_defaults.  If transaction_pooling
+    is not specified, the module-level setting is used.
+
+    """
+    if transaction_pooling is None:
+        transaction_pooling=globals()['transaction_pooling']
+    kwargs=dict(pool_defaults.get(role,{}))
+    kwargs.update(pool_options.get(role,{}))
+    engine=create_engine(parse_database_name(database),
+                         connect_args=keepalive_args,**kwargs)
+    if transaction_pooling:
+        event.listen(engine,"before_cursor_execute",
+                     _check_transaction_pooling)
+    return engine
+
+def init(database, replica_database=None, max_lag=None, role="command"):
     """
     Initialise the database subsystem.
 
     database can be a libpq connection string or a sqlalchemy URL
 
+    replica_database, if specified, is used for sessions started with
+    orm_session(readonly=True) as long as it is no more than max_lag
+    seconds behind the primary database.
+
+    role chooses the connection pool settings; see pool_defaults.
+
     """
-    global sm
+    global sm,replica_sm,replica_max_lag
     log.info("init database \'%s\'",database)
-    database=parse_database_name(database)
-    log.info("sqlalchemy engine URL \'%s\'",database)
-    engine=create_engine(database)
+    log.info("sqlalchemy engine URL \'%s\'",parse_database_name(database))
+    engine=make_engine(database,role)
     models.metadata.bind=engine # for DDL, eg. to recreate foodorder_seq
     sm=sessionmaker(bind=engine)
+    if replica_database:
+        log.info("init replica database \'%s\'",replica_database)
+        replica_sm=sessionmaker(bind=make_engine(replica_database,role))
+        replica_max_lag=max_lag
 
 def create_tables():
     """
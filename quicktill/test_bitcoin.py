@@ -0,0 +1,163 @@
+from . import bitcoin
+from . import event
+from . import tillconfig
+import unittest
+import json
+import threading
+import time
+import requests
+from decimal import Decimal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+SITE = "test"
+
+class FakeBTCMerch:
+    """A local HTTP server that behaves like a BTCMerch payment service
+
+    Each payment request is reported as paid once it has been checked
+    paid_after times.
+    """
+    def __init__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                data = parse_qs(self.rfile.read(length).decode('utf-8'))
+                time.sleep(fake.delay)
+                status, response = fake.post(self.path, data)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(response).encode('utf-8'))
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}/".format(self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        # Seconds taken to respond to each request
+        self.delay = 0.0
+        # If set, respond to all requests with this status
+        self.status = None
+        self.paid_after = 3
+        self.checks = {}
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def post(self, path, data):
+        if self.status:
+            return self.status, {}
+        if path != "/{}/payment.json".format(SITE):
+            return 404, {}
+        ref = data['ref'][0]
+        amount = Decimal(data['amount'][0])
+        with self._lock:
+            self.checks[ref] = self.checks.get(ref, 0) + 1
+            paid = self.checks[ref] >= self.paid_after
+        btc = str(amount / 1000)
+        return 200, {
+            'ref': ref, 'description': data['description'][0],
+            'amount': str(amount), 'amount_in_btc': btc,
+            'paid_so_far': btc if paid else "0", 'paid': paid,
+            'to_pay': "0" if paid else btc,
+            'to_pay_url': "bitcoin:1Fake?amount={}".format(btc),
+            'pay_to_address': "1Fake"}
+
+class PaymentProviderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeBTCMerch()
+        cls.api = bitcoin.Api("user", "password", SITE, cls.fake.url)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.close()
+
+    def setUp(self):
+        self.fake.delay = 0.0
+        self.fake.status = None
+        self.fake.checks = {}
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        self.results = []
+        self.errors = []
+
+    def _request(self, ref, amount=Decimal("10.00")):
+        return self.api.call(
+            self.api.request_payment, ref, "Payment {}".format(ref), amount,
+            result=self.results.append, error=self.errors.append)
+
+    def _run(self, until, timeout=5):
+        """Run the main loop until a condition is true"""
+        deadline = time.monotonic() + timeout
+        while not until() and time.monotonic() < deadline:
+            tillconfig.mainloop.add_timeout(0.05, lambda: None)
+            tillconfig.mainloop.iterate()
+
+    def test_main_loop_not_blocked(self):
+        self.fake.delay = 0.5
+        ticks = []
+        def tick():
+            ticks.append(len(self.results))
+            tillconfig.mainloop.add_timeout(0.05, tick)
+        tillconfig.mainloop.add_timeout(0.05, tick)
+        self._request("p1")
+        self._run(lambda: self.results)
+        self.assertEqual(len(self.results), 1)
+        self.assertFalse(self.results[0]['paid'])
+        # The main loop kept running while the request was made
+        self.assertGreater(ticks.count(0), 5)
+
+    def test_poll_until_paid(self):
+        # Check the payment again after each response, as btcpopup does
+        def check(result):
+            self.results.append(result)
+            if not result['paid']:
+                tillconfig.mainloop.add_timeout(0.1, request)
+        def request():
+            self.api.call(self.api.request_payment, "p2", "Payment 2",
+                          Decimal("5.00"), result=check,
+                          error=self.errors.append)
+        request()
+        self._run(lambda: self.results and self.results[-1]['paid'])
+        self.assertEqual([r['paid'] for r in self.results],
+                         [False, False, True])
+        self.assertEqual(self.results[-1]['paid_so_far'],
+                         self.results[-1]['amount_in_btc'])
+
+    def test_error(self):
+        self.fake.status = 409
+        self._request("p3")
+        self._run(lambda: self.errors)
+        self.assertEqual(self.results, [])
+        self.assertIsInstance(self.errors[0], requests.exceptions.HTTPError)
+        self.assertEqual(self.errors[0].response.status_code, 409)
+
+    def test_cancel(self):
+        self.fake.delay = 0.2
+        c = self._request("p4")
+        c.cancel()
+        self._run(lambda: c.finished)
+        self.assertTrue(c.finished)
+        self.assertEqual(self.results, [])
+        self.assertEqual(self.errors, [])
+
+    def test_concurrent_requests(self):
+        self.fake.delay = 0.5
+        start = time.monotonic()
+        for i in range(4):
+            self._request("c{}".format(i))
+        self._run(lambda: len(self.results) == 4)
+        self.assertEqual(len(self.results), 4)
+        # One slow request doesn't hold up the others
+        self.assertLess(time.monotonic() - start, 1.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+from . import models
+from . import dbtest
+import unittest
+import datetime
+import time
+import multiprocessing
+from decimal import Decimal
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+
+# Registers and sales for the benchmark; the plain test uses fewer
+REGISTERS = 8
+SALES_PER_REGISTER = 50
+BOTTLES = 100
+GLASSES_PER_BOTTLE = 6
+
+def _register(stocklineid, count, glasses):
+    """Make count sales of some glasses from a continuous stockline
+
+    Runs in a separate process, like a register on another terminal.
+    Returns the number of glasses sold.
+    """
+    engine = create_engine(dbtest.TEST_DATABASE_URL)
+    sm = sessionmaker(bind=engine)
+    sales = 0
+    for i in range(count):
+        s = sm()
+        stockline = s.query(models.StockLine).get(stocklineid)
+        sell, unallocated, remaining = stockline.calculate_sale(
+            Decimal(glasses))
+        for item, qty in sell:
+            s.add(models.StockOut(stockitem=item, qty=qty,
+                                  removecode_id='sold'))
+        s.commit()
+        s.close()
+        sales += glasses - unallocated
+    engine.dispose()
+    return sales
+
+class ContinuousStocklineContentionTest(dbtest.DatabaseTest):
+    """Several registers selling from the same continuous stockline at
+    once must not over-allocate any stock item.
+    """
+    def setUp(self):
+        # The registers run in other processes, so the test data must
+        # be committed
+        s = sessionmaker(bind=self._engine)()
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=20)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        glass = models.UnitType(id='glass', name='glass')
+        wine = models.StockType(
+            manufacturer="A Winery", name="A Wine", shortname="A Wine",
+            abv=12, unit=glass, department=dept)
+        bottle = models.StockUnit(
+            id='bottle', name='Bottle', size=GLASSES_PER_BOTTLE, unit=glass)
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        stockline = models.StockLine(
+            name="Wine", location="Test", linetype="continuous",
+            stocktype=wine)
+        s.add_all([stockline, models.RemoveCode(id='sold', reason='Sold')]
+                  + [models.StockItem(delivery=delivery, stocktype=wine,
+                                      stockunit=bottle)
+                     for i in range(BOTTLES)])
+        s.commit()
+        self.stocklineid = stockline.id
+        s.close()
+        # Don't share our connections with the register processes
+        self._engine.dispose()
+
+    def tearDown(self):
+        # The test data was committed, so it must be removed
+        with self._engine.begin() as conn:
+            conn.execute("TRUNCATE {} CASCADE".format(", ".join(
+                '"{}"'.format(table.name)
+                for table in models.metadata.sorted_tables)))
+
+    def _sell(self, registers, sales_per_register, glasses=1):
+        """Sell from several registers at once
+
+        Returns the number of glasses sold and the time taken.
+        """
+        start = time.time()
+        with multiprocessing.Pool(registers) as pool:
+            sales = pool.starmap(
+                _register,
+                [(self.stocklineid, sales_per_register, glasses)]
+                * registers)
+        elapsed = time.time() - start
+        total = sum(sales)
+        s = sessionmaker(bind=self._engine)()
+        items = s.query(models.StockItem).order_by(models.StockItem.id).all()
+        self.assertEqual(sum(item.used for item in items), total)
+        # An item may only go below zero once every other item has
+        # been used up, and then it must be the last one
+        for item in items[:-1]:
+            self.assertLessEqual(item.used, GLASSES_PER_BOTTLE)
+        if items[-1].used > GLASSES_PER_BOTTLE:
+            for item in items[:-1]:
+                self.assertEqual(item.used, GLASSES_PER_BOTTLE)
+        s.close()
+        return total, elapsed
+
+    def test_concurrent_sales(self):
+        total, elapsed = self._sell(3, 10)
+        self.assertEqual(total, 30)
+
+    def test_concurrent_sales_beyond_stock(self):
+        # Each sale spans several bottles, and between them the
+        # registers sell more than there is
+        total, elapsed = self._sell(3, 10, glasses=25)
+        self.assertEqual(total, 750)
+        self.assertGreater(total, BOTTLES * GLASSES_PER_BOTTLE)
+
+    @dbtest.benchmark
+    def test_benchmark_concurrent_sales(self):
+        total, elapsed = self._sell(REGISTERS, SALES_PER_REGISTER)
+        dbtest.benchmark_log.info(
+            "%d registers made %d sales in %.2fs (%.0f sales/s)",
+            REGISTERS, total, elapsed, total / elapsed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+from . import models
+from . import td
+from . import dbsetup
+from . import dbtest
+import unittest
+import io
+import time
+import yaml
+
+# Changes to some of the records in the template, and some new
+# records, as if the setup file was being re-imported after editing
+_changes = """
+- {model: Business, id: 2, name: Another Chef}
+- {model: Department, id: 12, vatband: B, description: Takeaway}
+- {model: Department, id: 12, minprice: 1.00}
+- {model: StockUnit, id: pin, size: 36.5}
+- {model: PayType, paytype: CASH, description: Cash}
+- {model: StockType, dept_id: 1, manufacturer: A Brewery, name: A Beer,
+   shortname: A Beer, abv: 4.5, unit_id: pt}
+- {model: StockType, dept_id: 6, manufacturer: A Brewery, name: "A \\"Bottle\\"",
+   shortname: A Bottle, unit_id: bottle, saleprice: 3.50,
+   saleprice_units: 1.0}
+- {model: StockType, id: 1, saleprice: 3.20}
+"""
+
+STOCKTYPES = 100000
+
+def _synthetic_catalogue(count):
+    """A setup file with a large stock type catalogue"""
+    f = io.StringIO()
+    f.write(dbsetup.template)
+    for i in range(count):
+        f.write("- {{model: StockType, dept_id: {}, manufacturer: "
+                "Brewery {}, name: Beer {}, shortname: Beer {}, "
+                "abv: {}, unit_id: pt}}\n".format(
+                    i % 4 + 1, i // 100, i, i, i % 10))
+    f.seek(0)
+    return f
+
+class DbSetupTest(dbtest.DatabaseTest):
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.trans = self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        td.s = self.s
+        # Sequences aren't rolled back with the transaction
+        self.s.execute("SELECT setval('stocktypes_seq', 1, false)")
+
+    def tearDown(self):
+        td.s = None
+        self.s.close()
+        self.trans.rollback()
+        self.connection.close()
+
+    def _contents(self):
+        """Contents of all the tables, in a form that can be compared"""
+        contents = {}
+        for table in models.metadata.sorted_tables:
+            contents[table.name] = sorted(
+                tuple(str(x) for x in row)
+                for row in self.s.execute(table.select()))
+        return contents
+
+    def _load(self, load):
+        records = [r for r in yaml.load(dbsetup.template, Loader=yaml.Loader)]
+        load(records)
+        load([r for r in yaml.load(_changes, Loader=yaml.Loader)])
+        return self._contents()
+
+    def test_same_as_merge(self):
+        savepoint = self.s.begin_nested()
+        merged = self._load(dbsetup.merge_records)
+        savepoint.rollback()
+        self.s.execute("SELECT setval('stocktypes_seq', 1, false)")
+        loaded = self._load(dbsetup.bulk_load)
+        self.assertEqual(loaded, merged)
+        self.assertEqual(self.s.query(models.StockType).get(1).saleprice,
+                         models.penny * 320)
+        self.assertEqual(self.s.query(models.Department).count(), 12)
+
+    @dbtest.benchmark
+    def test_benchmark_bulk_load(self):
+        f = _synthetic_catalogue(STOCKTYPES)
+        start = time.time()
+        dbsetup.setup(f)
+        elapsed = time.time() - start
+        self.assertEqual(self.s.query(models.StockType).count(), STOCKTYPES)
+        dbtest.benchmark_log.info("Loaded %d stock types in %.2fs",
+                                  STOCKTYPES, elapsed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,196 @@
+from . import models
+from . import td
+from . import dbtest
+from .delivery import split_cost, import_delivery
+import unittest
+from unittest import mock
+import argparse
+import contextlib
+import datetime
+import io
+import time
+from decimal import Decimal
+
+class DeliveryTest(dbtest.DatabaseTest):
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.trans = self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        td.s = self.s
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=20)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        pint = models.UnitType(id='pt', name='pint')
+        self.beer = models.StockType(
+            manufacturer="A Brewery", name="A Beer", shortname="A Beer",
+            abv=5, unit=pint, department=dept)
+        self.firkin = models.StockUnit(
+            id='firkin', name='Firkin', size=72, unit=pint)
+        self.delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test")
+        self.s.add_all([self.beer, self.firkin, self.delivery])
+        self.s.flush()
+
+    def tearDown(self):
+        td.s = None
+        self.s.close()
+        self.trans.rollback()
+        self.connection.close()
+
+    def test_split_cost(self):
+        self.assertEqual(split_cost(None, 2), [None, None])
+        self.assertEqual(split_cost(Decimal("10.00"), 3),
+                         [Decimal("3.33"), Decimal("3.33"), Decimal("3.34")])
+        self.assertEqual(sum(split_cost(Decimal("100.00"), 7)),
+                         Decimal("100.00"))
+
+    def test_stock_create(self):
+        bestbefore = datetime.date.today()
+        items = td.stock_create(
+            self.delivery, self.beer, self.firkin,
+            split_cost(Decimal("100.00"), 3), bestbefore)
+        self.assertEqual(len(items), 3)
+        self.assertEqual([x.id for x in items],
+                         sorted(x.id for x in items))
+        for item in items:
+            self.assertIs(item.delivery, self.delivery)
+            self.assertIs(item.stocktype, self.beer)
+            self.assertEqual(item.bestbefore, bestbefore)
+        self.assertEqual(self.delivery.items, items)
+        self.assertEqual(self.delivery.costprice, Decimal("100.00"))
+
+    @dbtest.benchmark
+    def test_benchmark_1000_item_delivery(self):
+        costs = split_cost(Decimal("60000.00"), 1000)
+        start = time.perf_counter()
+        for cost in costs:
+            self.s.add(models.StockItem(
+                delivery=self.delivery, stocktype=self.beer,
+                stockunit=self.firkin, costprice=cost))
+            self.s.flush()
+        one_by_one = time.perf_counter() - start
+        start = time.perf_counter()
+        items = td.stock_create(self.delivery, self.beer, self.firkin, costs)
+        bulk = time.perf_counter() - start
+        self.assertEqual(len(items), 1000)
+        self.assertEqual(self.delivery.costprice, Decimal("120000.00"))
+        self.assertLess(bulk, one_by_one)
+        dbtest.benchmark_log.info(
+            "1000 item delivery: %.3fs one by one, %.3fs bulk",
+            one_by_one, bulk)
+
+class ImportDeliveryTest(dbtest.DatabaseTest):
+    use_td = True
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with td.orm_session():
+            business = models.Business(
+                id=1, name='Test', abbrev='TEST', address='An address')
+            vatband = models.VatBand(band='A', business=business, rate=20)
+            dept = models.Department(id=1, description="Test", vat=vatband)
+            pint = models.UnitType(id='pt', name='pint')
+            beer = models.StockType(
+                manufacturer="A Brewery", name="A Beer", shortname="A Beer",
+                abv=5, unit=pint, department=dept)
+            td.s.add_all([
+                beer, models.Supplier(name="Test supplier"),
+                models.StockUnit(id='firkin', name='Firkin', size=72,
+                                 unit=pint)])
+            td.s.flush()
+            cls.beerid = beer.id
+
+    def tearDown(self):
+        with td.orm_session():
+            td.s.query(models.StockItem).delete()
+            td.s.query(models.Delivery).delete()
+
+    def _import(self, csvdata):
+        """Run the import-delivery command on some CSV
+
+        Returns the exit status and what was printed.
+        """
+        args = argparse.Namespace(
+            supplier="Test supplier", docnumber="INV1",
+            csvfile=io.StringIO(csvdata), date=None)
+        out = io.StringIO()
+        with mock.patch.object(td, "init"), contextlib.redirect_stdout(out):
+            status = import_delivery.run(args)
+        return status, out.getvalue()
+
+    def test_import(self):
+        status, out = self._import(
+            "stocktype,manufacturer,name,stockunit,qty,cost,bestbefore\n"
+            "{},,,firkin,3,100.00,2030-01-31\n"
+            ",A Brewery,A Beer,firkin,,,\n".format(self.beerid))
+        self.assertIsNone(status)
+        with td.orm_session():
+            delivery = td.s.query(models.Delivery).one()
+            self.assertIn("Delivery {} created with 4 items.".format(
+                delivery.id), out)
+            self.assertFalse(delivery.checked)
+            self.assertEqual(delivery.docnumber, "INV1")
+            self.assertEqual(delivery.supplier.name, "Test supplier")
+            self.assertEqual(
+                [(i.stocktype.id, i.stockunit.id, i.costprice, i.bestbefore)
+                 for i in delivery.items],
+                [(self.beerid, 'firkin', Decimal("33.33"),
+                  datetime.date(2030, 1, 31)),
+                 (self.beerid, 'firkin', Decimal("33.33"),
+                  datetime.date(2030, 1, 31)),
+                 (self.beerid, 'firkin', Decimal("33.34"),
+                  datetime.date(2030, 1, 31)),
+                 (self.beerid, 'firkin', None, None)])
+
+    def _assert_nothing_imported(self):
+        with td.orm_session():
+            self.assertEqual(td.s.query(models.Delivery).count(), 0)
+            self.assertEqual(td.s.query(models.StockItem).count(), 0)
+
+    def test_unknown_stocktype_and_unit(self):
+        status, out = self._import(
+            "stocktype,manufacturer,name,stockunit\n"
+            "{},,,firkin\n"
+            ",A Brewery,Another Beer,firkin\n"
+            "{},,,barrel\n".format(self.beerid, self.beerid))
+        self.assertEqual(status, 1)
+        # Every problem is reported, not just the first
+        self.assertEqual(out.splitlines(), [
+            "Line 3: stock type ('A Brewery', 'Another Beer') not found",
+            "Line 4: stock unit 'barrel' not found",
+            "Nothing imported."])
+        self._assert_nothing_imported()
+
+    def test_malformed_rows(self):
+        status, out = self._import(
+            "stocktype,stockunit,qty,cost,bestbefore\n"
+            "{0},firkin,two,,\n"
+            "{0},firkin,1,lots,\n"
+            "{0},firkin,1,,31/01/2030\n"
+            "{0},firkin,0,,\n"
+            "beer,firkin,1,,\n".format(self.beerid))
+        self.assertEqual(status, 1)
+        lines = out.splitlines()
+        self.assertEqual([l.split(":")[0] for l in lines[:-1]],
+                         ["Line 2", "Line 3", "Line 4", "Line 5", "Line 6"])
+        self.assertIn("cost 'lots' is not a number", lines[1])
+        self.assertIn("qty must be at least 1", lines[3])
+        self.assertEqual(lines[-1], "Nothing imported.")
+        self._assert_nothing_imported()
+
+    def test_unknown_supplier(self):
+        args = argparse.Namespace(
+            supplier="Nobody", docnumber="INV1",
+            csvfile=io.StringIO(""), date=None)
+        out = io.StringIO()
+        with mock.patch.object(td, "init"), contextlib.redirect_stdout(out):
+            self.assertEqual(import_delivery.run(args), 1)
+        self.assertEqual(out.getvalue(), "Supplier 'Nobody' not found\n")
+        self._assert_nothing_imported()
+
+if __name__ == '__main__':
+    unittest.main()
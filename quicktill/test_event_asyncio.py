@@ -0,0 +1,120 @@
+from . import event_asyncio
+import unittest
+import os
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class SlowServer:
+    """A local HTTP server that takes a while to respond"""
+    def __init__(self, delay):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(delay)
+                body = b"slow response"
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}/slow".format(
+            self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class AsyncioMainLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.mainloop = event_asyncio.AsyncioMainLoop()
+        self.addCleanup(self.mainloop._loop.close)
+
+    def _run(self, until, timeout=5):
+        """Run the main loop until a condition is true"""
+        deadline = time.monotonic() + timeout
+        while not until() and time.monotonic() < deadline:
+            self.mainloop.add_timeout(0.05, lambda: None)
+            self.mainloop.iterate()
+
+    def test_timeouts(self):
+        calls = []
+        self.mainloop.add_timeout(0.2, lambda: calls.append(2))
+        self.mainloop.add_timeout(0.1, lambda: calls.append(1))
+        self.mainloop.add_timeout(0.15, lambda: calls.append("x")).cancel()
+        self._run(lambda: len(calls) == 2)
+        self.assertEqual(calls, [1, 2])
+
+    def test_call_from_thread(self):
+        calls = []
+        t = threading.Thread(target=lambda: self.mainloop.call_from_thread(
+            lambda: calls.append(threading.current_thread())))
+        t.start()
+        t.join()
+        self.mainloop.iterate()
+        self.assertEqual(calls, [threading.main_thread()])
+
+    def test_exception_raised_from_iterate(self):
+        def fail():
+            raise ValueError("callback failed")
+        self.mainloop.add_timeout(0, fail)
+        with self.assertRaises(ValueError):
+            self.mainloop.iterate()
+
+    def test_slow_http_does_not_delay_keypresses(self):
+        server = SlowServer(1.0)
+        self.addCleanup(server.close)
+        responses = []
+        self.mainloop.run_coroutine(
+            event_asyncio.http_request(server.url),
+            result=responses.append)
+
+        # Keypresses arrive on a pipe, as they do from the terminal
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        handled = []
+        def keypress():
+            os.read(r, 1)
+            handled.append(time.monotonic())
+        self.mainloop.add_fd(r, keypress)
+        sent = []
+        def type_keys():
+            for i in range(5):
+                time.sleep(0.1)
+                sent.append(time.monotonic())
+                os.write(w, b"k")
+        typist = threading.Thread(target=type_keys)
+        typist.start()
+
+        self._run(lambda: responses and len(handled) == 5)
+        typist.join()
+        self.assertEqual(len(handled), 5)
+        # Each keypress was handled straight away, while we were
+        # waiting for the response
+        for s, h in zip(sent, handled):
+            self.assertLess(h - s, 0.1)
+        status, headers, body = responses[0]
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Type'], 'text/plain')
+        self.assertEqual(body, b"slow response")
+
+    def test_coroutine_error(self):
+        server = SlowServer(1.0)
+        self.addCleanup(server.close)
+        errors = []
+        self.mainloop.run_coroutine(
+            event_asyncio.http_request(server.url, timeout=0.2),
+            error=errors.append)
+        self._run(lambda: errors)
+        self.assertIsInstance(errors[0], event_asyncio.asyncio.TimeoutError)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+from . import foodorder
+from . import event
+from . import tillconfig
+import unittest
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeMenuServer:
+    """A local HTTP server that serves a food menu with an ETag"""
+    def __init__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with fake._lock:
+                    fake.requests.append(self.headers.get('If-None-Match'))
+                    etag = '"{}"'.format(fake.version)
+                if fake.error:
+                    self.send_error(500)
+                    return
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = fake.source().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/x-python')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}/menu.py".format(
+            self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.reset()
+
+    def reset(self):
+        self.version = 1
+        self.broken = False
+        self.error = False
+        self.requests = []
+
+    def source(self):
+        if self.broken:
+            return "menu = [\n"
+        return "version = {}\nmenu = []\n".format(self.version)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class MenuCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeMenuServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.close()
+
+    def setUp(self):
+        self.fake.reset()
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._old_cache_dir = tillconfig.cache_dir
+        tillconfig.cache_dir = self._tmpdir.name
+        self._old_interval = foodorder.menu_check_interval
+        foodorder.menu_check_interval = 0
+        self.cache = foodorder._menucache()
+
+    def tearDown(self):
+        foodorder.menu_check_interval = self._old_interval
+        tillconfig.cache_dir = self._old_cache_dir
+        self._tmpdir.cleanup()
+
+    def _run(self, until, timeout=5):
+        """Run the main loop until a condition is true"""
+        deadline = time.monotonic() + timeout
+        while not until() and time.monotonic() < deadline:
+            tillconfig.mainloop.add_timeout(0.05, lambda: None)
+            tillconfig.mainloop.iterate()
+
+    def test_first_fetch(self):
+        menu = self.cache.get(self.fake.url)
+        self.assertEqual(menu.version, 1)
+        self.assertEqual(self.fake.requests, [None])
+
+    def test_unchanged(self):
+        first = self.cache.get(self.fake.url)
+        # The menu we already have is returned straight away, and we
+        # check for a new one with a conditional request
+        self.assertIs(self.cache.get(self.fake.url), first)
+        self._run(lambda: not self.cache.checking)
+        self.assertEqual(self.fake.requests, [None, '"1"'])
+        self.assertIs(self.cache.module, first)
+
+    def test_updated(self):
+        self.cache.get(self.fake.url)
+        self.fake.version = 2
+        menu = self.cache.get(self.fake.url)
+        self.assertEqual(menu.version, 1)
+        self._run(lambda: not self.cache.checking)
+        self.assertEqual(self.cache.get(self.fake.url).version, 2)
+
+    def test_broken_update(self):
+        self.cache.get(self.fake.url)
+        self.fake.version = 2
+        self.fake.broken = True
+        self.cache.get(self.fake.url)
+        self._run(lambda: not self.cache.checking)
+        # We carry on using the old menu
+        self.assertEqual(self.cache.module.version, 1)
+
+    def test_server_error(self):
+        self.cache.get(self.fake.url)
+        self.fake.version = 2
+        self.fake.error = True
+        self.cache.get(self.fake.url)
+        with self.assertLogs("quicktill.foodorder", "WARNING") as cm:
+            self._run(lambda: not self.cache.checking)
+        self.assertIn("500", cm.output[0])
+        # We carry on using the old menu, and check again later
+        self.assertEqual(self.cache.module.version, 1)
+        self.fake.error = False
+        self.cache.get(self.fake.url)
+        self._run(lambda: not self.cache.checking)
+        self.assertEqual(self.cache.module.version, 2)
+
+    def test_disk_cache(self):
+        self.cache.get(self.fake.url)
+        self.fake.version = 2
+        self.cache.get(self.fake.url)
+        self._run(lambda: not self.cache.checking)
+        # After a restart the saved menu is used straight away
+        restarted = foodorder._menucache()
+        self.assertEqual(restarted.get(self.fake.url).version, 2)
+        self._run(lambda: not restarted.checking)
+        self.assertEqual(self.fake.requests[-1], '"2"')
+
+if __name__ == '__main__':
+    unittest.main()
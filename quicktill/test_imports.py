@@ -0,0 +1,51 @@
+import unittest
+import subprocess
+import sys
+import os
+
+# Modules that tills only need for particular printers or
+# integrations; they must not be imported just to start the till
+LAZY_MODULES = ["reportlab", "cups", "qrcode", "twython", "requests",
+                "requests_oauthlib", "oauthlib", "gi", "cairo"]
+
+# Maximum time to import quicktill.till, in microseconds.  Set
+# QUICKTILL_IMPORT_BUDGET to override this on slow machines.
+IMPORT_BUDGET = int(os.environ.get("QUICKTILL_IMPORT_BUDGET", 1500000))
+
+def importtime(module):
+    """Import module in a new interpreter using python -X importtime
+
+    Returns a dict of module name to cumulative import time in
+    microseconds.
+    """
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import {}".format(module)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    times = {}
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+class ImportTimeTest(unittest.TestCase):
+    def test_till_import(self):
+        # The first import may have to write bytecode files; don't
+        # count it
+        importtime("quicktill.till")
+        times = importtime("quicktill.till")
+        for name in times:
+            self.assertNotIn(name.split('.')[0], LAZY_MODULES,
+                             "{} imported by quicktill.till".format(name))
+        self.assertLess(times["quicktill.till"], IMPORT_BUDGET,
+                        "quicktill.till took {:.3f}s to import".format(
+                            times["quicktill.till"] / 1000000))
+
+if __name__ == '__main__':
+    unittest.main()
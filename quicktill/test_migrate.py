@@ -0,0 +1,195 @@
+from . import models
+from . import td
+from . import migrate
+from . import dbutils
+from . import dbtest
+import unittest
+import datetime
+from sqlalchemy.exc import DBAPIError
+
+LINES = 5000
+
+class Interrupted(Exception):
+    pass
+
+class InterruptedTranslineText(dbutils.TranslineText):
+    """Fills in transaction line text, but stops after a few batches"""
+    name = "test-interrupted"
+    batch_size = 500
+    batches_left = 3
+
+    def migrate(self, s, lines):
+        if self.batches_left == 0:
+            raise Interrupted()
+        self.batches_left -= 1
+        super().migrate(s, lines)
+
+class TestTranslineText(dbutils.TranslineText):
+    name = "test-transline-text"
+    batch_size = 500
+
+class MigrateTest(dbtest.DatabaseTest):
+    use_td = True
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with td.orm_session():
+            business = models.Business(
+                id=1, name='Test', abbrev='TEST', address='An address')
+            vatband = models.VatBand(band='A', business=business, rate=20)
+            td.s.add_all([
+                business, vatband,
+                models.Department(id=1, description="Test", vat=vatband),
+                models.TransCode(code='S', description='Sale'),
+                models.Session(datetime.date.today())])
+
+    def setUp(self):
+        # Migrations commit as they go, so the lines to migrate must
+        # be committed too
+        with td.orm_session():
+            td.s.execute(
+                "INSERT INTO transactions (transid, sessionid, notes, closed) "
+                "VALUES (nextval('transactions_seq'), "
+                "(SELECT max(sessionid) FROM sessions), '', false)")
+            td.s.execute(
+                "INSERT INTO translines "
+                "(translineid, transid, items, amount, dept, transcode) "
+                "SELECT nextval('translines_seq'), "
+                "currval('transactions_seq'), 1, 1.00, 1, 'S' "
+                "FROM generate_series(1, :lines)", {'lines': LINES})
+
+    def tearDown(self):
+        with td.orm_session():
+            td.s.query(models.MigrationProgress).delete()
+            td.s.query(models.Transline).delete()
+            td.s.query(models.Transaction).delete()
+
+    def _lines_without_text(self):
+        with td.orm_session():
+            return td.s.query(models.Transline)\
+                       .filter(models.Transline.text == None)\
+                       .count()
+
+    def test_migrate(self):
+        self.assertEqual(migrate.run(TestTranslineText()), LINES)
+        self.assertEqual(self._lines_without_text(), 0)
+        self.assertEqual(migrate.status(TestTranslineText.name),
+                         (LINES, 1, 1))
+        # Running a finished migration again does nothing
+        self.assertEqual(migrate.run(TestTranslineText()), 0)
+
+    def test_resume(self):
+        with self.assertRaises(Interrupted):
+            migrate.run(InterruptedTranslineText())
+        self.assertEqual(migrate.status(InterruptedTranslineText.name),
+                         (1500, 1, 0))
+        self.assertEqual(self._lines_without_text(), LINES - 1500)
+        m = InterruptedTranslineText()
+        m.batches_left = LINES
+        self.assertEqual(migrate.run(m), LINES - 1500)
+        self.assertEqual(self._lines_without_text(), 0)
+        self.assertEqual(migrate.status(InterruptedTranslineText.name),
+                         (LINES, 1, 1))
+
+    def test_parallel(self):
+        self.assertEqual(migrate.run(TestTranslineText(), workers=4,
+                                     database=dbtest.TEST_DATABASE_URL), LINES)
+        self.assertEqual(self._lines_without_text(), 0)
+        self.assertEqual(migrate.status(TestTranslineText.name),
+                         (LINES, 4, 4))
+
+    def test_migration_is_abstract(self):
+        with self.assertRaises(TypeError):
+            migrate.Migration()
+        self.assertNotIn(None, migrate.migrations())
+
+    def test_schema_migration(self):
+        # Put back the rule used by earlier versions
+        with td.orm_session():
+            td.s.execute("DROP TRIGGER log_stocktype ON stock")
+            td.s.execute(
+                "CREATE RULE log_stocktype AS ON UPDATE TO stock "
+                "WHERE NEW.stocklineid IS NOT NULL DO ALSO "
+                "INSERT INTO stockline_stocktype_log "
+                "VALUES (NEW.stocklineid, NEW.stocktype)")
+        m = dbutils.StocktypeLogTrigger()
+        self.assertEqual(migrate.run(m), 0)
+        with td.orm_session():
+            rules = td.s.execute(
+                "SELECT count(*) FROM pg_rules "
+                "WHERE rulename='log_stocktype'").scalar()
+            triggers = td.s.execute(
+                "SELECT count(*) FROM pg_trigger "
+                "WHERE tgname='log_stocktype'").scalar()
+        self.assertEqual((rules, triggers), (0, 1))
+        self.assertEqual(migrate.status(m.name), (0, 1, 1))
+        # It is only applied once
+        self.assertFalse(migrate.apply_schema(m))
+
+    def test_pullthru_index(self):
+        with td.orm_session():
+            td.s.execute("DROP INDEX stockout_pullthru_key")
+        self.assertTrue(migrate.apply_schema(dbutils.PullthruIndex()))
+        with td.orm_session():
+            self.assertTrue(migrate.relation_exists(
+                td.s, "stockout_pullthru_key"))
+
+    def test_stockline_sale_function(self):
+        self.assertTrue(migrate.apply_schema(dbutils.StocklineSaleFunction()))
+        with td.orm_session():
+            self.assertEqual(td.s.execute(
+                "SELECT count(*) FROM pg_proc "
+                "WHERE proname = 'stockline_sale'").scalar(), 1)
+
+    def test_partition_tables(self):
+        # Turn the tables back into the unpartitioned tables of
+        # earlier versions
+        with td.orm_session():
+            td.s.execute("DROP TRIGGER set_partition_bounds ON sessions")
+            td.s.execute("ALTER TABLE sessions DROP COLUMN translines_from, "
+                         "DROP COLUMN payments_from, DROP COLUMN archived")
+            for table, key, seq, size in models.partitioned_tables:
+                td.s.execute(
+                    'CREATE TABLE "{0}_plain" (LIKE "{0}" '
+                    'INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'.format(table))
+                td.s.execute('INSERT INTO "{0}_plain" '
+                             'SELECT * FROM "{0}"'.format(table))
+            td.s.execute("DROP TABLE stockout, payments, translines CASCADE")
+            for table, key, seq, size in models.partitioned_tables:
+                td.s.execute('ALTER TABLE "{0}_plain" '
+                             'RENAME TO "{0}"'.format(table))
+                td.s.execute('ALTER TABLE "{}" ADD PRIMARY KEY ("{}")'.format(
+                    table, key))
+        self.assertTrue(migrate.apply_schema(dbutils.PartitionTables()))
+        with td.orm_session():
+            self.assertEqual(td.s.query(models.Transline).count(), LINES)
+            self.assertEqual(
+                [name for name, lower, upper
+                 in dbutils.partitions(td.s, "translines")],
+                ["translines_0", "translines_1"])
+            session = models.Session.current(td.s)
+            self.assertEqual(session.translines_from, 0)
+            self.assertEqual(session.total, LINES)
+        # Safe to apply to a database that is already partitioned
+        with td.orm_session():
+            td.s.query(models.MigrationProgress).delete()
+        self.assertTrue(migrate.apply_schema(dbutils.PartitionTables()))
+
+    def test_outbox_batch_key(self):
+        with td.orm_session():
+            td.s.execute("ALTER TABLE accounts_outbox DROP COLUMN batch_key")
+        self.assertTrue(migrate.apply_schema(dbutils.OutboxBatchKey()))
+        with td.orm_session():
+            self.assertEqual(td.s.query(models.AccountsOutbox).count(), 0)
+
+    def test_statement_triggers(self):
+        # Safe to apply to a database that already has the new schema
+        self.assertTrue(migrate.apply_schema(dbutils.StatementTriggers()))
+        # There is already an open session
+        with self.assertRaises(DBAPIError):
+            with td.orm_session():
+                td.s.add(models.Session(datetime.date.today()))
+
+if __name__ == '__main__':
+    unittest.main()
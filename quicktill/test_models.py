@@ -1,39 +1,16 @@
 from . import models
+from . import td
+from . import dbtest
+from . import usestock
 import unittest
 import datetime
+import time
+from unittest import mock
 from decimal import Decimal
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError
 
-TEST_DATABASE_NAME = "quicktill-test"
-
-class ModelTest(unittest.TestCase):
-    @classmethod
-    def setUpClass(cls):
-        # Create the test database
-        engine = create_engine("postgresql+psycopg2:///postgres")
-        conn = engine.connect()
-        conn.execute('commit')
-        conn.execute('create database "{}"'.format(TEST_DATABASE_NAME))
-        conn.close()
-        cls._engine = create_engine("postgresql+psycopg2:///{}".format(
-            TEST_DATABASE_NAME))
-        models.metadata.bind = cls._engine
-        models.metadata.create_all()
-        cls._sm = sessionmaker()
-
-    @classmethod
-    def tearDownClass(cls):
-        # Dispose of the connection pool, closing all checked-in connections
-        cls._engine.dispose()
-        del cls._engine
-        engine = create_engine("postgresql+psycopg2:///postgres")
-        conn = engine.connect()
-        conn.execute('commit')
-        conn.execute('drop database "{}"'.format(TEST_DATABASE_NAME))
-        conn.close()
-
+class ModelTest(dbtest.DatabaseTest):
     def setUp(self):
         self.connection = self._engine.connect()
         self.trans = self.connection.begin()
@@ -211,6 +188,58 @@ class ModelTest(unittest.TestCase):
         self.assertIsNone(transline.voided_by_id)
         self.assertEqual(trans.balance, Decimal("10.00"))
 
+    def test_transline_void_lines(self):
+        self.template_setup()
+        trans = models.Transaction(
+            session=models.Session(datetime.date.today()))
+        lines = [models.Transline(
+            transaction=trans, items=1, amount=Decimal("10.00"), dept_id=1,
+            transcode='S', text="Test sale") for i in range(5)]
+        self.s.add_all(lines)
+        self.s.commit()
+        already = lines[0].void(trans, None)
+        self.s.commit()
+        updates = []
+        def count_updates(conn, cursor, statement, *args):
+            if statement.startswith("UPDATE translines"):
+                updates.append(statement)
+        event.listen(self.s.bind, "before_cursor_execute", count_updates)
+        try:
+            voids = models.Transline.void_lines(self.s, lines, trans, None)
+        finally:
+            event.remove(self.s.bind, "before_cursor_execute",
+                         count_updates)
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(len(voids), 4)
+        self.s.commit()
+        self.assertEqual([l.voided_by for l in lines], [already] + voids)
+        self.assertEqual(voids[0].voids, lines[1])
+        self.assertEqual(trans.balance, Decimal("0.00"))
+
+    def test_vatband_totals_for_sessions(self):
+        self.template_setup()
+        self.s.add(models.VatRate(band='A', businessid=1, rate=5,
+                                  active=datetime.date(2020, 7, 15)))
+        sessions = []
+        for date in (datetime.date(2020, 7, 14), datetime.date(2020, 7, 15)):
+            session = models.Session(date)
+            session.endtime = datetime.datetime.now()
+            trans = models.Transaction(session=session)
+            self.s.add(models.Transline(
+                transaction=trans, items=2, amount=Decimal("3.50"),
+                dept_id=1, transcode='S', text="Test sale"))
+            sessions.append(session)
+        # A session with no transactions
+        sessions.append(models.Session(datetime.date(2020, 7, 16)))
+        self.s.add_all(sessions)
+        self.s.commit()
+        totals = models.Session.vatband_totals_for_sessions(self.s, sessions)
+        for session in sessions:
+            self.assertEqual(totals[session.id], session.vatband_totals)
+        self.assertEqual(totals[sessions[0].id][0][3], Decimal("0.01"))
+        self.assertEqual(totals[sessions[1].id][0][3], Decimal("0.33"))
+        self.assertEqual(totals[sessions[2].id], [])
+
     def test_delivery_costprice(self):
         self.template_setup()
         beer = self.template_stocktype_setup()
@@ -237,5 +266,339 @@ class ModelTest(unittest.TestCase):
         self.s.commit()
         self.assertIsNone(delivery.costprice)
 
+    def template_display_stock_setup(self):
+        """Add a display stockline with some stock on sale."""
+        self.template_setup()
+        beer = self.template_stocktype_setup()
+        case24 = models.StockUnit(
+            id='case', name='Case', size=24, unit_id='pt')
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test", checked=True)
+        stockline = models.StockLine(
+            name="Test", location="Test", linetype="display",
+            capacity=30, stocktype=beer)
+        removecode = models.RemoveCode(id='test', reason='Test')
+        items = [models.StockItem(delivery=delivery, stocktype=beer,
+                                  stockunit=case24, stockline=stockline)
+                 for i in range(3)]
+        items[0].displayqty = 8
+        self.s.add_all(items + [removecode])
+        self.s.commit()
+        self.s.add(models.StockOut(stockitem=items[0], qty=6,
+                                   removecode=removecode))
+        self.s.commit()
+        return stockline, items
+
+    def test_calculate_restock_for_lines(self):
+        stockline, items = self.template_display_stock_setup()
+        for target in (None, 0, 2, 5, 100):
+            expected = stockline.calculate_restock(target)
+            moves = models.StockLine.calculate_restock_for_lines(
+                self.s, [stockline], target)
+            self.assertEqual(moves.get(stockline.id, []), expected)
+        moves = models.StockLine.calculate_restock_for_lines(
+            self.s, [stockline])
+        self.assertEqual(moves[stockline.id], [
+            (items[0], 16, 24, 0),
+            (items[1], 12, 12, 12)])
+
+    def test_auto_allocate_plan(self):
+        stockline, items = self.template_display_stock_setup()
+        beer = stockline.stocktype
+        delivery = items[0].delivery
+        cider = models.StockType(
+            manufacturer="A Cidery", name="A Cider", shortname="A Cider",
+            abv=5, unit_id='pt', dept_id=1)
+        cider_lines = [models.StockLine(
+            name="Cider {}".format(i), location="Test", linetype="display",
+            capacity=10, stocktype=cider) for i in range(2)]
+        unchecked = models.Delivery(
+            date=datetime.date.today(), supplier=delivery.supplier,
+            docnumber="unchecked")
+        beer_item = models.StockItem(delivery=delivery, stocktype=beer,
+                                     stockunit_id='case')
+        cider_item = models.StockItem(delivery=delivery, stocktype=cider,
+                                      stockunit_id='case')
+        unchecked_item = models.StockItem(delivery=unchecked, stocktype=beer,
+                                          stockunit_id='case')
+        self.s.add_all(cider_lines + [beer_item, cider_item, unchecked_item])
+        self.s.commit()
+        plan = models.StockLine.auto_allocate_plan(self.s)
+        self.assertEqual(plan, [(beer_item, [stockline]),
+                                (cider_item, cider_lines)])
+        self.assertEqual(
+            models.StockLine.auto_allocate_plan(self.s, unchecked.id), [])
+        # Stock that must be used soonest comes first
+        cider_item.bestbefore = datetime.date.today()
+        self.s.commit()
+        plan = models.StockLine.auto_allocate_plan(self.s)
+        self.assertEqual(plan, [(cider_item, cider_lines),
+                                (beer_item, [stockline])])
+
+    def test_auto_allocate_more_than_one_line(self):
+        stockline, items = self.template_display_stock_setup()
+        cider = models.StockType(
+            manufacturer="A Cidery", name="A Cider", shortname="A Cider",
+            abv=5, unit_id='pt', dept_id=1)
+        cider_lines = [models.StockLine(
+            name="Cider {}".format(i), location="Test", linetype="display",
+            capacity=10, stocktype=cider) for i in range(2)]
+        cider_item = models.StockItem(delivery=items[0].delivery,
+                                      stocktype=cider, stockunit_id='case')
+        self.s.add_all(cider_lines + [cider_item])
+        self.s.commit()
+        td.s = self.s
+        try:
+            with mock.patch.object(usestock.user, "current_dbuser",
+                                   return_value=None), \
+                 mock.patch.object(usestock.ui, "infopopup") as popup:
+                usestock.auto_allocate_internal()
+        finally:
+            td.s = None
+        self.assertIsNone(cider_item.stockline)
+        msg = popup.call_args[0][0]
+        self.assertIn("{} {} -> Cider 0 or Cider 1".format(
+            cider_item.id, cider.format()), msg)
+
+    def test_stockline_sale_function_display(self):
+        stockline, items = self.template_display_stock_setup()
+        trans = models.Transaction(
+            session=models.Session(datetime.date.today()))
+        self.s.add(trans)
+        self.s.commit()
+        sell, unallocated, remaining = stockline.calculate_sale(Decimal(2))
+        td.s = self.s
+        try:
+            result = td.stockline_sale(
+                trans.id, stockline.id, Decimal(1), 2, Decimal("3.00"), 1,
+                "Test sale", None)
+            self.assertEqual([(r.sale_stockid, r.sale_qty) for r in result],
+                             [(item.id, qty) for item, qty in sell])
+            r = result[0]
+            self.assertEqual((r.sale_remaining, r.sale_instock), remaining)
+            self.assertFalse(r.sale_repeated)
+            self.assertEqual(len(trans.lines), 1)
+            self.assertEqual(trans.lines[0].items, 2)
+            self.assertEqual(trans.total, Decimal("6.00"))
+            # There's nothing left on display
+            result = td.stockline_sale(
+                trans.id, stockline.id, Decimal(1), 1, Decimal("3.00"), 1,
+                "Test sale", None)
+            self.assertEqual(len(result), 1)
+            self.assertIsNone(result[0].sale_stockid)
+            self.assertEqual(result[0].sale_unallocated, 1)
+            self.s.expire(trans)
+            self.assertEqual(len(trans.lines), 1)
+        finally:
+            td.s = None
+
+    def test_stockline_sale_function_continuous_repeat(self):
+        stockline, items = self.template_display_stock_setup()
+        wine = models.StockLine(
+            name="Wine", location="Test", linetype="continuous",
+            stocktype=stockline.stocktype)
+        loose = [models.StockItem(delivery=items[0].delivery,
+                                  stocktype=stockline.stocktype,
+                                  stockunit_id='case') for i in range(2)]
+        trans = models.Transaction(
+            session=models.Session(datetime.date.today()))
+        self.s.add_all([wine, trans] + loose)
+        self.s.commit()
+        sell, unallocated, remaining = wine.calculate_sale(Decimal(30))
+        td.s = self.s
+        try:
+            result = td.stockline_sale(
+                trans.id, wine.id, Decimal(30), 1, Decimal("3.00"), 1,
+                "Test sale", None)
+            self.assertEqual([(r.sale_stockid, r.sale_qty) for r in result],
+                             [(item.id, qty) for item, qty in sell])
+            self.assertEqual(result[0].sale_remaining, remaining)
+            # Selling the same again extends the transaction line
+            # instead of adding a new one, but only if it comes from
+            # a single stock item
+            first = result[0]
+            result = td.stockline_sale(
+                trans.id, wine.id, Decimal(30), 1,
+                Decimal("3.00"), 1, "Test sale", None,
+                first.sale_translineid)
+            self.assertFalse(result[0].sale_repeated)
+            result = td.stockline_sale(
+                trans.id, wine.id, Decimal(1), 1,
+                Decimal("3.00"), 1, "Test sale", None,
+                result[0].sale_translineid)
+            self.assertFalse(result[0].sale_repeated)
+            tl = models.Transline(
+                transaction=trans,
+                items=1, amount=Decimal("3.00"), dept_id=1,
+                transcode='S', text="Test sale")
+            self.s.add(tl)
+            self.s.flush()
+            self.s.add(models.StockOut(transline=tl, stockitem=loose[1],
+                                       qty=1, removecode_id='sold'))
+            result = td.stockline_sale(
+                trans.id, wine.id, Decimal(1), 1,
+                Decimal("3.00"), 1, "Test sale", None, tl.id)
+            self.assertTrue(result[0].sale_repeated)
+            self.s.expire(tl)
+            self.assertEqual(tl.items, 2)
+        finally:
+            td.s = None
+
+    def test_stockline_sale_function_continuous_same_as_python(self):
+        # stockline_sale() must choose the same stock as
+        # StockLine.calculate_sale(), including which items it leaves
+        # alone and which it sells beyond the end of
+        stockline, items = self.template_display_stock_setup()
+        beer = stockline.stocktype
+        delivery = items[0].delivery
+        cider = models.StockType(
+            manufacturer="A Cidery", name="A Cider", shortname="A Cider",
+            abv=5, unit_id='pt', dept_id=1)
+        unchecked = models.Delivery(
+            date=datetime.date.today(), supplier=delivery.supplier,
+            docnumber="unchecked")
+        wine = models.StockLine(
+            name="Wine", location="Test", linetype="continuous",
+            stocktype=beer)
+        loose = [models.StockItem(delivery=delivery, stocktype=beer,
+                                  stockunit_id='case') for i in range(4)]
+        loose[1].finished = datetime.datetime.now()
+        loose[1].finishcode = models.FinishCode(
+            id='empty', description='All gone')
+        others = [
+            models.StockItem(delivery=unchecked, stocktype=beer,
+                             stockunit_id='case'),
+            models.StockItem(delivery=delivery, stocktype=cider,
+                             stockunit_id='case'),
+        ]
+        trans = models.Transaction(
+            session=models.Session(datetime.date.today()))
+        self.s.add_all([wine, trans] + loose + others)
+        self.s.commit()
+        # An item that has already been emptied is passed over
+        self.s.add(models.StockOut(stockitem=loose[0], qty=24,
+                                   removecode_id='sold'))
+        self.s.commit()
+        td.s = self.s
+        try:
+            for qty in (5, 30, 20, 10, 3):
+                self.s.expire_all()
+                sell, unallocated, remaining = wine.calculate_sale(
+                    Decimal(qty))
+                result = td.stockline_sale(
+                    trans.id, wine.id, Decimal(qty), 1, Decimal("3.00"), 1,
+                    "Test sale", None)
+                self.assertEqual(
+                    [(r.sale_stockid, r.sale_qty) for r in result],
+                    [(item.id, sellqty) for item, sellqty in sell])
+                self.assertEqual(result[0].sale_unallocated, unallocated)
+                self.assertEqual(result[0].sale_remaining, remaining)
+        finally:
+            td.s = None
+        # The last sales went beyond the end of the stock, into the
+        # last item only
+        self.s.expire_all()
+        self.assertEqual([item.remaining for item in loose],
+                         [0, 24, 0, -20])
+        self.assertEqual([item.remaining for item in items + others],
+                         [18, 24, 24, 24, 24])
+
+    def test_stockline_sale_function_pullthru(self):
+        stockline, items = self.template_display_stock_setup()
+        beer = models.StockLine(
+            name="Beer", location="Test", linetype="regular",
+            pullthru=Decimal("0.5"), stocktype=stockline.stocktype)
+        items[0].stockline = beer
+        trans = models.Transaction(
+            session=models.Session(datetime.date.today()))
+        self.s.add_all([beer, trans, models.StockOut(
+            stockitem=items[0], qty=1, removecode_id='sold',
+            time=datetime.datetime.now() - datetime.timedelta(hours=12))])
+        self.s.commit()
+        td.s = self.s
+        try:
+            result = td.stockline_sale(
+                trans.id, beer.id, Decimal(1), 1, Decimal("3.00"), 1,
+                "Test sale", None, None, datetime.timedelta(hours=11))
+            self.assertTrue(result[0].sale_pullthru)
+            result = td.stockline_sale(
+                trans.id, beer.id, Decimal(1), 1, Decimal("3.00"), 1,
+                "Test sale", None, None, datetime.timedelta(hours=11))
+            self.assertFalse(result[0].sale_pullthru)
+            # The check is skipped when the caller knows the answer
+            result = td.stockline_sale(
+                trans.id, beer.id, Decimal(1), 1, Decimal("3.00"), 1,
+                "Test sale", None)
+            self.assertFalse(result[0].sale_pullthru)
+        finally:
+            td.s = None
+
+    def test_stockline_stocktype_log(self):
+        stockline, items = self.template_display_stock_setup()
+        log = self.s.query(models.StockLineTypeLog)
+        # Stock updates that don't change the stockline or stocktype
+        # don't touch the log
+        items[1].displayqty = 5
+        self.s.commit()
+        self.assertEqual(log.count(), 0)
+        other = models.StockLine(
+            name="Other", location="Test", linetype="display",
+            capacity=10, stocktype=stockline.stocktype)
+        self.s.add(other)
+        items[2].stockline = other
+        self.s.commit()
+        items[2].stockline = stockline
+        self.s.commit()
+        self.assertEqual(
+            sorted((x.stocklineid, x.stocktype_id) for x in log.all()),
+            [(stockline.id, stockline.stocktype.id),
+             (other.id, stockline.stocktype.id)])
+        # Moving back to a line already logged isn't an error
+        items[2].stockline = other
+        self.s.commit()
+        self.assertEqual(log.count(), 2)
+
+    def _time_stock_updates(self, items, rounds):
+        start = time.time()
+        for i in range(rounds):
+            for item in items:
+                self.s.execute(
+                    "UPDATE stock SET displayqty=:qty WHERE stockid=:id",
+                    {'qty': i + 1, 'id': item.id})
+        return time.time() - start
+
+    @dbtest.benchmark
+    def test_benchmark_stock_update_logging(self):
+        stockline, items = self.template_display_stock_setup()
+        items = items + [models.StockItem(
+            delivery=items[0].delivery, stocktype=stockline.stocktype,
+            stockunit_id='case', stockline=stockline) for i in range(97)]
+        self.s.add_all(items)
+        self.s.commit()
+        rounds = 20
+        updates = rounds * len(items)
+        after = self._time_stock_updates(items, rounds)
+        # Put back the rules used before the log_stocktype trigger
+        self.s.execute("DROP TRIGGER log_stocktype ON stock")
+        self.s.execute("""
+CREATE RULE ignore_duplicate_stockline_types AS
+       ON INSERT TO stockline_stocktype_log
+       WHERE (NEW.stocklineid,NEW.stocktype)
+       IN (SELECT stocklineid,stocktype FROM stockline_stocktype_log)
+       DO INSTEAD NOTHING""")
+        self.s.execute("""
+CREATE RULE log_stocktype AS ON UPDATE TO stock
+       WHERE NEW.stocklineid is not null
+       DO ALSO
+       INSERT INTO stockline_stocktype_log VALUES
+       (NEW.stocklineid,NEW.stocktype)""")
+        before = self._time_stock_updates(items, rounds)
+        dbtest.benchmark_log.info(
+            "%d stock updates: %.0f/s with rules, %.0f/s with trigger",
+            updates, updates / before, updates / after)
+        self.assertEqual(self.s.query(models.StockLineTypeLog).count(), 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,232 @@
+from . import models
+from . import dbutils
+from . import dbtest
+import unittest
+import datetime
+from decimal import Decimal
+from sqlalchemy.exc import IntegrityError
+
+class PartitionTest(dbtest.DatabaseTest):
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.trans = self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=20)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        pint = models.UnitType(id='pt', name='pint')
+        beer = models.StockType(
+            manufacturer="A Brewery", name="A Beer", shortname="A Beer",
+            abv=5, unit=pint, department=dept)
+        firkin = models.StockUnit(
+            id='firkin', name='Firkin', size=72, unit=pint)
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test")
+        self.item = models.StockItem(
+            delivery=delivery, stocktype=beer, stockunit=firkin)
+        self.s.add_all([
+            business, vatband, dept, self.item,
+            models.TransCode(code='S', description='Sale'),
+            models.PayType(paytype='CASH', description='Cash'),
+            models.RemoveCode(id='sold', reason='Sold'),
+            models.FinishCode(id='empty', description='All gone')])
+        self.s.flush()
+
+    def tearDown(self):
+        self.s.close()
+        self.trans.rollback()
+        self.connection.close()
+
+    def _partition_names(self, table):
+        return [name for name, lower, upper
+                in dbutils.partitions(self.s, table)]
+
+    def _sale(self, session, time):
+        """Sell a pint in a new transaction in a session
+
+        Returns the transaction line.
+        """
+        t = models.Transaction(session=session)
+        line = models.Transline(transaction=t, items=1, amount=Decimal(3),
+                                dept_id=1, transcode='S', time=time)
+        self.s.add_all([
+            t, line,
+            models.StockOut(stockitem=self.item, qty=Decimal(1),
+                            removecode_id='sold', transline=line, time=time),
+            models.Payment(transaction=t, amount=Decimal(3),
+                           paytype_id='CASH', time=time)])
+        self.s.flush()
+        t.closed = True
+        self.s.flush()
+        return line
+
+    def _start_next_partitions(self):
+        """Move the sequences on so that new records go in partition 1"""
+        for table, key, seq, size in models.partitioned_tables:
+            self.s.execute("SELECT setval(:seq, :value)",
+                           {'seq': seq, 'value': size - 1})
+        self.s.execute("SELECT add_partitions()")
+
+    def _old_and_current_sessions(self):
+        then = datetime.datetime.now() - datetime.timedelta(days=730)
+        old = models.Session(then.date())
+        old.starttime = then
+        self.s.add(old)
+        self.s.flush()
+        oldline = self._sale(old, then)
+        old.endtime = then + datetime.timedelta(hours=8)
+        self.s.flush()
+        self._start_next_partitions()
+        current = models.Session(datetime.date.today())
+        self.s.add(current)
+        self.s.flush()
+        line = self._sale(current, datetime.datetime.now())
+        return old, oldline, current, line
+
+    def _explain(self, query, params={}, analyze=False):
+        return "\n".join(r[0] for r in self.s.execute(
+            ("EXPLAIN ANALYZE " if analyze else "EXPLAIN ") + query, params))
+
+    def test_initial_partitions(self):
+        for table, key, seq, size in models.partitioned_tables:
+            self.assertEqual(self._partition_names(table),
+                             [table + "_0", table + "_1"])
+
+    def test_add_partitions(self):
+        self.s.execute("SELECT setval('translines_seq', 2500000)")
+        self.s.execute("SELECT add_partitions()")
+        self.assertEqual(self._partition_names("translines"),
+                         ["translines_0", "translines_1", "translines_2",
+                          "translines_3"])
+
+    def test_current_session_pruned(self):
+        old, oldline, current, line = self._old_and_current_sessions()
+        self.assertEqual(current.translines_from, 1000000)
+        self.assertEqual(current.payments_from, 500000)
+        # Queries on the current session only touch the newest
+        # partitions, although the old ones are still attached
+        plan = self._explain(
+            "SELECT sum(tl.items * tl.amount) FROM translines tl "
+            "JOIN transactions t ON t.transid = tl.transid "
+            "WHERE t.sessionid = :sessionid "
+            "AND tl.translineid >= :translines_from",
+            {'sessionid': current.id,
+             'translines_from': current.translines_from})
+        self.assertNotIn("translines_0", plan)
+        self.assertIn("translines_1", plan)
+        # Where the bound comes from the sessions table, the old
+        # partitions are skipped when the query runs
+        q = self.s.query(models.Session.total)\
+                  .filter(models.Session.id == current.id)
+        self.assertEqual(q.scalar(), Decimal(3))
+        plan = self._explain(str(q.statement.compile(
+            dialect=self.s.bind.dialect,
+            compile_kwargs={"literal_binds": True})), analyze=True)
+        for l in plan.splitlines():
+            if "translines_0" in l:
+                self.assertIn("never executed", l)
+        self.assertEqual(current.payment_totals[0][1], Decimal(3))
+        self.assertEqual(old.total, Decimal(3))
+
+    def test_deferred_transaction_in_bounds(self):
+        old, oldline, current, line = self._old_and_current_sessions()
+        current.endtime = datetime.datetime.now()
+        deferred = models.Transaction(session=None)
+        self.s.add(models.Transline(
+            transaction=deferred, items=1, amount=Decimal(3),
+            dept_id=1, transcode='S'))
+        self.s.flush()
+        # The next session starts with the deferred transaction's
+        # lines in range
+        nextsession = models.Session(datetime.date.today())
+        self.s.add(nextsession)
+        self.s.flush()
+        self.assertLessEqual(nextsession.translines_from,
+                             deferred.lines[0].id)
+        deferred.session = nextsession
+        self.s.flush()
+        self.assertEqual(nextsession.total, Decimal(3))
+
+    def test_voided_by_unique(self):
+        old, oldline, current, line = self._old_and_current_sessions()
+        # The lines are in different partitions
+        void = models.Transline(
+            transaction=models.Transaction(session=current), items=-1, amount=Decimal(3),
+            dept_id=1, transcode='S', time=datetime.datetime.now())
+        self.s.add(void)
+        self.s.flush()
+        oldline.voided_by = void
+        self.s.flush()
+        sp = self.s.begin_nested()
+        line.voided_by = void
+        with self.assertRaises(IntegrityError):
+            self.s.flush()
+        sp.rollback()
+
+    def test_archive(self):
+        old, oldline, current, line = self._old_and_current_sessions()
+        self.item.finished = datetime.datetime.now() \
+                             - datetime.timedelta(days=700)
+        self.item.finishcode_id = 'empty'
+        self.s.flush()
+        results = dbutils.archive_partitions(
+            self.s, datetime.date.today() - datetime.timedelta(days=365))
+        self.assertEqual(results, [("stockout_0", None), ("payments_0", None),
+                                   ("translines_0", None)])
+        self.assertEqual(self.s.execute(
+            "SELECT count(*) FROM archive.translines_0").scalar(), 1)
+        self.assertEqual(self.s.query(models.Transline).count(), 1)
+        self.assertNotIn("translines_0", self._partition_names("translines"))
+        # The old session's totals are shown as incomplete
+        self.s.expire_all()
+        self.assertTrue(old.archived)
+        self.assertFalse(current.archived)
+        # Lookups by ID only touch one partition
+        plan = self._explain(
+            "SELECT * FROM translines WHERE translineid = :id",
+            {'id': line.id})
+        self.assertIn("translines_1", plan)
+        self.assertNotIn("translines_2", plan)
+        self.assertNotIn("translines_default", plan)
+        # Archived ranges don't get new partitions
+        self.s.execute("SELECT add_partitions()")
+        self.assertNotIn("translines_0", self._partition_names("translines"))
+
+    def test_archive_dry_run(self):
+        old, oldline, current, line = self._old_and_current_sessions()
+        self.item.finished = datetime.datetime.now() \
+                             - datetime.timedelta(days=700)
+        self.item.finishcode_id = 'empty'
+        self.s.flush()
+        results = dbutils.archive_partitions(
+            self.s, datetime.date.today() - datetime.timedelta(days=365),
+            dryrun=True)
+        self.assertEqual(results, [("stockout_0", None), ("payments_0", None),
+                                   ("translines_0", None)])
+        self.assertIn("translines_0", self._partition_names("translines"))
+        # Nothing was locked against the tills
+        self.assertEqual(self.s.execute(
+            "SELECT count(*) FROM pg_locks "
+            "WHERE pid = pg_backend_pid() AND locktype = 'relation' "
+            "AND mode = 'AccessExclusiveLock'").scalar(), 0)
+
+    def test_archive_unfinished_stock(self):
+        # The stock item is still in use, so its usage and the
+        # transaction lines that refer to it must stay live
+        self._old_and_current_sessions()
+        results = dbutils.archive_partitions(
+            self.s, datetime.date.today() - datetime.timedelta(days=365))
+        self.assertEqual(results, [("payments_0", None)])
+        self.assertEqual(self.s.query(models.StockOut).count(), 2)
+
+    def test_archive_nothing_old(self):
+        self._old_and_current_sessions()
+        self.assertEqual(dbutils.archive_partitions(
+            self.s, datetime.date.today() - datetime.timedelta(days=1000)),
+                         [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+from . import pdrivers
+from . import event
+from . import tillconfig
+import unittest
+import sys
+import time
+import types
+from unittest import mock
+
+class FakeCups:
+    """Enough of the pycups module to test cupsprinter"""
+    def __init__(self):
+        fake = self
+        self.module = types.ModuleType("cups")
+
+        class IPPError(Exception):
+            pass
+
+        class HTTPError(Exception):
+            pass
+
+        class Connection:
+            def __init__(self, **kwargs):
+                if fake.down:
+                    raise RuntimeError("failed to connect to server")
+                fake.connections.append(kwargs)
+                self.broken = False
+                self._job = None
+
+            def _check(self):
+                if self.broken or fake.down:
+                    self.broken = True
+                    raise HTTPError(-1)
+
+            def getPrinterAttributes(self, name):
+                self._check()
+                fake.calls.append("getPrinterAttributes")
+                if name not in fake.printers:
+                    raise IPPError(1030, "The printer or class does not exist.")
+                return {'printer-is-accepting-jobs': fake.printers[name]}
+
+            def createJob(self, name, title, options):
+                self._check()
+                fake.calls.append("createJob")
+                fake.next_job += 1
+                self._job = [name, options, b""]
+                return fake.next_job
+
+            def startDocument(self, name, job, docname, format, last):
+                self._check()
+                fake.calls.append("startDocument")
+
+            def writeRequestData(self, data, length):
+                self._check()
+                fake.calls.append("writeRequestData")
+                time.sleep(fake.delay)
+                self._job[2] += data[:length]
+
+            def finishDocument(self, name):
+                self._check()
+                fake.calls.append("finishDocument")
+                fake.jobs.append(tuple(self._job))
+
+        self.module.IPPError = IPPError
+        self.module.HTTPError = HTTPError
+        self.module.Connection = Connection
+        self.reset()
+
+    def reset(self):
+        self.down = False
+        self.delay = 0.0
+        self.printers = {'labels': True, 'paused': False}
+        self.connections = []
+        self.calls = []
+        self.jobs = []
+        self.next_job = 0
+
+class rawdriver:
+    """A driver that passes lines straight through to the printer"""
+    mimetype = "text/plain"
+    def start(self, fileobj, interface):
+        self._f = fileobj
+        return self
+    def end(self):
+        pass
+    def printline(self, l="", **kwargs):
+        self._f.write(l.encode('utf-8') + b"\n")
+
+class CupsPrinterTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeCups()
+        self._old_cups = sys.modules.get("cups")
+        sys.modules["cups"] = self.fake.module
+        pdrivers._cupsclient._clients.clear()
+        self._old_ttl = pdrivers.cups_state_ttl
+        tillconfig.mainloop = event.SelectorsMainLoop()
+
+    def tearDown(self):
+        pdrivers.cups_state_ttl = self._old_ttl
+        pdrivers._cupsclient._clients.clear()
+        if self._old_cups:
+            sys.modules["cups"] = self._old_cups
+        else:
+            del sys.modules["cups"]
+
+    def _print(self, p, text):
+        with p as d:
+            d.printline(text)
+
+    def _wait(self, p):
+        p._client().wait()
+
+    def test_connection_shared(self):
+        a = pdrivers.cupsprinter("labels", rawdriver())
+        b = pdrivers.cupsprinter("paused", rawdriver())
+        self.assertIsNone(a.offline())
+        self.assertIn("not accepting jobs", b.offline())
+        self._print(a, "one")
+        self._print(b, "two")
+        self._wait(a)
+        # One connection for jobs and one for printer states
+        self.assertEqual(len(self.fake.connections), 2)
+        self.assertEqual(self.fake.jobs, [("labels", {}, b"one\n"),
+                                          ("paused", {}, b"two\n")])
+
+    def test_jobs_in_background(self):
+        self.fake.delay = 0.2
+        p = pdrivers.cupsprinter("labels", rawdriver())
+        start = time.monotonic()
+        for i in range(5):
+            self._print(p, str(i))
+        self.assertLess(time.monotonic() - start, 0.2)
+        self._wait(p)
+        self.assertEqual([j[2] for j in self.fake.jobs],
+                         ["{}\n".format(i).encode('utf-8') for i in range(5)])
+
+    def test_state_cached(self):
+        p = pdrivers.cupsprinter("labels", rawdriver(),
+                                 description="Label printer")
+        for i in range(5):
+            self.assertEqual(str(p), "Label printer")
+        self.assertEqual(self.fake.calls.count("getPrinterAttributes"), 1)
+        # Once the state is out of date, it is refreshed in the
+        # background and the cached state is returned meanwhile
+        pdrivers.cups_state_ttl = 0
+        self.fake.printers['labels'] = False
+        self.assertIsNone(p.offline())
+        self._wait(p)
+        self.assertIn("not accepting jobs", p.offline())
+
+    def test_reconnect(self):
+        p = pdrivers.cupsprinter("labels", rawdriver())
+        self.assertIsNone(p.offline())
+        # The server restarts; the old connection no longer works
+        self._print(p, "before restart")
+        self._wait(p)
+        p._client()._jobs._connection.broken = True
+        self._print(p, "after restart")
+        self._wait(p)
+        self.assertEqual(len(self.fake.connections), 3)
+        self.assertEqual(self.fake.jobs[-1][2], b"after restart\n")
+
+    def test_server_down(self):
+        self.fake.down = True
+        p = pdrivers.cupsprinter("labels", rawdriver())
+        self.assertEqual(p.offline(), "failed to connect to server")
+        self._print(p, "lost")
+        self._wait(p)
+        self.assertEqual(self.fake.jobs, [])
+        # The failure is reported from the main loop
+        with self.assertLogs("quicktill.pdrivers", "ERROR"), \
+             mock.patch("quicktill.ui.infopopup") as popup:
+            tillconfig.mainloop.add_timeout(0.05, lambda: None)
+            tillconfig.mainloop.iterate()
+        self.assertIn("failed to connect to server", popup.call_args[0][0][0])
+
+    def test_server_down_without_mainloop(self):
+        tillconfig.mainloop = None
+        self.fake.down = True
+        p = pdrivers.cupsprinter("labels", rawdriver())
+        with self.assertRaises(RuntimeError):
+            self._print(p, "lost")
+
+    def test_state_during_job(self):
+        # Looking up a printer state doesn't wait for a job that is
+        # being sent
+        self.fake.delay = 0.5
+        p = pdrivers.cupsprinter("labels", rawdriver())
+        q = pdrivers.cupsprinter("paused", rawdriver())
+        self._print(p, "slow")
+        # Wait until the job is part way through
+        while "writeRequestData" not in self.fake.calls:
+            time.sleep(0.01)
+        start = time.monotonic()
+        self.assertIn("not accepting jobs", q.offline())
+        self.assertLess(time.monotonic() - start, 0.2)
+        self._wait(p)
+        self.assertEqual(self.fake.calls, [
+            "createJob", "startDocument", "writeRequestData",
+            "getPrinterAttributes", "finishDocument"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+from . import td
+from . import dbtest
+from . import test_models
+from . import test_migrate
+from . import test_xero
+import unittest
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import getpass
+
+# These tests run through a PgBouncer started just for the test, in
+# transaction pooling mode, talking to the local PostgreSQL server.
+# They are skipped if pgbouncer is not installed.
+PGBOUNCER = shutil.which("pgbouncer", path=os.environ.get("PATH", "")
+                         + ":/usr/sbin")
+PGHOST = os.environ.get("PGHOST", "/var/run/postgresql")
+
+_pgbouncer_ini = """
+[databases]
+* = host={host} user={user}
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = {port}
+unix_socket_dir =
+auth_type = any
+pool_mode = transaction
+default_pool_size = 2
+"""
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_pgbouncer():
+    """Start pgbouncer
+
+    Returns the process, its temporary directory and a URL for the
+    test database through it.
+    """
+    tmpdir = tempfile.TemporaryDirectory()
+    port = _free_port()
+    ini = os.path.join(tmpdir.name, "pgbouncer.ini")
+    with open(ini, "w") as f:
+        f.write(_pgbouncer_ini.format(
+            host=PGHOST, user=getpass.getuser(), port=port))
+    p = subprocess.Popen([PGBOUNCER, ini], stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
+    for i in range(50):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return p, tmpdir, "postgresql+psycopg2://127.0.0.1:{}/{}".format(
+        port, dbtest.TEST_DATABASE_NAME)
+
+def stop_pgbouncer(p, tmpdir):
+    p.terminate()
+    p.wait()
+    tmpdir.cleanup()
+
+class ThroughPgBouncer:
+    """Run the tests of a DatabaseTest class through PgBouncer
+
+    Put this before the test class in the bases of a new class.
+    Statements that aren't safe with transaction pooling are rejected,
+    as they are for tills with database_transaction_pooling set.
+    """
+    @classmethod
+    def _connect(cls, url):
+        cls._pgbouncer, cls._tmpdir, url = start_pgbouncer()
+        cls._old_transaction_pooling = td.transaction_pooling
+        td.transaction_pooling = True
+        if cls.use_td:
+            return super()._connect(url)
+        return td.make_engine(url)
+
+    @classmethod
+    def _disconnect(cls):
+        super()._disconnect()
+        td.transaction_pooling = cls._old_transaction_pooling
+        stop_pgbouncer(cls._pgbouncer, cls._tmpdir)
+
+# The model tests include the stockline_sale() database function; the
+# outbox tests include claiming entries with SKIP LOCKED from several
+# threads; and the migration tests record their progress as they go
+@unittest.skipUnless(PGBOUNCER, "pgbouncer not installed")
+class ModelTestThroughPgBouncer(ThroughPgBouncer, test_models.ModelTest):
+    pass
+
+@unittest.skipUnless(PGBOUNCER, "pgbouncer not installed")
+class XeroOutboxTestThroughPgBouncer(ThroughPgBouncer,
+                                     test_xero.XeroOutboxTest):
+    pass
+
+@unittest.skipUnless(PGBOUNCER, "pgbouncer not installed")
+class MigrateTestThroughPgBouncer(ThroughPgBouncer,
+                                  test_migrate.MigrateTest):
+    pass
+
+@unittest.skipUnless(PGBOUNCER, "pgbouncer not installed")
+class TransactionPoolingTest(dbtest.DatabaseTest):
+    use_td = True
+
+    @classmethod
+    def _connect(cls, url):
+        cls._pgbouncer, cls._tmpdir, url = start_pgbouncer()
+        cls._pooling_engine = td.make_engine(url, transaction_pooling=True)
+        return super()._connect(url)
+
+    @classmethod
+    def _disconnect(cls):
+        cls._pooling_engine.dispose()
+        super()._disconnect()
+        stop_pgbouncer(cls._pgbouncer, cls._tmpdir)
+
+    def test_pool_options(self):
+        td.pool_options = {'command': {'pool_size': 3}}
+        try:
+            engine = td.make_engine("postgresql+psycopg2:///postgres")
+            self.assertEqual(engine.pool.size(), 3)
+        finally:
+            td.pool_options = {}
+        engine = td.make_engine("postgresql+psycopg2:///postgres",
+                                role="tillweb")
+        self.assertEqual(engine.pool.size(),
+                         td.pool_defaults['tillweb']['pool_size'])
+
+    def test_session_state_rejected(self):
+        conn = self._pooling_engine.connect()
+        for statement in ("SET statement_timeout=1000",
+                          "set search_path to public",
+                          "LISTEN foo",
+                          "CREATE TEMPORARY TABLE foo (bar integer)",
+                          "SELECT pg_advisory_lock(1)"):
+            with self.assertRaises(td.TransactionPoolingError):
+                conn.execute(statement)
+        conn.close()
+
+    def test_transaction_state_allowed(self):
+        conn = self._pooling_engine.connect()
+        with conn.begin():
+            conn.execute("SET TRANSACTION READ ONLY")
+            conn.execute("SET LOCAL statement_timeout=1000")
+            conn.execute("SELECT pg_advisory_xact_lock(1)")
+            self.assertEqual(
+                conn.execute("SHOW statement_timeout").scalar(), "1s")
+        conn.close()
+
+    def test_foodorder_ticket(self):
+        # nextval() works whichever server connection each
+        # transaction ends up on
+        td.foodorder_reset()
+        tickets = []
+        for i in range(5):
+            with td.orm_session():
+                tickets.append(td.foodorder_ticket())
+        self.assertEqual(tickets, [1, 2, 3, 4, 5])
+
+if __name__ == '__main__':
+    unittest.main()
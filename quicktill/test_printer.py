@@ -0,0 +1,102 @@
+from . import printer
+from . import pdrivers
+from . import tillconfig
+from . import dbtest
+import unittest
+import datetime
+import os
+import time
+from types import SimpleNamespace
+from unittest import mock
+
+# Maximum time to print 1000 labels, in seconds
+LABEL_BUDGET = float(os.environ.get("QUICKTILL_LABEL_BUDGET", 10.0))
+
+class recordingprinter(pdrivers.tmpfileprinter):
+    """Keep the size of each document printed"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jobs = []
+
+    def finish(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        assert data.startswith(b'%PDF')
+        self.jobs.append(len(data))
+
+def _items(n, stocktypes=20):
+    """Make n things that look like StockItems to a stocklabel"""
+    supplier = SimpleNamespace(name="Dark Star Brewing")
+    delivery = SimpleNamespace(supplier=supplier,
+                               date=datetime.date(2019, 3, 1))
+    types = [SimpleNamespace(descriptions=[
+        "Dark Star Brewing Hophead number {} 3.8% ABV".format(i),
+        "Dark Star Hophead {} 3.8%".format(i),
+        "Hophead {}".format(i)]) for i in range(stocktypes)]
+    unit = SimpleNamespace(name="Firkin")
+    return [SimpleNamespace(id=1000 + i, checkdigits="{:03d}".format(i),
+                            stocktype=types[i % stocktypes],
+                            delivery=delivery, stockunit=unit)
+            for i in range(n)]
+
+class StockLabelTest(unittest.TestCase):
+    def setUp(self):
+        self._old_checkdigit_print = tillconfig.checkdigit_print
+        tillconfig.checkdigit_print = True
+        self.labels = [printer.stocklabel(i) for i in _items(1000)]
+
+    def tearDown(self):
+        tillconfig.checkdigit_print = self._old_checkdigit_print
+
+    def _labelprinter(self):
+        return recordingprinter(pdrivers.pdf_labelpage(
+            2, 4, "99.1mm", "67.7mm", "3mm", "0mm"))
+
+    def test_jobs(self):
+        p = self._labelprinter()
+        printer._print_labels(p, self.labels[:100])
+        # Eight labels per page, ten pages per job
+        self.assertEqual(len(p.jobs), 2)
+
+    @dbtest.benchmark
+    def test_benchmark_1000_labels(self):
+        p = self._labelprinter()
+        start = time.monotonic()
+        layouts = printer._print_labels(p, self.labels)
+        elapsed = time.monotonic() - start
+        self.assertEqual(len(p.jobs), 13)
+        # Labels for items of the same stock type are only laid out once
+        self.assertEqual(len(layouts), 20)
+        self.assertLess(elapsed, LABEL_BUDGET,
+                        "1000 labels took {:.2f}s".format(elapsed))
+        dbtest.benchmark_log.info("1000 labels printed in %.2fs", elapsed)
+
+    def test_background_printer_is_a_copy(self):
+        p = self._labelprinter()
+        with mock.patch.object(printer.td, "s"), \
+             mock.patch.object(tillconfig, "mainloop", create=True):
+            printer.stocklabel_print(p, _items(10)).result()
+        # The caller's printer and driver weren't used by the
+        # background thread
+        self.assertEqual(p.jobs, [])
+        self.assertIsNone(p._driver.ll)
+
+    def test_fresh_printer(self):
+        # A printer that has printed something is left holding the
+        # closed file in its driver, so it can't be deep-copied; a
+        # fresh printer and driver are made from its configuration
+        p = recordingprinter(pdrivers.pdf_driver(width=200),
+                             description="Receipts")
+        with p as d:
+            d.printline("Receipt")
+        q = p.fresh()
+        self.assertIsNot(q._driver, p._driver)
+        self.assertEqual(q._driver.width, 200)
+        self.assertEqual(str(q), "Receipts")
+        with q as d:
+            d.printline("Receipt")
+        self.assertEqual(len(p.jobs), 1)
+        self.assertEqual(len(q.jobs), 1)
+
+if __name__ == '__main__':
+    unittest.main()
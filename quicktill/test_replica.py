@@ -0,0 +1,68 @@
+from . import models
+from . import dbtest
+from .replica import readonly_session, replica_lag
+import unittest
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine
+from sqlalchemy.exc import InternalError
+
+# A second database on the same server stands in for the replica; it
+# is not in recovery so always reports zero lag
+PRIMARY_DATABASE_NAME = dbtest.TEST_DATABASE_NAME
+REPLICA_DATABASE_NAME = "quicktill-test-replica"
+
+class ReplicaTest(dbtest.DatabaseTest):
+    @classmethod
+    def setUpClass(cls):
+        # The test database is the primary
+        super().setUpClass()
+        dbtest.create_database(REPLICA_DATABASE_NAME)
+        cls._replica_engine = create_engine(
+            "postgresql+psycopg2:///{}".format(REPLICA_DATABASE_NAME))
+        models.metadata.create_all(bind=cls._replica_engine)
+        cls._primary = sessionmaker(bind=cls._engine)
+        cls._replica = sessionmaker(bind=cls._replica_engine)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._replica_engine.dispose()
+        del cls._replica_engine
+        dbtest.drop_database(REPLICA_DATABASE_NAME)
+        super().tearDownClass()
+
+    def _database(self, s):
+        return s.execute("select current_database()").scalar()
+
+    def test_no_replica(self):
+        s = readonly_session(self._primary)
+        self.assertEqual(self._database(s), PRIMARY_DATABASE_NAME)
+        s.close()
+
+    def test_replica_used(self):
+        s = readonly_session(self._primary, self._replica, max_lag=60)
+        self.assertEqual(self._database(s), REPLICA_DATABASE_NAME)
+        self.assertEqual(replica_lag(s), 0)
+        s.close()
+
+    def test_replica_is_readonly(self):
+        s = readonly_session(self._primary, self._replica)
+        s.add(models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address'))
+        with self.assertRaises(InternalError):
+            s.flush()
+        s.close()
+
+    def test_stale_replica_not_used(self):
+        s = readonly_session(self._primary, self._replica, max_lag=-1)
+        self.assertEqual(self._database(s), PRIMARY_DATABASE_NAME)
+        s.close()
+
+    def test_unavailable_replica_not_used(self):
+        missing = sessionmaker(bind=create_engine(
+            "postgresql+psycopg2:///quicktill-test-missing"))
+        s = readonly_session(self._primary, missing)
+        self.assertEqual(self._database(s), PRIMARY_DATABASE_NAME)
+        s.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+from . import models
+from . import td
+from . import dbtest
+import unittest
+import time
+import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
+
+class ConnectionRecoveryTest(dbtest.DatabaseTest):
+    """Check that the till recovers when its database connections are
+    killed, for example by a database restart or a network failure.
+
+    Backend connections are killed from a separate connection using
+    pg_terminate_backend().
+    """
+    use_td = True
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls._admin = create_engine("postgresql+psycopg2:///postgres")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._admin.dispose()
+        super().tearDownClass()
+
+    def setUp(self):
+        self._ping_idle_time = td.ping_idle_time
+
+    def tearDown(self):
+        td.ping_idle_time = self._ping_idle_time
+
+    def _backend_pid(self):
+        with td.orm_session():
+            return td.s.execute("select pg_backend_pid()").scalar()
+
+    def _terminate(self, pid):
+        conn = self._admin.connect()
+        conn.execute("select pg_terminate_backend(%s)", pid)
+        # pg_terminate_backend() only sends a signal; wait for the
+        # backend to go away
+        for i in range(50):
+            if not conn.execute(
+                    "select count(*) from pg_stat_activity where pid=%s",
+                    pid).scalar():
+                break
+            time.sleep(0.1)
+        conn.close()
+
+    def test_connection_reused(self):
+        pid = self._backend_pid()
+        self.assertEqual(self._backend_pid(), pid)
+
+    def test_idle_connection_pinged(self):
+        # With no idle threshold every checkout is pinged, so a killed
+        # connection is replaced before it is used
+        td.ping_idle_time = 0
+        pid = self._backend_pid()
+        self._terminate(pid)
+        self.assertNotEqual(self._backend_pid(), pid)
+
+    def test_recent_connection_recovers_after_first_use(self):
+        # A recently used connection isn't pinged; the failure shows up
+        # when it is first used, and after that the pool has been
+        # refreshed
+        td.ping_idle_time = 3600
+        pid = self._backend_pid()
+        self._terminate(pid)
+        with self.assertRaises(DBAPIError) as cm:
+            self._backend_pid()
+        self.assertTrue(cm.exception.connection_invalidated)
+        self.assertNotEqual(self._backend_pid(), pid)
+
+    def test_all_connections_killed(self):
+        # As happens when the database server is restarted
+        td.ping_idle_time = 0
+        with td.orm_session():
+            pid = td.s.execute("select pg_backend_pid()").scalar()
+            # Check out a second connection while the first is in use
+            s2 = td.sm()
+            pid2 = s2.execute("select pg_backend_pid()").scalar()
+            s2.close()
+        for p in (pid, pid2):
+            self._terminate(p)
+        with td.orm_session():
+            td.s.add(models.Business(
+                id=1, name='Test', abbrev='TEST', address='An address'))
+        with td.orm_session():
+            self.assertEqual(td.s.query(models.Business).count(), 1)
+            td.s.query(models.Business).delete()
+
+class PullthruTest(dbtest.DatabaseTest):
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.trans = self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        td.s = self.s
+        td._lastsale.clear()
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=20)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        pint = models.UnitType(id='pt', name='pint')
+        beer = models.StockType(
+            manufacturer="A Brewery", name="A Beer", shortname="A Beer",
+            abv=5, unit=pint, department=dept)
+        firkin = models.StockUnit(
+            id='firkin', name='Firkin', size=72, unit=pint)
+        delivery = models.Delivery(
+            date=datetime.date.today(),
+            supplier=models.Supplier(name="Test supplier"),
+            docnumber="test")
+        self.item = models.StockItem(
+            delivery=delivery, stocktype=beer, stockunit=firkin)
+        self.s.add_all([self.item,
+                        models.RemoveCode(id='sold', reason='Sold'),
+                        models.RemoveCode(id='pullthru', reason='Pullthru')])
+        self.s.flush()
+
+    def tearDown(self):
+        td.s = None
+        td._lastsale.clear()
+        self.s.close()
+        self.trans.rollback()
+        self.connection.close()
+
+    def _add_sales(self, count, hours_ago):
+        self.s.execute(
+            "INSERT INTO stockout "
+            "(stockoutid, stockid, qty, removecode, time) "
+            "SELECT nextval('stockout_seq'), :stockid, 0.1, 'sold', "
+            "now() - :age - x * interval '1 second' "
+            "FROM generate_series(1, :count) AS x",
+            {'stockid': self.item.id, 'count': count,
+             'age': datetime.timedelta(hours=hours_ago)})
+
+    def test_checkpullthru(self):
+        maxtime = datetime.timedelta(hours=11)
+        self.assertIsNone(td.stock_checkpullthru(self.item.id, maxtime))
+        self._add_sales(10, 12)
+        self.assertTrue(td.stock_checkpullthru(self.item.id, maxtime))
+        # Once this process has seen a sale the database isn't consulted
+        td.stock_recordsale(self.item.id)
+        self.assertFalse(td.stock_checkpullthru(self.item.id, maxtime))
+        # The sale is remembered once it has been committed
+        self.assertNotIn(self.item.id, td._lastsale)
+        self.s.commit()
+        self.assertIn(self.item.id, td._lastsale)
+        # A sale made by another till is found in the database
+        td._lastsale.clear()
+        self._add_sales(1, 1)
+        self.assertFalse(td.stock_checkpullthru(self.item.id, maxtime))
+
+    def test_recordsale_rolled_back(self):
+        td.stock_recordsale(self.item.id)
+        self.s.rollback()
+        self.assertNotIn(self.item.id, td._lastsale)
+        self.assertNotIn('lastsale', self.s.info)
+
+    @dbtest.benchmark
+    def test_benchmark_checkpullthru_100k_stockout(self):
+        maxtime = datetime.timedelta(hours=11)
+        self._add_sales(100000, 12)
+        self.s.execute("ANALYZE stockout")
+        runs = 100
+        start = time.time()
+        for i in range(runs):
+            td._lastsale.clear()
+            self.assertTrue(td.stock_checkpullthru(self.item.id, maxtime))
+        cold = (time.time() - start) / runs
+        td.stock_recordsale(self.item.id)
+        start = time.time()
+        for i in range(runs):
+            self.assertFalse(td.stock_checkpullthru(self.item.id, maxtime))
+        warm = (time.time() - start) / runs
+        self.assertLess(warm, cold)
+        dbtest.benchmark_log.info(
+            "Pull-through check with 100k stockout rows: "
+            "%.3fms from the database, %.3fms cached",
+            cold * 1000, warm * 1000)
+
+if __name__ == '__main__':
+    unittest.main()
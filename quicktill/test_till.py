@@ -0,0 +1,158 @@
+from . import till
+from . import tillconfig
+import unittest
+import os
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeConfigServer:
+    """A local HTTP server that serves a global configuration file"""
+    def __init__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(fake.delay)
+                with fake._lock:
+                    fake.requests.append(self.headers.get('If-None-Match'))
+                    etag = '"{}"'.format(fake.version)
+                if fake.status:
+                    self.send_response(fake.status)
+                    self.end_headers()
+                    return
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = "configurations = {{'default': {{'version': {}}}}}\n"\
+                    .format(fake.version).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}/config.py".format(
+            self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.reset()
+
+    def reset(self):
+        self.version = 1
+        self.delay = 0.0
+        # If set, respond to all requests with this status
+        self.status = None
+        self.requests = []
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class ConfigCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeConfigServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.close()
+
+    def setUp(self):
+        self.fake.reset()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._old_cache_dir = tillconfig.cache_dir
+        tillconfig.cache_dir = self._tmpdir.name
+
+    def tearDown(self):
+        tillconfig.cache_dir = self._old_cache_dir
+        self._tmpdir.cleanup()
+
+    def _start(self, wait=0.5, save=True):
+        """Load the configuration as the till does when it starts"""
+        c = till._configcache(self.fake.url, wait)
+        g = {}
+        exec(c.get(), g)
+        if save:
+            c.save()
+        return c, g['configurations']['default']['version']
+
+    def test_first_start(self):
+        c, version = self._start()
+        self.assertEqual(version, 1)
+        self.assertFalse(c.from_cache)
+        self.assertEqual(self.fake.requests, [None])
+
+    def test_unchanged(self):
+        self._start()
+        c, version = self._start()
+        self.assertEqual(version, 1)
+        self.assertTrue(c.from_cache)
+        self.assertEqual(self.fake.requests, [None, '"1"'])
+
+    def test_changed(self):
+        self._start()
+        self.fake.version = 2
+        c, version = self._start()
+        self.assertEqual(version, 2)
+        self.assertFalse(c.from_cache)
+        c, version = self._start()
+        self.assertTrue(c.from_cache)
+        self.assertEqual(version, 2)
+
+    def test_not_saved_until_loaded(self):
+        self._start(save=False)
+        c, version = self._start()
+        self.assertFalse(c.from_cache)
+
+    def test_server_down(self):
+        self._start()
+        self.fake.version = 2
+        self.fake.status = 500
+        c, version = self._start()
+        self.assertEqual(version, 1)
+        self.assertTrue(c.from_cache)
+
+    def test_server_slow(self):
+        self._start()
+        self.fake.version = 2
+        self.fake.delay = 1.0
+        start = time.monotonic()
+        c, version = self._start(wait=0.2)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(version, 1)
+        self.assertTrue(c.from_cache)
+
+    def test_late_response_used_next_time(self):
+        self._start()
+        self.fake.version = 2
+        self.fake.delay = 0.5
+        c, version = self._start(wait=0.1)
+        self.assertEqual(version, 1)
+        # Wait for the late response to arrive
+        deadline = time.monotonic() + 5
+        while not os.path.exists(c._cachefile + ".pending") \
+              and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # The next start uses it straight away, however slow the
+        # server is...
+        self.fake.delay = 1.0
+        c, version = self._start(wait=0.1)
+        self.assertEqual(version, 2)
+        # ...and keeps it once it has loaded
+        self.assertFalse(os.path.exists(c._cachefile + ".pending"))
+        self.fake.delay = 0.0
+        self.fake.status = 500
+        c, version = self._start()
+        self.assertEqual(version, 2)
+
+if __name__ == '__main__':
+    unittest.main()
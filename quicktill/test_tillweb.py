@@ -0,0 +1,86 @@
+import unittest
+from unittest import mock
+import django
+from django.conf import settings
+from django.http import HttpResponse
+
+# The views need the tillweb app to be set up; run them as a
+# standalone site so that no users or Till objects are needed
+if not settings.configured:
+    settings.configure(
+        INSTALLED_APPS=[
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'quicktill.tillweb',
+        ],
+        TILLWEB_SINGLE_SITE=True,
+        TILLWEB_LOGIN_REQUIRED=False,
+        TILLWEB_PUBNAME="Test pub",
+        TILLWEB_DEFAULT_ACCESS='R',
+    )
+    django.setup()
+
+from django.test import RequestFactory, override_settings
+from .tillweb import views
+
+def _render(request, template, context, status=200):
+    return HttpResponse(template, status=status)
+
+class HeavyViewTest(unittest.TestCase):
+    def setUp(self):
+        views._heavy_semaphores.clear()
+        self.session = mock.Mock()
+        self.sm = mock.Mock(return_value=self.session)
+        self.request = RequestFactory().get("/report/")
+        self.limits = {'heavy_concurrency': 1, 'heavy_queue_timeout': 0}
+        patcher = mock.patch.object(views, "render", side_effect=_render)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _view(self, heavy=True):
+        return views.tillweb_view(
+            lambda request, info, session: HttpResponse("done"),
+            heavy=heavy)
+
+    def _get(self, view):
+        with override_settings(TILLWEB_DATABASE=self.sm,
+                               TILLWEB_QUERY_LIMITS=self.limits):
+            return view(self.request, "test")
+
+    def test_statement_timeout(self):
+        response = self._get(self._view())
+        self.assertEqual(response.content, b"done")
+        self.session.execute.assert_called_once_with(
+            "SET LOCAL statement_timeout = 300000")
+        self.session.close.assert_called_once_with()
+        self.session.reset_mock()
+        self._get(self._view(heavy=False))
+        self.session.execute.assert_called_once_with(
+            "SET LOCAL statement_timeout = 60000")
+
+    def test_busy(self):
+        semaphore = views._heavy_semaphore("test", 1)
+        self.assertTrue(semaphore.acquire(blocking=False))
+        try:
+            response = self._get(self._view())
+        finally:
+            semaphore.release()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.content, b"tillweb/busy.html")
+        self.assertEqual(response['Retry-After'], "30")
+        # The request was turned away before the database was used
+        self.sm.assert_not_called()
+        # Once the slot is free, the view runs
+        response = self._get(self._view())
+        self.assertEqual(response.content, b"done")
+
+    def test_slot_released_after_error(self):
+        self.sm.side_effect = RuntimeError("no database")
+        with self.assertRaises(RuntimeError):
+            self._get(self._view())
+        semaphore = views._heavy_semaphore("test", 1)
+        self.assertTrue(semaphore.acquire(blocking=False))
+        semaphore.release()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+from . import timesheets
+from . import event
+from . import tillconfig
+import unittest
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+STAFF_PATH = "/api/staff/"
+
+class FakeTimesheets:
+    """A local HTTP server that stands in for the timesheet server"""
+    def __init__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _respond(self, status, response, headers={}):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                if response is not None:
+                    self.wfile.write(json.dumps(response).encode('utf-8'))
+
+            def do_GET(self):
+                time.sleep(fake.delay)
+                with fake._lock:
+                    fake.gets.append(self.headers.get('If-None-Match'))
+                    etag = '"{}"'.format(fake.version)
+                if self.path != STAFF_PATH:
+                    return self._respond(404, None)
+                if self.headers.get('If-None-Match') == etag:
+                    return self._respond(304, None, {'ETag': etag})
+                self._respond(200, fake.staff(), {'ETag': etag})
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                data = parse_qs(self.rfile.read(length).decode('utf-8'))
+                with fake._lock:
+                    fake.posts.append((self.path, data['pin'][0]))
+                    if fake.drop:
+                        fake.drop -= 1
+                        self.close_connection = True
+                        return
+                    if fake.unavailable:
+                        fake.unavailable -= 1
+                        return self._respond(fake.unavailable_status, None)
+                if data['pin'][0] != "1234":
+                    return self._respond(200, False)
+                self._respond(200, self.path + "actions/")
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.reset()
+
+    def reset(self):
+        self.delay = 0.0
+        self.version = 1
+        # Number of POST requests to fail, and the response to fail
+        # them with
+        self.unavailable = 0
+        self.unavailable_status = 503
+        # Number of POST requests to drop the connection on, after
+        # the request has been received
+        self.drop = 0
+        self.gets = []
+        self.posts = []
+
+    def staff(self):
+        return [{'username': 'u{}'.format(i),
+                 'fullname': 'User {} v{}'.format(i, self.version),
+                 'url': '/api/staff/u{}/'.format(i)} for i in range(3)]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class TimesheetsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.fake = FakeTimesheets()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.fake.close()
+
+    def setUp(self):
+        self.fake.reset()
+        tillconfig.mainloop = event.SelectorsMainLoop()
+        self.api = timesheets.Api("user", "password", self.fake.url,
+                                  STAFF_PATH, cache_ttl=0.5, retry_delay=0.1)
+        self.results = []
+        self.errors = []
+
+    def _run(self, until, timeout=5):
+        """Run the main loop until a condition is true"""
+        deadline = time.monotonic() + timeout
+        while not until() and time.monotonic() < deadline:
+            tillconfig.mainloop.add_timeout(0.05, lambda: None)
+            tillconfig.mainloop.iterate()
+
+    def _users(self):
+        self.api.users(self.results.append, self.errors.append)
+
+    def test_staff_list_cached(self):
+        self.fake.delay = 0.2
+        self._users()
+        # The list is fetched in the background
+        self.assertEqual(self.results, [])
+        self._run(lambda: self.results)
+        self.assertEqual([u.fullname for u in self.results[0]],
+                         ["User 0 v1", "User 1 v1", "User 2 v1"])
+        # While it's fresh, the cached list is returned straight away
+        # without contacting the server
+        self._users()
+        self.assertEqual(len(self.results), 2)
+        self.assertEqual(len(self.fake.gets), 1)
+
+    def test_conditional_refresh(self):
+        self._users()
+        self._run(lambda: self.results)
+        time.sleep(0.6)
+        # The stale list is returned straight away, and refreshed
+        # with a conditional request
+        self._users()
+        self.assertEqual(len(self.results), 2)
+        self._run(lambda: len(self.fake.gets) == 2
+                  and not self.api._users_refreshing)
+        self.assertEqual(self.fake.gets, [None, '"1"'])
+        first = self.results[0]
+        self._users()
+        self.assertIs(self.results[-1], first)
+        # When the list changes on the server, the new one is fetched
+        self.fake.version = 2
+        time.sleep(0.6)
+        self._users()
+        self._run(lambda: not self.api._users_refreshing)
+        self._users()
+        self.assertEqual(self.results[-1][0].fullname, "User 0 v2")
+
+    def test_pin_retried(self):
+        self.fake.unavailable = 2
+        self._users()
+        self._run(lambda: self.results)
+        user = self.results[0][0]
+        user.check_pin("1234", self.results.append, self.errors.append)
+        self._run(lambda: len(self.results) == 2)
+        self.assertEqual(self.results[1], "/api/staff/u0/actions/")
+        self.assertEqual(user.pin, "1234")
+        self.assertEqual(len(self.fake.posts), 3)
+        self.assertEqual(self.errors, [])
+
+    def test_pin_incorrect(self):
+        self._users()
+        self._run(lambda: self.results)
+        user = self.results[0][0]
+        user.check_pin("0000", self.results.append, self.errors.append)
+        self._run(lambda: len(self.results) == 2)
+        self.assertFalse(self.results[1])
+        self.assertIsNone(user.pin)
+
+    def test_server_down(self):
+        self.fake.unavailable = 10
+        self._users()
+        self._run(lambda: self.results)
+        user = self.results[0][0]
+        user.check_pin("1234", self.results.append, self.errors.append)
+        self._run(lambda: self.errors)
+        self.assertEqual(len(self.errors), 1)
+        # The first attempt and three retries
+        self.assertEqual(len(self.fake.posts), 4)
+
+    def test_gateway_error_not_retried(self):
+        self._users()
+        self._run(lambda: self.results)
+        user = self.results[0][0]
+        self.fake.unavailable = 1
+        self.fake.unavailable_status = 504
+        user.check_pin("1234", self.results.append, self.errors.append)
+        self._run(lambda: self.errors)
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(len(self.fake.posts), 1)
+
+    def test_lost_response_not_retried(self):
+        self._users()
+        self._run(lambda: self.results)
+        user = self.results[0][0]
+        self.fake.drop = 1
+        user.check_pin("1234", self.results.append, self.errors.append)
+        self._run(lambda: self.errors)
+        self.assertEqual(len(self.errors), 1)
+        # The server may have acted on the request, so it isn't sent
+        # again
+        self.assertEqual(len(self.fake.posts), 1)
+        self.assertIsNone(user.pin)
+
+    def test_unreachable_retried(self):
+        self._users()
+        self._run(lambda: self.results)
+        user = self.results[0][0]
+        self.fake.close()
+        self.addCleanup(self._restart_fake)
+        with self.assertLogs("quicktill.timesheets", "INFO") as cm:
+            user.check_pin("1234", self.results.append, self.errors.append)
+            self._run(lambda: self.errors)
+        self.assertEqual(len(self.errors), 1)
+        self.assertEqual(
+            len([l for l in cm.output if "retrying" in l]), 3)
+
+    @classmethod
+    def _restart_fake(cls):
+        cls.fake = FakeTimesheets()
+
+    def test_cached_users(self):
+        self.assertIsNone(self.api.cached_users)
+        self._users()
+        self._run(lambda: self.results)
+        self.assertIs(self.api.cached_users, self.results[0])
+
+if __name__ == '__main__':
+    unittest.main()
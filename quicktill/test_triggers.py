@@ -0,0 +1,169 @@
+from . import models
+from . import dbtest
+import unittest
+import datetime
+import time
+from decimal import Decimal
+from sqlalchemy.exc import InternalError
+
+# Number of rows written by each benchmark statement
+BENCHMARK_ROWS = 10000
+
+class TriggerTest(dbtest.DatabaseTest):
+    """Tests for the integrity checking triggers on sessions,
+    transactions, translines and payments, and benchmarks of the cost
+    of those triggers.
+    """
+
+    def setUp(self):
+        self.connection = self._engine.connect()
+        self.trans = self.connection.begin()
+        self.s = self._sm(bind=self.connection)
+        business = models.Business(
+            id=1, name='Test', abbrev='TEST', address='An address')
+        vatband = models.VatBand(band='A', business=business, rate=0.2)
+        dept = models.Department(id=1, description="Test", vat=vatband)
+        self.session = models.Session(datetime.date.today())
+        self.s.add_all([
+            business, vatband, dept, self.session,
+            models.TransCode(code='S', description='Sale'),
+            models.PayType(paytype='CASH', description='Cash')])
+        self.s.flush()
+
+    def tearDown(self):
+        self.s.close()
+        self.trans.rollback()
+        self.connection.close()
+
+    def _transaction(self, amount=Decimal(1), closed=False):
+        """Make a transaction with one line and a payment that balances it
+        """
+        t = models.Transaction(session=self.session)
+        self.s.add_all([
+            t,
+            models.Transline(transaction=t, items=1, amount=amount,
+                             dept_id=1, transcode='S'),
+            models.Payment(transaction=t, amount=amount, paytype_id='CASH')])
+        self.s.flush()
+        if closed:
+            t.closed = True
+            self.s.flush()
+        return t
+
+    def test_close_balanced(self):
+        t = self._transaction(closed=True)
+        self.assertTrue(t.closed)
+
+    def test_close_unbalanced(self):
+        t = self._transaction()
+        t.lines[0].amount = Decimal(2)
+        self.s.flush()
+        t.closed = True
+        with self.assertRaises(InternalError):
+            self.s.flush()
+
+    def test_modify_closed_line(self):
+        t = self._transaction(closed=True)
+        # Setting a null column is allowed
+        t.lines[0].text = "Test"
+        self.s.flush()
+        t.lines[0].text = "Changed"
+        with self.assertRaises(InternalError):
+            self.s.flush()
+
+    def test_move_line_into_closed_transaction(self):
+        closed = self._transaction(closed=True)
+        t = self._transaction()
+        with self.assertRaises(InternalError):
+            self.s.execute(
+                "UPDATE translines SET transid=:closed WHERE transid=:open",
+                {'closed': closed.id, 'open': t.id})
+
+    def test_add_payment_to_closed_transaction(self):
+        t = self._transaction(closed=True)
+        self.s.add(models.Payment(transaction=t, amount=Decimal(0),
+                                  paytype_id='CASH'))
+        with self.assertRaises(InternalError):
+            self.s.flush()
+
+    def test_bulk_move_lines(self):
+        # The same statement as the register uses to merge transactions
+        t1 = self._transaction()
+        t2 = self._transaction()
+        self.s.query(models.Transline)\
+              .filter(models.Transline.transid == t1.id)\
+              .update({models.Transline.transid: t2.id},
+                      synchronize_session=False)
+        self.s.expire_all()
+        self.assertEqual(len(t2.lines), 2)
+        self.assertEqual(len(t1.lines), 0)
+
+    def test_one_open_session(self):
+        self.s.add(models.Session(datetime.date.today()))
+        with self.assertRaises(InternalError):
+            self.s.flush()
+
+    def _insert_transactions(self, count):
+        """Insert empty open transactions
+
+        Returns a list of the new transaction IDs.
+        """
+        return [r[0] for r in self.s.execute(
+            "INSERT INTO transactions (transid, sessionid, notes, closed) "
+            "SELECT nextval('transactions_seq'), :sessionid, '', false "
+            "FROM generate_series(1, :count) "
+            "RETURNING transid",
+            {'sessionid': self.session.id, 'count': count})]
+
+    def _benchmark(self):
+        """Time bulk statements against transactions, translines and payments
+
+        Returns a dict of statement name to time taken in seconds.
+        """
+        timings = {}
+        def timed(name, statement, params={}):
+            start = time.time()
+            self.s.execute(statement, params)
+            timings[name] = time.time() - start
+        transids = self._insert_transactions(BENCHMARK_ROWS)
+        params = {'lo': min(transids), 'hi': max(transids)}
+        timed("insert translines",
+              "INSERT INTO translines "
+              "(translineid, transid, items, amount, dept, transcode) "
+              "SELECT nextval('translines_seq'), transid, 1, 1.00, 1, 'S' "
+              "FROM transactions WHERE transid BETWEEN :lo AND :hi", params)
+        timed("insert payments",
+              "INSERT INTO payments (paymentid, transid, amount, paytype) "
+              "SELECT nextval('payments_seq'), transid, 1.00, 'CASH' "
+              "FROM transactions WHERE transid BETWEEN :lo AND :hi", params)
+        timed("update payments",
+              "UPDATE payments SET ref='Test' "
+              "WHERE transid BETWEEN :lo AND :hi", params)
+        timed("close transactions",
+              "UPDATE transactions SET closed=true "
+              "WHERE transid BETWEEN :lo AND :hi", params)
+        # Setting a null column in a closed transaction is allowed
+        timed("update translines",
+              "UPDATE translines SET text='Test' "
+              "WHERE transid BETWEEN :lo AND :hi", params)
+        return timings
+
+    @dbtest.benchmark
+    def test_benchmark_triggers(self):
+        tables = ("sessions", "transactions", "translines", "payments")
+        self.s.execute("SAVEPOINT benchmark")
+        with_triggers = self._benchmark()
+        self.s.execute("ROLLBACK TO SAVEPOINT benchmark")
+        for table in tables:
+            self.s.execute("ALTER TABLE {} DISABLE TRIGGER USER".format(table))
+        without_triggers = self._benchmark()
+        for table in tables:
+            self.s.execute("ALTER TABLE {} ENABLE TRIGGER USER".format(table))
+        for name, t in with_triggers.items():
+            dbtest.benchmark_log.info(
+                "Trigger overhead for %d rows: %-20s %8.1fms with triggers, "
+                "%8.1fms without", BENCHMARK_ROWS, name, t * 1000,
+                without_triggers[name] * 1000)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,452 @@
+from . import models
+from . import td
+from . import dbtest
+from . import xero
+from . import payment
+from . import cash
+import unittest
+import datetime
+import email.utils
+import threading
+import time
+import uuid
+from unittest import mock
+from decimal import Decimal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlsplit
+from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
+
+SALES_CONTACT = "00000000-0000-0000-0000-000000000001"
+SUPPLIER_CONTACT = "00000000-0000-0000-0000-000000000002"
+
+BACKFILL_SESSIONS = 30
+BACKFILL_DELIVERIES = 6
+
+class MockXero:
+    """A local HTTP server that behaves like the parts of the Xero API
+    used by the till
+
+    Requests with an Idempotency-Key header that has been seen before
+    get the same response as the first time, without creating anything
+    new.  If rate_limit is set to (calls, seconds), requests over the
+    limit get a 429 response.
+    """
+    def __init__(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_PUT(self):
+                length = int(self.headers['Content-Length'])
+                body = parse_qs(self.rfile.read(length).decode('utf-8'))
+                xml = body['xml'][0]
+                url = urlsplit(self.path)
+                with mock._lock:
+                    mock._in_flight += 1
+                    mock.max_in_flight = max(mock.max_in_flight,
+                                             mock._in_flight)
+                time.sleep(mock.delay)
+                with mock._lock:
+                    status, headers, body = mock.put(
+                        url.path, parse_qs(url.query), xml,
+                        self.headers.get('Idempotency-Key'))
+                    mock._in_flight -= 1
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml')
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:{}/api.xro/2.0/".format(
+            self._server.server_port)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self.reset()
+
+    def reset(self):
+        self.invoices = {}
+        self.payments = []
+        self.requests = []
+        self.rate_limited = 0
+        self.max_in_flight = 0
+        self._in_flight = 0
+        self._responses = {}
+        # Time taken to deal with each request, in seconds
+        self.delay = 0.0
+        self.rate_limit = None
+        # Number of requests to process but then fail with a 503, as
+        # if the response had been lost on the way back
+        self.lose_responses = 0
+        # If set, reject all requests with this message
+        self.reject = None
+        # If set, called with each document; returns a message if the
+        # document should be rejected
+        self.reject_document = None
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def put(self, path, query, xml, key):
+        now = time.monotonic()
+        self.requests.append(now)
+        if self.rate_limit:
+            calls, seconds = self.rate_limit
+            if len([t for t in self.requests if t > now - seconds]) > calls:
+                self.rate_limited += 1
+                return 429, {'Retry-After': str(seconds)}, b""
+        if key in self._responses:
+            return self._responses[key]
+        summarize = query.get('summarizeErrors') != ['false']
+        if path.endswith("/Invoices/"):
+            response = self._documents(
+                fromstring(xml), "Invoice", self._invoice, summarize)
+        elif path.endswith("/Payments/"):
+            response = self._documents(
+                fromstring(xml), "Payment", self._payment, summarize)
+        else:
+            return 404, {}, b""
+        if key:
+            self._responses[key] = response
+        if self.lose_responses:
+            self.lose_responses -= 1
+            return 503, {}, b""
+        return response
+
+    def _rejection(self, document):
+        if self.reject:
+            return self.reject
+        if self.reject_document:
+            return self.reject_document(document)
+
+    def _documents(self, root, tag, create, summarize):
+        """Create the documents in a request
+
+        If summarize is set, the whole request fails if any of the
+        documents is rejected.  Otherwise each document in the
+        response has its own status.
+        """
+        documents = root.findall(tag)
+        errors = [self._rejection(d) for d in documents]
+        if summarize and any(errors):
+            return 400, {}, self._error([e for e in errors if e][0])
+        response = Element("Response")
+        results = SubElement(response, root.tag)
+        for document, error in zip(documents, errors):
+            r = SubElement(results, tag)
+            if error:
+                SubElement(r, "StatusAttributeString").text = "ERROR"
+                SubElement(SubElement(SubElement(r, "ValidationErrors"),
+                                      "ValidationError"),
+                           "Message").text = error
+            else:
+                create(document, r)
+                SubElement(r, "StatusAttributeString").text = "OK"
+        return 200, {}, tostring(response)
+
+    def _invoice(self, invoice, result):
+        invid = str(uuid.uuid4())
+        self.invoices[invid] = invoice
+        SubElement(result, "InvoiceID").text = invid
+
+    def _payment(self, payment, result):
+        self.payments.append(payment)
+
+    def _error(self, message):
+        e = Element("ApiException")
+        SubElement(SubElement(SubElement(e, "ValidationErrors"),
+                              "ValidationError"), "Message").text = message
+        return tostring(e)
+
+class XeroOutboxTest(dbtest.DatabaseTest):
+    use_td = True
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if 'CASH' not in payment.methods:
+            cash.CashPayment('CASH', 'Cash', 'Change', account_code='090')
+        with td.orm_session():
+            business = models.Business(
+                id=1, name='Test', abbrev='TEST', address='An address')
+            vatband = models.VatBand(band='A', business=business, rate=20)
+            dept = models.Department(id=1, description="Test", vat=vatband,
+                                     accinfo="200/300")
+            pint = models.UnitType(id='pt', name='pint')
+            beer = models.StockType(
+                manufacturer="A Brewery", name="A Beer", shortname="A Beer",
+                abv=5, unit=pint, department=dept)
+            firkin = models.StockUnit(
+                id='firkin', name='Firkin', size=72, unit=pint)
+            td.s.add_all([
+                business, vatband, dept, beer, firkin,
+                models.TransCode(code='S', description='Sale'),
+                models.PayType(paytype='CASH', description='Cash'),
+                models.Supplier(name="Test supplier",
+                                accinfo=SUPPLIER_CONTACT)])
+        cls.mock = MockXero()
+        cls.xero = xero.XeroIntegration(
+            sales_contact=SALES_CONTACT, endpoint_url=cls.mock.url)
+        # Retry temporary failures straight away
+        cls.xero.outbox_retry_delay = lambda attempts: datetime.timedelta(0)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.mock.close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.mock.reset()
+
+    def tearDown(self):
+        with td.orm_session():
+            td.s.query(models.AccountsOutbox).delete()
+
+    def _session(self, amount=Decimal(10), date=None):
+        """Make a closed session with one sale and its totals recorded
+
+        Returns the session ID.
+        """
+        with td.orm_session():
+            session = models.Session(date or datetime.date.today())
+            t = models.Transaction(session=session)
+            td.s.add_all([
+                session, t,
+                models.Transline(transaction=t, items=1, amount=amount,
+                                 dept_id=1, transcode='S'),
+                models.Payment(transaction=t, amount=amount,
+                               paytype_id='CASH')])
+            td.s.flush()
+            t.closed = True
+            session.endtime = datetime.datetime.now()
+            td.s.add(models.SessionTotal(session=session, paytype_id='CASH',
+                                         amount=amount))
+            td.s.flush()
+            return session.id
+
+    def _delivery(self, date, docnumber, items=3):
+        """Make a confirmed delivery of some firkins
+
+        Returns the delivery ID.
+        """
+        with td.orm_session():
+            supplier = td.s.query(models.Supplier).one()
+            stocktype = td.s.query(models.StockType).one()
+            delivery = models.Delivery(
+                date=date, supplier=supplier, docnumber=docnumber,
+                checked=True)
+            td.s.add_all([delivery] + [
+                models.StockItem(delivery=delivery, stocktype=stocktype,
+                                 stockunit_id='firkin',
+                                 costprice=Decimal("80.00"))
+                for i in range(items)])
+            td.s.flush()
+            return delivery.id
+
+    def _queue_session(self, sessionid):
+        with td.orm_session():
+            self.xero._queue_session(sessionid)
+
+    def _entries(self):
+        with td.orm_session():
+            return [(e.kind, e.state, e.attempts, e.last_error)
+                    for e in td.s.query(models.AccountsOutbox)
+                    .order_by(models.AccountsOutbox.id)]
+
+    def test_session(self):
+        sessionid = self._session()
+        self._queue_session(sessionid)
+        # Nothing is sent until the outbox is processed
+        self.assertEqual(len(self.mock.requests), 0)
+        self.assertEqual(self.xero.process_outbox(), 2)
+        self.assertEqual(len(self.mock.invoices), 1)
+        invid = list(self.mock.invoices)[0]
+        self.assertEqual(len(self.mock.payments), 1)
+        self.assertEqual(self.mock.payments[0].findtext("Invoice/InvoiceID"),
+                         invid)
+        self.assertEqual(self.mock.payments[0].findtext("Account/Code"),
+                         "090")
+        self.assertEqual(self._entries(), [("invoice", "done", 1, None),
+                                           ("payments", "done", 1, None)])
+        with td.orm_session():
+            note = td.s.query(models.SessionNote)\
+                       .filter(models.SessionNote.sessionid == sessionid)\
+                       .one()
+            self.assertEqual(note.ntype, "xeroinv")
+            self.assertEqual(note.text, invid)
+        # Everything has been sent
+        self.assertEqual(self.xero.process_outbox(), 0)
+
+    def test_lost_response(self):
+        self.mock.lose_responses = 1
+        self._queue_session(self._session())
+        self.assertEqual(self.xero.process_outbox(), 3)
+        # The invoice was retried with the same idempotency key, so
+        # it was only created once
+        self.assertEqual(len(self.mock.requests), 3)
+        self.assertEqual(len(self.mock.invoices), 1)
+        self.assertEqual(len(self.mock.payments), 1)
+        self.assertEqual(self._entries(), [("invoice", "done", 2, None),
+                                           ("payments", "done", 1, None)])
+
+    def test_rejected(self):
+        self.mock.reject = "Account code '200' is not a valid code"
+        self._queue_session(self._session())
+        # The payments are not sent because the invoice failed
+        self.assertEqual(self.xero.process_outbox(), 1)
+        self.assertEqual(self._entries(), [
+            ("invoice", "failed", 1, "Xero rejected invoice: "
+             "Account code '200' is not a valid code"),
+            ("payments", "failed", 0,
+             "Not sent because the invoice it depends on failed")])
+        # Retrying the invoice retries the payments too
+        self.mock.reject = None
+        with td.orm_session():
+            invoice = td.s.query(models.AccountsOutbox)\
+                          .filter_by(kind='invoice')\
+                          .one()
+            with mock.patch("quicktill.ui.toast"):
+                self.xero._retry_outbox_entry(invoice.id)
+        self.assertEqual(self.xero.process_outbox(), 2)
+        self.assertEqual([e[1] for e in self._entries()], ["done", "done"])
+
+    def test_sent_after_commit(self):
+        deliveryid = self._delivery(datetime.date.today(), "uncommitted")
+        self.xero._wakeup.clear()
+        # Queueing a delivery leaves the caller's transaction open;
+        # if it is rolled back, nothing is sent
+        with self.assertRaises(RuntimeError), \
+             mock.patch("quicktill.ui.toast"):
+            with td.orm_session():
+                self.xero._send_delivery(deliveryid)
+                self.assertTrue(td.s.is_active)
+                raise RuntimeError
+        self.assertFalse(self.xero._wakeup.is_set())
+        self.assertEqual(self._entries(), [])
+        with td.orm_session(), mock.patch("quicktill.ui.toast"):
+            self.xero._send_delivery(deliveryid)
+            self.assertFalse(self.xero._wakeup.is_set())
+        # The worker is woken once the transaction commits
+        self.assertTrue(self.xero._wakeup.is_set())
+        self.assertEqual(self._entries(), [("bill", "pending", 0, None)])
+
+    def test_delivery_bill(self):
+        deliveryid = self._delivery(datetime.date.today(), "test")
+        with td.orm_session():
+            self.xero._queue("bill", self.xero._bill_xml_for_delivery(
+                deliveryid), deliveryid=deliveryid)
+        self.assertEqual(self.xero.process_outbox(), 1)
+        self.assertEqual(len(self.mock.invoices), 1)
+        invid, bill = list(self.mock.invoices.items())[0]
+        self.assertEqual(bill.findtext("Type"), "ACCPAY")
+        self.assertEqual(bill.findtext("LineItems/LineItem/Quantity"), "3")
+        with td.orm_session():
+            self.assertEqual(td.s.query(models.Delivery).get(deliveryid)
+                             .accinfo, invid)
+
+    def test_backfill(self):
+        date = datetime.date.today() - datetime.timedelta(days=30)
+        for i in range(BACKFILL_SESSIONS):
+            self._session(date=date)
+        for i in range(BACKFILL_DELIVERIES):
+            self._delivery(date, "backfill {}".format(i))
+        # A scaled down version of Xero's limits, with each request
+        # taking a little while
+        self.mock.rate_limit = (6, 1)
+        self.mock.delay = 0.1
+        start = time.monotonic()
+        with td.orm_session():
+            result = self.xero.backfill(date, date, batch_size=10,
+                                        workers=3, calls_per_minute=120)
+        elapsed = time.monotonic() - start
+        documents = BACKFILL_SESSIONS + BACKFILL_DELIVERIES
+        self.assertEqual(result, (documents + BACKFILL_SESSIONS, 0, 0))
+        # Invoices and bills in batches of 10, then payments
+        self.assertEqual(len(self.mock.requests),
+                         -(-documents // 10) - (-BACKFILL_SESSIONS // 10))
+        self.assertEqual(self.mock.rate_limited, 0)
+        self.assertLessEqual(self.mock.max_in_flight, 3)
+        self.assertEqual(len(self.mock.invoices), documents)
+        self.assertEqual(len(self.mock.payments), BACKFILL_SESSIONS)
+        # Three requests straight away, then two a second
+        self.assertGreaterEqual(elapsed, (len(self.mock.requests) - 3) / 2)
+        dbtest.benchmark_log.info(
+            "Backfilled %d documents in %d requests in %.2fs",
+            documents, len(self.mock.requests), elapsed)
+        with td.orm_session():
+            self.assertEqual(
+                td.s.query(models.SessionNote)
+                .join(models.Session)
+                .filter(models.Session.date == date)
+                .filter(models.SessionNote.ntype == 'xeroinv')
+                .count(), BACKFILL_SESSIONS)
+            self.assertEqual(
+                td.s.query(models.Delivery)
+                .filter(models.Delivery.date == date)
+                .filter(models.Delivery.accinfo != None)
+                .count(), BACKFILL_DELIVERIES)
+            # Nothing is sent twice
+            self.assertEqual(self.xero.backfill(date, date), (0, 0, 0))
+
+    def test_backfill_lost_response(self):
+        date = datetime.date.today() - datetime.timedelta(days=90)
+        self._session(date=date)
+        self._session(date=date)
+        # Xero creates the invoices, but the backfill never finds out
+        self.mock.lose_responses = 1
+        self.xero.backfill_retries = 1
+        self.addCleanup(delattr, self.xero, "backfill_retries")
+        with td.orm_session():
+            self.assertEqual(self.xero.backfill(date, date), (0, 0, 4))
+        self.assertEqual(len(self.mock.invoices), 2)
+        # The outbox sends the invoices again in the same batch, so
+        # they are not created twice, and then sends the payments
+        self.assertEqual(self.xero.process_outbox(), 4)
+        self.assertEqual(len(self.mock.invoices), 2)
+        self.assertEqual(len(self.mock.payments), 2)
+        self.assertEqual([e[1] for e in self._entries()], ["done"] * 4)
+        with td.orm_session():
+            self.assertEqual(td.s.query(models.AccountsOutbox)
+                             .filter(models.AccountsOutbox.batch_key != None)
+                             .count(), 0)
+
+    def test_backfill_rejected(self):
+        date = datetime.date.today() - datetime.timedelta(days=60)
+        self._session(date=date)
+        self._delivery(date, "good")
+        self._delivery(date, "bad")
+        self.mock.reject_document = lambda d: "Invoice number already used" \
+            if d.findtext("InvoiceNumber") == "bad" else None
+        with td.orm_session():
+            self.assertEqual(self.xero.backfill(date, date), (3, 1, 0))
+        self.assertEqual(len(self.mock.requests), 2)
+        self.assertEqual(self._entries(), [
+            ("invoice", "done", 1, None),
+            ("payments", "done", 1, None),
+            ("bill", "done", 1, None),
+            ("bill", "failed", 1,
+             "Xero rejected bill: Invoice number already used")])
+
+class RetryAfterTest(unittest.TestCase):
+    def test_seconds(self):
+        self.assertEqual(xero._retry_after("30"), 30)
+        self.assertIsNone(xero._retry_after(None))
+        self.assertIsNone(xero._retry_after("soon"))
+
+    def test_http_date(self):
+        when = datetime.datetime.now(datetime.timezone.utc) \
+            + datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(xero._retry_after(
+            email.utils.format_datetime(when, usegmt=True)), 30, delta=2)
+        # A date in the past means we can try again straight away
+        self.assertEqual(xero._retry_after(
+            "Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,15 +8,24 @@ module.
 # As the main entry point, any modules that define their own
 # subcommands must be imported here otherwise they will be ignored.
 
+import time
+# For the startup time report
+_import_start = time.monotonic()
 import urllib.request, urllib.parse, urllib.error
 import sys, os, logging, logging.config, locale, argparse, yaml
 import termios,fcntl,array
 import socket
-import time
+import hashlib
+import importlib.util
+import marshal
+import threading
+import contextlib
 from . import ui, td, printer, tillconfig, foodorder, user
 from . import pdrivers, cmdline, extras
 from . import dbsetup
 from . import dbutils
+from . import xero
+from . import delivery
 from . import kbdrivers
 from . import keyboard
 from .version import version
@@ -29,6 +38,164 @@ log=logging.getLogger(__name__)
 
 configurlfile="/etc/quicktill/configurl"
 
+# How long each stage of starting up took, in seconds
+_startup_times = [("imports", time.monotonic() - _import_start)]
+
+@contextlib.contextmanager
+def _startup_stage(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        _startup_times.append((name, time.monotonic() - start))
+
+def _report_startup_times():
+    log.info("Startup times: %s; %.3fs in total",
+             ", ".join("{} {:.3f}s".format(name, t)
+                       for name, t in _startup_times),
+             time.monotonic() - _import_start)
+
+class _configcache:
+    """The global configuration file
+
+    A copy of the last configuration that loaded successfully is kept
+    in tillconfig.cache_dir.  When we have a copy, the configuration
+    server is asked whether it has changed using a conditional
+    request, and given wait seconds to answer; if it doesn't answer
+    in time, or can't be reached, we start with the copy.  If a new
+    configuration arrives after we have given up waiting, it is kept
+    as a pending copy and used the next time the till starts.
+
+    The copy is always kept in the default tillconfig.cache_dir: a
+    cache_dir setting in the configuration file itself can't be known
+    until the configuration file has been loaded, so it is ignored
+    here.
+    """
+    def __init__(self, url, wait):
+        self.url = url
+        self.wait = wait
+        self.from_cache = False
+        self._fetched = None
+        self._late = False
+        self._lock = threading.Lock()
+        self._cachefile = None
+        if tillconfig.cache_dir:
+            self._cachefile = os.path.join(
+                tillconfig.cache_dir, "config-{}".format(
+                    hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]))
+
+    @staticmethod
+    def _fetch(url, etag, last_modified):
+        """Fetch and compile the configuration file
+
+        Returns None if it has not changed, otherwise a tuple of
+        (code, etag, last_modified).
+        """
+        request = urllib.request.Request(url)
+        if etag:
+            request.add_header('If-None-Match', etag)
+        if last_modified:
+            request.add_header('If-Modified-Since', last_modified)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as f:
+                source = f.read()
+                headers = f.headers
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return
+            raise
+        return (compile(source, url, 'exec'),
+                headers.get('ETag'), headers.get('Last-Modified'))
+
+    def _load(self, filename):
+        if not filename or not os.path.exists(filename):
+            return
+        try:
+            with open(filename, "rb") as f:
+                magic, url, code, etag, last_modified = marshal.load(f)
+        except Exception:
+            log.exception("Unable to read the cached configuration")
+            return
+        if magic != importlib.util.MAGIC_NUMBER or url != self.url:
+            return
+        return code, etag, last_modified
+
+    def _write(self, filename, fetched):
+        code, etag, last_modified = fetched
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename + ".new", "wb") as f:
+                marshal.dump((importlib.util.MAGIC_NUMBER, self.url,
+                              code, etag, last_modified), f)
+            os.replace(filename + ".new", filename)
+        except OSError as e:
+            log.warning("Unable to save the configuration cache: %s", e)
+
+    def get(self):
+        """Return the compiled configuration file"""
+        cached = self._load(self._cachefile)
+        if self._cachefile:
+            pending = self._load(self._cachefile + ".pending")
+            if pending:
+                # This arrived too late to be used last time.  It
+                # replaces the copy once it has loaded successfully;
+                # if it doesn't load, we don't try it again.
+                try:
+                    os.remove(self._cachefile + ".pending")
+                except OSError:
+                    pass
+                cached = pending
+                self._fetched = pending
+        if not cached:
+            self._fetched = self._fetch(self.url, None, None)
+            return self._fetched[0]
+        code, etag, last_modified = cached
+        result = []
+        def run():
+            try:
+                fetched = self._fetch(self.url, etag, last_modified)
+            except Exception as e:
+                fetched = e
+            with self._lock:
+                if self._late:
+                    if fetched is not None \
+                       and not isinstance(fetched, Exception) \
+                       and self._cachefile:
+                        self._write(self._cachefile + ".pending", fetched)
+                        log.info("The configuration file has changed; "
+                                 "it will be used when the till restarts")
+                    return
+                result.append(fetched)
+        t = threading.Thread(target=run, name="config", daemon=True)
+        t.start()
+        t.join(self.wait)
+        with self._lock:
+            if not result:
+                self._late = True
+                log.warning("Configuration server did not respond; "
+                            "using the cached configuration")
+                self.from_cache = True
+                return code
+        fetched = result[0]
+        if isinstance(fetched, Exception):
+            log.warning("Unable to fetch the configuration file (%s); "
+                        "using the cached configuration", fetched)
+            self.from_cache = True
+            return code
+        if fetched is None:
+            self.from_cache = True
+            return code
+        self._fetched = fetched
+        return fetched[0]
+
+    def save(self):
+        """Keep the configuration we fetched for next time
+
+        Call this once the configuration has been loaded successfully.
+        """
+        if self._cachefile and self._fetched:
+            self._write(self._cachefile, self._fetched)
+
 class intropage(ui.basicpage):
     def __init__(self):
         ui.basicpage.__init__(self)
@@ -102,6 +269,9 @@ class runtill(cmdline.command):
         debugp.add_argument(
             "--glib-mainloop", action="store_true", dest="glibmainloop",
             help="Use GLib mainloop")
+        debugp.add_argument(
+            "--asyncio-mainloop", action="store_true", dest="asynciomainloop",
+            help="Use asyncio mainloop")
         gtkp = parser.add_argument_group(
             title="display system arguments",
             description="The Gtk display system can be used instead of the "
@@ -153,6 +323,9 @@ class runtill(cmdline.command):
             else:
                 log.error("GLib not available")
                 return 1
+        elif args.asynciomainloop:
+            from . import event_asyncio
+            tillconfig.mainloop = event_asyncio.AsyncioMainLoop()
         else:
             from . import event
             tillconfig.mainloop = event.SelectorsMainLoop()
@@ -168,7 +341,23 @@ class runtill(cmdline.command):
         tillconfig.minimum_run_time = args.minimum_run_time
         tillconfig.minimum_lock_screen_time = args.minimum_lock_screen_time
         tillconfig.start_time = time.time()
-        td.init(tillconfig.database)
+        with _startup_stage("database connect"):
+            td.init(tillconfig.database, role=tillconfig.database_role)
+            try:
+                with td.orm_session():
+                    td.s.connection()
+            except Exception:
+                log.exception("Unable to connect to the database")
+        xero.start_workers()
+
+        # The display is first drawn just before the main loop runs
+        # for the first time
+        paint_start = time.monotonic()
+        def first_paint():
+            _startup_times.append(("first paint",
+                                   time.monotonic() - paint_start))
+            _report_startup_times()
+        tillconfig.mainloop.add_timeout(0, first_paint, desc="startup report")
 
         dbg_kbd = None
         try:
@@ -263,6 +452,11 @@ class totals(cmdline.command):
     """
     Display a table of session totals.
 
+    By default the most recent sessions are shown; a range of dates
+    can be given instead.  The output can be a table for people to
+    read, or CSV or JSON for other programs.  Amounts in JSON output
+    are strings to avoid loss of precision.
+
     """
     help = "display table of session totals"
 
@@ -270,50 +464,136 @@ class totals(cmdline.command):
     def add_arguments(parser):
         parser.add_argument("-d","--days",type=int,dest="days",
                             help="number of days to display",default=40)
+        parser.add_argument("--start",type=cmdline.date,dest="start",
+                            metavar="YYYY-MM-DD",
+                            help="display sessions from this date")
+        parser.add_argument("--end",type=cmdline.date,dest="end",
+                            metavar="YYYY-MM-DD",
+                            help="display sessions up to this date")
+        parser.add_argument("-f","--format",dest="format",default="text",
+                            choices=["text","csv","json"],
+                            help="output format")
+
     @staticmethod
     def run(args):
-        td.init(tillconfig.database)
-        with td.orm_session():
-            sessions=td.s.query(Session).\
+        from sqlalchemy.orm import undefer,subqueryload
+        from sqlalchemy.sql import desc
+        td.init(tillconfig.database, tillconfig.replica_database,
+                tillconfig.replica_max_lag)
+        with td.orm_session(readonly=True):
+            q=td.s.query(Session).\
                 filter(Session.endtime!=None).\
-                order_by(Session.id)[-args.days:]
+                options(undefer('total'),undefer('actual_total'),
+                        subqueryload('actual_totals'))
+            if args.start or args.end:
+                if args.start:
+                    q=q.filter(Session.date>=args.start)
+                if args.end:
+                    q=q.filter(Session.date<=args.end)
+                sessions=q.order_by(Session.id).all()
+            else:
+                sessions=q.order_by(desc(Session.id)).limit(args.days).all()
+                sessions.reverse()
+            # Sessions with no total recorded will report actual_total
+            # of None
+            sessions=[s for s in sessions if s.actual_total is not None]
+            archived=[str(s.id) for s in sessions if s.archived]
+            if archived:
+                print("Warning: records from sessions {} have been archived; "
+                      "their till totals are incomplete".format(
+                          ", ".join(archived)),file=sys.stderr)
             businesses=td.s.query(Business).order_by(Business.id).all()
-            f="{s.id:>5} | {s.date} | "
-            h="  ID  |    Date    | "
-            for x in tillconfig.all_payment_methods:
-                f=f+"{p[%s]:>8} | "%x.paytype
-                h=h+"{:^8} | ".format(x.description)
-            f=f+"{error:>7} | "
-            h=h+" Error  | "
-            for b in businesses:
-                if b.show_vat_breakdown:
-                    f=f+"{b[%s][1]:>10} | {b[%s][2]:>8} | "%(b.id,b.id)
-                    h=h+"{:^10} | {:^8} | ".format(
-                        b.abbrev+" ex-VAT",b.abbrev+" VAT")
-                else:
-                    f=f+"{b[%s][0]:>8} | "%b.id
-                    h=h+"{:^8} | ".format(b.abbrev)
-            f=f[:-2]
-            h=h[:-2]
-            print(h)
+            vbt=Session.vatband_totals_for_sessions(td.s,sessions)
+            rows=[]
             for s in sessions:
-                # Sessions with no total recorded will report actual_total
-                # of None
-                if s.actual_total is None: continue
-                vbt=s.vatband_totals
                 p={}
-                for x in tillconfig.all_payment_methods:
-                    p[x.paytype]=""
                 for t in s.actual_totals:
                     p[t.paytype_id]=t.amount
                 b={}
                 for x in businesses:
                     b[x.id]=(zero,zero,zero)
-                for x in vbt:
+                for x in vbt[s.id]:
                     o=b[x[0].businessid]
                     o=(o[0]+x[1],o[1]+x[2],o[2]+x[3])
                     b[x[0].businessid]=o
-                print(f.format(s=s,p=p,error=s.actual_total-s.total,b=b))
+                rows.append((s,p,b,vbt[s.id]))
+            if args.format=="csv":
+                totals._csv(rows,businesses)
+            elif args.format=="json":
+                totals._json(rows,businesses)
+            else:
+                totals._text(rows,businesses)
+
+    @staticmethod
+    def _text(rows,businesses):
+        f="{s.id:>5} | {s.date} | "
+        h="  ID  |    Date    | "
+        for x in tillconfig.all_payment_methods:
+            f=f+"{p[%s]:>8} | "%x.paytype
+            h=h+"{:^8} | ".format(x.description)
+        f=f+"{error:>7} | "
+        h=h+" Error  | "
+        for b in businesses:
+            if b.show_vat_breakdown:
+                f=f+"{b[%s][1]:>10} | {b[%s][2]:>8} | "%(b.id,b.id)
+                h=h+"{:^10} | {:^8} | ".format(
+                    b.abbrev+" ex-VAT",b.abbrev+" VAT")
+            else:
+                f=f+"{b[%s][0]:>8} | "%b.id
+                h=h+"{:^8} | ".format(b.abbrev)
+        f=f[:-2]
+        h=h[:-2]
+        print(h)
+        for s,p,b,vbt in rows:
+            pt={}
+            for x in tillconfig.all_payment_methods:
+                pt[x.paytype]=p.get(x.paytype,"")
+            print(f.format(s=s,p=pt,error=s.actual_total-s.total,b=b))
+
+    @staticmethod
+    def _csv(rows,businesses):
+        import csv
+        paytypes=[x.paytype for x in tillconfig.all_payment_methods]
+        w=csv.writer(sys.stdout)
+        h=["id","date","total","actual_total","error"]
+        h=h+["paid {}".format(x) for x in paytypes]
+        for b in businesses:
+            h=h+["{} total".format(b.abbrev),"{} ex-VAT".format(b.abbrev),
+                 "{} VAT".format(b.abbrev)]
+        w.writerow(h)
+        for s,p,b,vbt in rows:
+            r=[s.id,s.date,s.total,s.actual_total,s.actual_total-s.total]
+            r=r+[p.get(x,"") for x in paytypes]
+            for x in businesses:
+                r=r+list(b[x.id])
+            w.writerow(r)
+
+    @staticmethod
+    def _json(rows,businesses):
+        babbrev={b.id:b.abbrev for b in businesses}
+        out=[]
+        for s,p,b,vbt in rows:
+            out.append({
+                'id':s.id,
+                'date':str(s.date),
+                'total':str(s.total),
+                'actual_total':str(s.actual_total),
+                'error':str(s.actual_total-s.total),
+                'payments':{k:str(v) for k,v in p.items()},
+                'businesses':{babbrev[k]:{'total':str(v[0]),
+                                          'exvat':str(v[1]),
+                                          'vat':str(v[2])}
+                              for k,v in b.items()},
+                'vatbands':[{'band':v.band,
+                             'business':babbrev[v.businessid],
+                             'rate':str(v.rate),
+                             'total':str(t),
+                             'exvat':str(ex),
+                             'vat':str(vat)}
+                            for v,t,ex,vat in vbt],
+            })
+        json.dump(out,sys.stdout,indent=2)
+        print()
 
 def _linux_unblank_screen():
     TIOCL_UNBLANKSCREEN=4
@@ -347,6 +627,11 @@ def main():
                         dest="configurl", default=configurl,
                         help="URL of global till configuration file; overrides "
                         "contents of %s"%configurlfile)
+    parser.add_argument("--config-wait", action="store", type=float,
+                        dest="config_wait", default=0.5, metavar="SECONDS",
+                        help="When there is a cached copy of the global "
+                        "configuration file, wait this long for the "
+                        "configuration server before using the copy")
     parser.add_argument("-c", "--config-name", action="store",
                         dest="configname", default="default",
                         help="Till type to use from configuration file")
@@ -354,6 +639,11 @@ def main():
                         dest="database",
                         help="Database connection string; overrides "
                         "database specified in configuration file")
+    parser.add_argument("--replica-database", action="store",
+                        dest="replica_database",
+                        help="Database connection string for a replica "
+                        "to be used by reports; overrides replica specified "
+                        "in configuration file")
     parser.add_argument("-f", "--user", action="store",
                         dest="user", type=int, default=None,
                         help="User ID to use when no other user information "
@@ -373,7 +663,8 @@ def main():
                         "instead of the configured printer")
     cmdline.command.add_subparsers(parser)
     parser.set_defaults(configurl=configurl, configname="default",
-                        database=None, logfile=None, debug=False,
+                        database=None, replica_database=None,
+                        logfile=None, debug=False,
                         interactive=False, disable_printer=False)
     args = parser.parse_args()
 
@@ -385,9 +676,6 @@ def main():
     if args.debug:
         tillconfig.debug = True
     tillconfig.configversion = args.configurl
-    f = urllib.request.urlopen(args.configurl)
-    globalconfig = f.read()
-    f.close()
 
     # Logging configuration.  If we have a log configuration file,
     # read it and apply it.  This is done before the main
@@ -423,10 +711,15 @@ def main():
     toasthandler.setLevel(logging.WARNING)
     rootlog.addHandler(toasthandler)
 
+    configfile = _configcache(args.configurl, args.config_wait)
+    with _startup_stage("config fetch"):
+        globalconfig = configfile.get()
+
     import imp
     g = imp.new_module("globalconfig")
     g.configname = args.configname
-    exec(globalconfig, g.__dict__)
+    with _startup_stage("config exec"):
+        exec(globalconfig, g.__dict__)
 
     config = g.configurations.get(args.configname)
     if config is None:
@@ -435,6 +728,7 @@ def main():
         for i in list(g.configurations.keys()):
             print("%s: %s"%(i,g.configurations[i]['description']))
         sys.exit(1)
+    configfile.save()
 
     if args.user:
         tillconfig.default_user = args.user
@@ -450,9 +744,24 @@ def main():
     tillconfig.database = config.get('database')
     if args.database is not None:
         tillconfig.database = args.database
+    tillconfig.replica_database = config.get('replica_database')
+    if args.replica_database is not None:
+        tillconfig.replica_database = args.replica_database
+    tillconfig.replica_max_lag = config.get('replica_max_lag')
+    if 'ping_idle_time' in config:
+        td.ping_idle_time = config['ping_idle_time']
+    if 'database_pool' in config:
+        td.pool_options = config['database_pool']
+    td.transaction_pooling = config.get('database_transaction_pooling', False)
+    tillconfig.database_role = config.get('database_role', 'till')
+    tillconfig.server_side_sales = config.get('server_side_sales', False)
     if 'kitchenprinter' in config:
         foodorder.kitchenprinter = config['kitchenprinter']
     foodorder.menuurl = config.get('menuurl')
+    # This doesn't affect the copy of the configuration file itself;
+    # see _configcache
+    if 'cache_dir' in config:
+        tillconfig.cache_dir = config['cache_dir']
     tillconfig.pubname = config['pubname']
     tillconfig.pubnumber = config['pubnumber']
     tillconfig.pubaddr = config['pubaddr']
@@ -5,6 +5,7 @@ most of the entries here.
 
 """
 
+import os
 from .models import penny
 
 # Has the --debug flag been set on the command line?
@@ -36,8 +37,29 @@ checkdigit_on_usestock=False
 
 database=None
 
+# Optional replica of the database for reports, and the maximum
+# replication lag in seconds that we will accept before falling back
+# to the primary database
+replica_database=None
+replica_max_lag=None
+
+# Which kind of process this is, for the database connection pool
+# settings: "till" or "stockterminal"; commands always use "command"
+database_role="till"
+
+# Sell from stocklines using the stockline_sale() database function
+# instead of working out the stock allocation here
+server_side_sales=False
+
 firstpage=None
 
+# Directory for local copies of things fetched from elsewhere, so
+# that they are available straight away when the till starts.  None
+# to disable.
+cache_dir = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser("~/.cache")),
+    "quicktill")
+
 # Called by ui code whenever a usertoken is processed by the default
 # page's hotkey handler
 def usertoken_handler(t):
@@ -20,8 +20,13 @@ from sqlalchemy.sql.expression import tuple_, func, null
 from sqlalchemy import distinct
 from quicktill.models import *
 from quicktill.version import version
+from quicktill.replica import readonly_session
 from . import spreadsheets
+from collections import Counter
+import threading
 import io
+import logging
+log = logging.getLogger(__name__)
 
 # We use this date format in templates - defined here so we don't have
 # to keep repeating it.  It's available in templates as 'dtf'
@@ -59,15 +64,77 @@ def publist(request):
 # user - the quicktill.models.User object if available, or 'R','M','F'
 # session - sqlalchemy database session
 
-def tillweb_view(view):
+# Read-only views are run against a replica of the till database if
+# one is configured, falling back to the primary database if the
+# replica is unavailable or more than TILLWEB_REPLICA_MAX_LAG seconds
+# behind.  In single-site mode the replica is TILLWEB_REPLICA_DATABASE;
+# otherwise it is looked up by till database name in
+# SQLALCHEMY_REPLICA_SESSIONS.  Views that write to the database must
+# be declared with @tillweb_view(primary=True).
+
+# Database queries made by views are subject to statement_timeout
+# (seconds, or None for no limit).  Views that can run expensive
+# queries, for example over a wide date range, are declared with
+# @tillweb_view(heavy=True): they have heavy_statement_timeout
+# instead, and no more than heavy_concurrency of them can run at once
+# for each pub in each server process.  Further requests wait for up
+# to heavy_queue_timeout seconds and are then turned away with a
+# "busy" page.  The defaults below can be overridden for all pubs in
+# the TILLWEB_QUERY_LIMITS setting, and for individual pubs in the
+# TILLWEB_PUB_QUERY_LIMITS setting which is a dict keyed by pubname.
+default_query_limits = {
+    'statement_timeout': 60,
+    'heavy_statement_timeout': 300,
+    'heavy_concurrency': 2,
+    'heavy_queue_timeout': 10,
+}
+
+# Requests turned away as busy, and queries cancelled by
+# statement_timeout, counted by pubname
+query_limit_counts = {
+    'busy': Counter(),
+    'timeout': Counter(),
+}
+
+_heavy_semaphores = {}
+_heavy_semaphores_lock = threading.Lock()
+
+def query_limits(pubname):
+    """Query limits in force for a pub"""
+    limits = dict(default_query_limits)
+    limits.update(getattr(settings, 'TILLWEB_QUERY_LIMITS', {}))
+    limits.update(getattr(settings, 'TILLWEB_PUB_QUERY_LIMITS', {})
+                  .get(pubname, {}))
+    return limits
+
+def _heavy_semaphore(pubname, concurrency):
+    with _heavy_semaphores_lock:
+        if pubname not in _heavy_semaphores:
+            _heavy_semaphores[pubname] = threading.BoundedSemaphore(
+                concurrency)
+        return _heavy_semaphores[pubname]
+
+def _busy(request, pubname, till, access, reason):
+    query_limit_counts[reason][pubname] += 1
+    response = render(request, 'tillweb/busy.html',
+                      {'object': till, 'access': access, 'reason': reason},
+                      status=503)
+    response['Retry-After'] = "30"
+    return response
+
+def tillweb_view(view=None, primary=False, heavy=False):
+    if view is None:
+        return lambda view: tillweb_view(view, primary=primary, heavy=heavy)
     single_site = getattr(settings, 'TILLWEB_SINGLE_SITE', False)
     tillweb_login_required = getattr(settings, 'TILLWEB_LOGIN_REQUIRED', True)
+    replica_max_lag = getattr(settings, 'TILLWEB_REPLICA_MAX_LAG', None)
     def new_view(request, pubname="", *args, **kwargs):
         if single_site:
             till = None
             tillname = settings.TILLWEB_PUBNAME
             access = settings.TILLWEB_DEFAULT_ACCESS
-            session = settings.TILLWEB_DATABASE()
+            sm = settings.TILLWEB_DATABASE
+            replica = getattr(settings, 'TILLWEB_REPLICA_DATABASE', None)
         else:
             try:
                 till = Till.objects.get(slug=pubname)
@@ -79,13 +146,39 @@ def tillweb_view(view):
                 # Pretend it doesn't exist!
                 raise Http404
             try:
-                session = settings.SQLALCHEMY_SESSIONS[till.database]()
+                sm = settings.SQLALCHEMY_SESSIONS[till.database]
             except ValueError:
                 # The database doesn't exist
                 raise Http404
+            replica = getattr(settings, 'SQLALCHEMY_REPLICA_SESSIONS', {})\
+                      .get(till.database)
             tillname = till.name
             access = access.permission
+        limits = query_limits(pubname)
+        slot = None
+        session = None
         try:
+            if heavy:
+                semaphore = _heavy_semaphore(
+                    pubname, limits['heavy_concurrency'])
+                if not semaphore.acquire(
+                        timeout=limits['heavy_queue_timeout']):
+                    log.warning("Turned away %s for %s: too many heavy "
+                                "requests", request.path, tillname)
+                    return _busy(request, pubname, till, access, 'busy')
+                slot = semaphore
+            if primary:
+                session = sm()
+            else:
+                session = readonly_session(sm, replica, replica_max_lag)
+            timeout = limits['heavy_statement_timeout' if heavy
+                             else 'statement_timeout']
+            if timeout:
+                # SET LOCAL lasts until the end of the current
+                # transaction, so the setting never outlives the
+                # request on a pooled connection
+                session.execute("SET LOCAL statement_timeout = {:d}".format(
+                    int(timeout * 1000)))
             info = {
                 'access': access,
                 'tillname': tillname, # Formatted for people
@@ -112,13 +205,21 @@ def tillweb_view(view):
             defaults.update(d)
             return render(request, 'tillweb/' + t, defaults)
         except OperationalError as oe:
+            if getattr(oe.orig, 'pgcode', None) == '57014':
+                # query_canceled: statement_timeout has expired
+                log.warning("Statement timeout on %s for %s",
+                            request.path, tillname)
+                return _busy(request, pubname, till, access, 'timeout')
             t = get_template('tillweb/operationalerror.html')
             return HttpResponse(
                 t.render(RequestContext(
                         request, {'object':till, 'access':access, 'error':oe})),
                 status=503)
         finally:
-            session.close()
+            if session is not None:
+                session.close()
+            if slot:
+                slot.release()
     if tillweb_login_required or not single_site:
         new_view = login_required(new_view)
     return new_view
@@ -365,7 +466,7 @@ class SessionSheetForm(forms.Form):
         ("Weeks", "Weeks"),
         ])
 
-@tillweb_view
+@tillweb_view(heavy=True)
 def sessionfinder(request, info, session):
     if request.method == 'POST' and "submit_find" in request.POST:
         form = SessionFinderForm(request.POST)
@@ -423,7 +524,7 @@ def session(request, info, session, sessionid):
     return ('session.html',
             {'session': s, 'nextlink': nextlink, 'prevlink': prevlink})
 
-@tillweb_view
+@tillweb_view(heavy=True)
 def session_spreadsheet(request, info, session, sessionid):
     s = session\
         .query(Session)\
@@ -817,7 +918,7 @@ class StockCheckForm(forms.Form):
         min_value=0.0, initial=1.0)
     department = forms.ChoiceField()
 
-@tillweb_view
+@tillweb_view(heavy=True)
 def stockcheck(request, info, session):
     buylist = []
     depts = session\
@@ -1,24 +1,164 @@
 import requests
-from . import ui, keyboard
+import urllib3
+import threading
+import time
+from . import ui, keyboard, tillconfig
+
+import logging
+log = logging.getLogger(__name__)
 
 pinlength = 8
 
 class Api(object):
-    """A python interface to the Timesheet API"""
-    def __init__(self, username, password, site, base_url, timeout = 4):
+    """A python interface to the Timesheet API
+
+    Requests are made on worker threads, and their results are passed
+    back through the main loop, so a slow timesheet server doesn't
+    hold up the till.  Requests that could not be delivered to the
+    server are retried up to retries times.
+
+    The staff list is cached for cache_ttl seconds.  After that the
+    cached list is still used, but is refreshed in the background
+    with a conditional request, so the server only sends the list
+    again if it has changed.
+    """
+    def __init__(self, username, password, site, base_url, timeout=4,
+                 cache_ttl=300, retries=3, retry_delay=2):
         self._site = site
         self._base_url = base_url
         self._auth = (username, password)
         self._timeout = timeout
-    def get_users(self):
+        self._cache_ttl = cache_ttl
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._users = None
+        self._users_etag = None
+        self._users_fetched = None
+        self._users_refreshing = False
+        # (result, error) callbacks waiting for the first staff list
+        self._users_waiting = []
+
+    def _background(self, func, args, result, error):
+        """Call func(*args) on a worker thread
+
+        result or error is called from the main loop with the return
+        value or the exception.
+        """
+        def deliver(callback, value):
+            tillconfig.mainloop.call_from_thread(lambda: callback(value))
+
+        def run():
+            attempt = 0
+            while True:
+                try:
+                    r = func(*args)
+                except Exception as e:
+                    if attempt < self._retries and _retryable(e):
+                        attempt += 1
+                        log.info("Timesheet request failed, retrying: %s", e)
+                        time.sleep(self._retry_delay * 2 ** (attempt - 1))
+                        continue
+                    deliver(error, e)
+                    return
+                deliver(result, r)
+                return
+
+        threading.Thread(target=run, name="timesheets", daemon=True).start()
+
+    def _get_users(self, etag):
+        """Fetch the staff list
+
+        Returns a tuple of the list and its ETag, or None instead of
+        the list if it has not changed since etag.
+        """
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
         r = requests.get(self._site + self._base_url, auth=self._auth,
-                         timeout=self._timeout, verify=True)
-        return [User(self,x) for x in r.json()]
-    def action_with_pin(self, url, pin):
+                         headers=headers, timeout=self._timeout, verify=True)
+        if r.status_code == 304:
+            return None, etag
+        r.raise_for_status()
+        return r.json(), r.headers.get('ETag')
+
+    @property
+    def cached_users(self):
+        """The staff list fetched before, or None if there isn't one"""
+        return self._users
+
+    def users(self, result, error):
+        """Get the staff list
+
+        If a list has been fetched before, result is called with it
+        straight away, and the list is refreshed in the background if
+        it is out of date.  Otherwise result or error is called when
+        the server responds.
+        """
+        if self._users is not None:
+            if time.monotonic() - self._users_fetched > self._cache_ttl:
+                self.refresh_users()
+            result(self._users)
+            return
+        self._users_waiting.append((result, error))
+        self.refresh_users()
+
+    def refresh_users(self):
+        """Refresh the staff list in the background"""
+        if self._users_refreshing:
+            return
+        self._users_refreshing = True
+        self._background(self._get_users, (self._users_etag,),
+                         self._users_received, self._users_failed)
+
+    def _users_received(self, response):
+        self._users_refreshing = False
+        data, etag = response
+        if data is not None:
+            self._users = [User(self, x) for x in data]
+            self._users_etag = etag
+        self._users_fetched = time.monotonic()
+        waiting, self._users_waiting = self._users_waiting, []
+        for result, error in waiting:
+            result(self._users)
+
+    def _users_failed(self, e):
+        # Carry on using the old list, if there is one
+        self._users_refreshing = False
+        log.warning("Failed to fetch the timesheet staff list: %s", e)
+        waiting, self._users_waiting = self._users_waiting, []
+        for result, error in waiting:
+            error(e)
+
+    def _action_with_pin(self, url, pin):
         r = requests.post(self._site + url, data={'pin':pin},
                           auth=self._auth, timeout=self._timeout, verify=True)
+        if r.status_code >= 500:
+            r.raise_for_status()
         return r.json()
 
+    def action_with_pin(self, url, pin, result, error):
+        self._background(self._action_with_pin, (url, pin), result, error)
+
+def _retryable(e):
+    """Is it worth making a request again after this exception?
+
+    Only requests that the server didn't act on are retried: those
+    that never reached it, and those it turned away as unavailable.
+    Requests that timed out waiting for a response, or whose
+    connection was lost part way through, aren't retried because the
+    server may have acted on them.  Nor are those answered by a
+    gateway error, because a proxy may have passed the request on
+    before the answer was lost.
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], 'reason', None),
+                          urllib3.exceptions.NewConnectionError)
+    if isinstance(e, requests.HTTPError):
+        return e.response.status_code == 503
+    return False
+
 class User(object):
     def __init__(self, api, d):
         self._api = api
@@ -27,66 +167,121 @@ class User(object):
         self.fullname = d['fullname']
         self.pin = None
         self.actions_url = None
-    def check_pin(self, pin):
-        ok = self._api.action_with_pin(self.url,pin)
-        if ok:
-            self.pin = pin
-        return ok
-    def action(self, action):
-        return self._api.action_with_pin(action, self.pin)
-
-class ActionPopup(ui.menu):
-    def __init__(self, user, url):
-        acts = None
-        with ui.exception_guard("performing the requested action"):
-            acts = user.action(url)
-        if acts is None: return
-        try:
-            title = acts.get('title', 'Action')
-            message = acts.get('message', None)
-            actions = acts.get('actions', [])
-            l = [(a['action'], ActionPopup, (user, a['url']))
-                 for a in actions]
-        except:
-            ui.popup_exception("Invalid response from server")
+    def check_pin(self, pin, result, error):
+        def checked(ok):
+            if ok:
+                self.pin = pin
+            result(ok)
+        self._api.action_with_pin(self.url, pin, checked, error)
+    def action(self, action, result, error):
+        self._api.action_with_pin(action, self.pin, result, error)
+
+class waitpopup(ui.infopopup):
+    """Tell the user we are waiting for the timesheet server
+
+    The popup can be dismissed while we wait; if it has been, the
+    response should be ignored.
+    """
+    def __init__(self, message):
+        self.dismissed = False
+        super().__init__([message], title="Timesheets",
+                         colour=ui.colour_info)
+
+    def dismiss(self):
+        self.dismissed = True
+        super().dismiss()
+
+def _show_error(doing):
+    def error(e):
+        ui.infopopup(["There was a problem {}: {}".format(doing, e)],
+                     title="Timesheets")
+    return error
+
+def _if_waiting(wait, callback):
+    """Call callback only if the user is still waiting for it"""
+    def call(value):
+        if wait.dismissed:
             return
-        if len(l) > 0:
-            l=[("Don't do anything - just reload the list of available actions",
-                ActionPopup, (user, url))] + l
-            ui.menu.__init__(self, l, title=title,
-                             blurb=[message] if message else [])
-        else:
-            ui.infopopup([message], title=title, colour=ui.colour_info,
-                         dismiss=keyboard.K_CASH)
+        wait.dismiss()
+        callback(value)
+    return call
+
+def action_popup(user, url):
+    wait = waitpopup("Contacting the timesheet server...")
+    user.action(
+        url, _if_waiting(wait, lambda acts: _show_actions(user, url, acts)),
+        _if_waiting(wait, _show_error("performing the requested action")))
+
+def _show_actions(user, url, acts):
+    try:
+        title = acts.get('title', 'Action')
+        message = acts.get('message', None)
+        actions = acts.get('actions', [])
+        l = [(a['action'], action_popup, (user, a['url']))
+             for a in actions]
+    except:
+        ui.popup_exception("Invalid response from server")
+        return
+    if len(l) > 0:
+        l=[("Don't do anything - just reload the list of available actions",
+            action_popup, (user, url))] + l
+        ui.menu(l, title=title, blurb=[message] if message else [])
+    else:
+        ui.infopopup([message], title=title, colour=ui.colour_info,
+                     dismiss=keyboard.K_CASH)
 
 class enterpin(ui.dismisspopup):
     def __init__(self,user):
         self.user=user
+        self.checking = False
         ui.dismisspopup.__init__(self,5,20+pinlength,title=user.fullname,
                                  colour=ui.colour_input)
         self.addstr(2,2,"Enter your PIN:")
         self.pinfield=ui.editfield(2,18,pinlength,keymap={
                 keyboard.K_CASH:(self.enter,None,False)})
         self.pinfield.focus()
+    def dismiss(self):
+        self.checking = False
+        super().dismiss()
     def enter(self):
-        ok = None
-        with ui.exception_guard("checking the PIN"):
-            ok = self.user.check_pin(self.pinfield.f)
-        if ok is None:
-            self.pinfield.set('')
+        if self.checking:
+            return
+        self.checking = True
+        self.addstr(3, 2, "Checking...")
+        self.user.check_pin(self.pinfield.f, self._checked, self._failed)
+    def _checked(self, ok):
+        if not self.checking:
+            # Dismissed while we were waiting
             return
+        self.checking = False
+        self.addstr(3, 2, "           ")
         if ok:
             self.dismiss()
-            ActionPopup(self.user, ok)
+            action_popup(self.user, ok)
         else:
             self.pinfield.set('')
             ui.infopopup(["Incorrect PIN."], title="Error")
+    def _failed(self, e):
+        if not self.checking:
+            return
+        self.checking = False
+        self.addstr(3, 2, "           ")
+        self.pinfield.set('')
+        _show_error("checking the PIN")(e)
+
+def popup(api):
+    """Choose a member of staff to use the timesheets
 
-class popup(ui.menu):
-    def __init__(self,api):
-        users = None
-        with ui.exception_guard("fetching the staff list"):
-            users = api.get_users()
+    If the staff list has been fetched before, the menu appears
+    straight away.
+    """
+    def show(users):
         if users:
             l = [(u.fullname,enterpin,(u,)) for u in users]
-            ui.menu.__init__(self,l,title="Who are you?",blurb=[])
+            ui.menu(l,title="Who are you?",blurb=[])
+    if api.cached_users is not None:
+        api.users(show, _show_error("fetching the staff list"))
+        return
+    wait = waitpopup("Fetching the staff list...")
+    api.users(_if_waiting(wait, show),
+              _if_waiting(wait, _show_error("fetching the staff list")))
@@ -103,6 +103,8 @@ def current_user():
     Look up the focus stack and return the first user information
     found, or None if there is none.
     """
+    if not basicwin._focus:
+        return
     stack = basicwin._focus.parents()
     for i in stack:
         if hasattr(i, 'user'):
@@ -1,9 +1,14 @@
-import requests
-from oauthlib.oauth1 import SIGNATURE_RSA, SIGNATURE_TYPE_AUTH_HEADER, SIGNATURE_HMAC
-from requests_oauthlib import OAuth1
 from xml.etree.ElementTree import Element, SubElement, tostring, fromstring
 import datetime
+import email.utils
+import time
 import logging
+import threading
+import concurrent.futures
+import uuid
+from sqlalchemy import or_, func, event
+from sqlalchemy.orm import aliased
+from sqlalchemy.orm import Session as ORMSession
 from . import session
 from . import payment
 from . import ui
@@ -11,8 +16,11 @@ from . import td
 from . import user
 from . import delivery
 from . import keyboard
+from . import cmdline
+from . import tillconfig
+from .plugins import InstancePluginMount
 from .models import Session, SessionNoteType, SessionNote, zero
-from .models import Delivery, Supplier
+from .models import Delivery, Supplier, AccountsOutbox
 log = logging.getLogger(__name__)
 
 XERO_ENDPOINT_URL = "https://api.xero.com/api.xro/2.0/"
@@ -20,6 +28,37 @@ XERO_ENDPOINT_URL = "https://api.xero.com/api.xro/2.0/"
 class XeroError(Exception):
     pass
 
+class XeroTemporaryError(XeroError):
+    """A failure that may go away if the request is tried again later
+
+    retry_after is the number of seconds Xero asked us to wait before
+    trying again, if it said.
+    """
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def _retry_after(value):
+    """Number of seconds to wait given by a Retry-After header
+
+    The header may be either a number of seconds or an HTTP date.
+    Returns None if it is absent or can't be understood.
+    """
+    if not value:
+        return None
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max((when - datetime.datetime.now(datetime.timezone.utc))
+               .total_seconds(), 0)
+
 class XeroSessionHooks(session.SessionHooks):
     def __init__(self, xero):
         self.xero = xero
@@ -39,30 +78,14 @@ class XeroSessionHooks(session.SessionHooks):
         # Commit at this point to ensure the totals are recorded in
         # the till database.
         td.s.commit()
-        ui.toast("Sending session details to accounting system...")
         try:
             with ui.exception_guard("creating the Xero invoice",
                                     suppress_exception=False):
-                invid = self.xero._create_invoice_for_session(
-                    sessionid, approve=True)
+                self.xero._queue_session(sessionid)
         except XeroError:
             return
-        # Record the Xero invoice ID as a note against the session
-        id_note_type = td.s.merge(
-            SessionNoteType(id="xeroinv", description="Xero InvoiceID"))
-        id_note = SessionNote(session=session, type=id_note_type,
-                              text=invid, user=user.current_dbuser())
-        td.s.add(id_note)
-        # We want to commit the invoice ID to the database even if adding
-        # payments fails, so we can try again later
         td.s.commit()
-        try:
-            with ui.exception_guard("adding payments to the Xero invoice",
-                                    suppress_exception=False):
-                self.xero._add_payments_for_session(sessionid, invid)
-        except XeroError:
-            return
-        ui.toast("Session details uploaded to Xero.")
+        ui.toast("Session details queued for sending to Xero.")
 
 class XeroDeliveryHooks(delivery.DeliveryHooks):
     def __init__(self, xero):
@@ -100,14 +123,79 @@ class XeroDeliveryHooks(delivery.DeliveryHooks):
             return
         self.xero._send_delivery(deliveryid)
 
-class XeroIntegration:
+# Documents queued by _queue() are sent once the database transaction
+# that queued them has been committed
+@event.listens_for(ORMSession, "after_commit")
+def _wake_after_commit(s):
+    xero = s.info.pop('xero_wake', None)
+    if xero:
+        xero.wake()
+
+@event.listens_for(ORMSession, "after_rollback")
+def _forget_wake(s):
+    s.info.pop('xero_wake', None)
+
+def _session_note_for_invoice(s, entry):
+    # Record the Xero invoice ID as a note against the session
+    id_note_type = s.merge(
+        SessionNoteType(id="xeroinv", description="Xero InvoiceID"))
+    s.add(SessionNote(sessionid=entry.sessionid, type=id_note_type,
+                      text=entry.result, user_id=entry.user_id))
+
+def _delivery_bill(s, entry):
+    entry.delivery.accinfo = entry.result
+
+class TokenBucket:
+    """Limit the rate at which requests are made
+
+    Up to capacity requests may be made straight away; after that,
+    requests are allowed at rate per second.  May be shared between
+    threads.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Wait until a request may be made"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class XeroIntegration(metaclass=InstancePluginMount):
     """Xero accounting system integration
 
     To integrate with Xero, create an instance of this class in the
     till configuration file.  You should add an "Apps" menu entry that
     calls the instance's app_menu() method to enable users to access
     the integration utilities menu.
+
+    Invoices, payments and bills are not sent to Xero while the user
+    waits.  They are written to the accounts_outbox table and sent by
+    a background thread, which retries them with increasing delays
+    until Xero accepts or rejects them.  The thread is started by
+    start_workers() when the till starts on a terminal with access to
+    Xero, so that documents left in the outbox when the till last
+    stopped are sent.  Other commands leave the outbox to the tills.
     """
+    # Where to send the results of sending each kind of document
+    _outbox_paths = {
+        'invoice': ("Invoices/", _session_note_for_invoice),
+        'payments': ("Payments/", None),
+        'bill': ("Invoices/", _delivery_bill),
+    }
 
     def __init__(self,
                  # oauth parameters - if absent, integration will prevent
@@ -137,10 +225,20 @@ class XeroIntegration:
                  # Use this account for till discrepancies
                  discrepancy_account=None,
                  # Only start sending totals to Xero on or after this date
-                 start_date=None):
+                 start_date=None,
+                 # Xero API endpoint
+                 endpoint_url=XERO_ENDPOINT_URL,
+                 # How often the background thread looks for work
+                 # queued by other terminals, in seconds
+                 outbox_poll_interval=60):
         XeroSessionHooks(self)
         XeroDeliveryHooks(self)
         if consumer_key and private_key:
+            # This module is imported by every till for its commands;
+            # only tills that use Xero need requests and oauthlib
+            from oauthlib.oauth1 import SIGNATURE_RSA
+            from oauthlib.oauth1 import SIGNATURE_TYPE_AUTH_HEADER
+            from requests_oauthlib import OAuth1
             self.oauth = OAuth1(
                 consumer_key,
                 resource_owner_key=consumer_key,
@@ -160,6 +258,10 @@ class XeroIntegration:
         self.shortcode = shortcode
         self.discrepancy_account = discrepancy_account
         self.start_date = start_date
+        self.endpoint_url = endpoint_url
+        self.outbox_poll_interval = outbox_poll_interval
+        self._worker = None
+        self._wakeup = threading.Event()
 
     def _get_sales_contact(self, session):
         if callable(self.sales_contact):
@@ -208,6 +310,8 @@ class XeroIntegration:
             ("Re-send a delivery to Xero as a bill",
              choose_delivery,
              (self._send_delivery, self.start_date, True)),
+            ("Show the queue of documents waiting to be sent to Xero",
+             self._outbox_menu, ()),
             ("Test the connection to Xero",
              self.check_connection, ()),
             ("Xero debug menu",
@@ -298,12 +402,10 @@ class XeroIntegration:
         if len(codes) > 2:
             return codes[2]
     
-    def _create_invoice_for_session(self, sessionid, approve=False):
-        """Create an invoice for a session
+    def _invoice_xml_for_session(self, sessionid, approve=False):
+        """Build an invoice for a session
 
-        Returns the invoice's GUID.  Does not check whether the
-        invoice has already been created, or record the GUID against
-        the session.
+        Returns the XML to be sent to Xero.
         """
         session = td.s.query(Session).get(sessionid)
         if not session:
@@ -358,37 +460,25 @@ class XeroIntegration:
             tracking = self._get_tracking(None)
             if tracking:
                 li.append(tracking)
-        xml = tostring(invoices)
-        r = requests.put(XERO_ENDPOINT_URL + "Invoices/",
-                         data={'xml': xml},
-                         auth=self.oauth)
-        if r.status_code == 400:
-            root = fromstring(r.text)
-            messages = [e.text for e in root.findall(".//Message")]
-            raise XeroError("Xero rejected invoice: {}".format(
-                ", ".join(messages)))
-        if r.status_code != 200:
-            raise XeroError("Received {} response".format(r.status_code))
-        root = fromstring(r.text)
-        if root.tag != "Response":
-            raise XeroError("Response root tag '{}' was not 'Response'".format(
-                root.tag))
-        i = root.find("./Invoices/Invoice")
-        if not i:
-            raise XeroError("Response did not contain invoice details")
-        invid = _fieldtext(i, "InvoiceID")
-        if not invid:
-            raise XeroError("No invoice ID was returned")
-        #warnings = [w.text for w in i.findall("./Warnings/Warning/Message")]
-        return invid
+        return tostring(invoices)
 
-    def _add_payments_for_session(self, sessionid, invoice):
-        """Add payments for a session to an existing invoice
+    def _create_invoice_for_session(self, sessionid, approve=False):
+        """Create an invoice for a session
 
-        The invoice is specified by its Xero InvoiceID.  It must be
-        Approved, otherwise adding payments will fail.  This call does
-        not check the invoice state, or whether payments have already
-        been added.
+        Returns the invoice's GUID.  Does not check whether the
+        invoice has already been created, or record the GUID against
+        the session.
+        """
+        root = self._put("Invoices/", self._invoice_xml_for_session(
+            sessionid, approve=approve), "invoice")
+        return _invoice_id(root)
+
+    def _payments_xml_for_session(self, sessionid, invoice):
+        """Build the payments for a session
+
+        Returns the XML to be sent to Xero.  If invoice is None the
+        InvoiceID elements are left empty, to be filled in when the
+        invoice has been created.
         """
         session = td.s.query(Session).get(sessionid)
         if not session:
@@ -412,23 +502,24 @@ class XeroIntegration:
             p.append(_textelem("Amount", str(total.amount)))
             p.append(_textelem("Reference", ref))
 
-        xml = tostring(payments)
-        r = requests.put(XERO_ENDPOINT_URL + "Payments/",
-                         data={'xml': xml},
-                         auth=self.oauth)
-        if r.status_code == 400:
-            root = fromstring(r.text)
-            messages = [e.text for e in root.findall(".//Message")]
-            raise XeroError("Xero rejected payments: {}".format(
-                ", ".join(messages)))
-        if r.status_code != 200:
-            raise XeroError("Received {} response".format(r.status_code))
-        root = fromstring(r.text)
-        if root.tag != "Response":
-            raise XeroError("Response root tag '{}' was not 'Response'".format(
-                root.tag))
+        return tostring(payments)
 
-    def _create_bill_for_delivery(self, deliveryid):
+    def _add_payments_for_session(self, sessionid, invoice):
+        """Add payments for a session to an existing invoice
+
+        The invoice is specified by its Xero InvoiceID.  It must be
+        Approved, otherwise adding payments will fail.  This call does
+        not check the invoice state, or whether payments have already
+        been added.
+        """
+        self._put("Payments/", self._payments_xml_for_session(
+            sessionid, invoice), "payments")
+
+    def _bill_xml_for_delivery(self, deliveryid):
+        """Build a bill for a delivery
+
+        Returns the XML to be sent to Xero.
+        """
         d = td.s.query(Delivery).get(deliveryid)
         if not d:
             raise XeroError("Delivery {} does not exist".format(deliveryid))
@@ -478,29 +569,79 @@ class XeroIntegration:
                 li.append(tracking)
             previtem = item
 
-        xml = tostring(invoices)
-        r = requests.put(XERO_ENDPOINT_URL + "Invoices/",
-                         data={'xml': xml},
-                         auth=self.oauth)
+        return tostring(invoices)
+
+    def _create_bill_for_delivery(self, deliveryid):
+        root = self._put("Invoices/", self._bill_xml_for_delivery(deliveryid),
+                         "invoice")
+        return _invoice_id(root)
+
+    def _put(self, path, xml, what, idempotency_key=None, params=None):
+        """Send a document to Xero
+
+        Returns the root element of the response.  Raises
+        XeroTemporaryError if the request may succeed if tried again
+        later, and XeroError if Xero rejected it.
+        """
+        import requests
+        headers = {}
+        if idempotency_key:
+            headers['Idempotency-Key'] = idempotency_key
+        try:
+            r = requests.put(self.endpoint_url + path,
+                             data={'xml': xml},
+                             params=params,
+                             headers=headers,
+                             auth=self.oauth,
+                             timeout=60)
+        except requests.RequestException as e:
+            raise XeroTemporaryError("Failed to contact Xero: {}".format(e))
         if r.status_code == 400:
             root = fromstring(r.text)
             messages = [e.text for e in root.findall(".//Message")]
-            raise XeroError("Xero rejected invoice: {}".format(
-                ", ".join(messages)))
+            raise XeroError("Xero rejected {}: {}".format(
+                what, ", ".join(messages)))
+        if r.status_code == 429:
+            raise XeroTemporaryError(
+                "Xero rate limit exceeded",
+                retry_after=_retry_after(r.headers.get('Retry-After')))
         if r.status_code != 200:
-            raise XeroError("Received {} response".format(r.status_code))
+            raise XeroTemporaryError("Received {} response".format(
+                r.status_code))
         root = fromstring(r.text)
         if root.tag != "Response":
             raise XeroError("Response root tag '{}' was not 'Response'".format(
                 root.tag))
-        i = root.find("./Invoices/Invoice")
-        if not i:
-            raise XeroError("Response did not contain invoice details")
-        invid = _fieldtext(i, "InvoiceID")
-        if not invid:
-            raise XeroError("No invoice ID was returned")
-        #warnings = [w.text for w in i.findall("./Warnings/Warning/Message")]
-        return invid
+        return root
+
+    def _queue(self, kind, payload, **kwargs):
+        """Add a document to the outbox
+
+        The entry is sent once the caller's database transaction has
+        been committed.
+        """
+        entry = AccountsOutbox(
+            kind=kind, payload=payload.decode('utf-8'),
+            idempotency_key=str(uuid.uuid4()),
+            user=user.current_dbuser(), **kwargs)
+        td.s.add(entry)
+        td.s.info['xero_wake'] = self
+        return entry
+
+    def _queue_session(self, sessionid):
+        """Queue the invoice and payments for a session
+
+        Building the documents may raise XeroError.  Returns the
+        invoice and payments outbox entries.
+        """
+        invoice = self._queue(
+            "invoice", self._invoice_xml_for_session(sessionid, approve=True),
+            sessionid=sessionid)
+        payments = self._queue(
+            "payments", self._payments_xml_for_session(sessionid, None),
+            sessionid=sessionid, depends_on=invoice)
+        td.s.flush()
+        return invoice, payments
 
     def _send_delivery(self, deliveryid):
         d = td.s.query(Delivery).get(deliveryid)
@@ -511,10 +652,443 @@ class XeroIntegration:
                          title="Error")
             return
         with ui.exception_guard("sending bill for delivery to Xero"):
-            iid = self._create_bill_for_delivery(deliveryid)
-            d.accinfo = iid
-            td.s.flush()
-            ui.toast("Delivery sent to Xero as draft bill")
+            self._queue("bill", self._bill_xml_for_delivery(deliveryid),
+                        deliveryid=deliveryid)
+            ui.toast("Delivery queued for sending to Xero as draft bill")
+
+    def _start_worker(self):
+        if self.oauth and not self._worker:
+            self._worker = threading.Thread(
+                target=self._worker_loop, name="xero-outbox", daemon=True)
+            self._wakeup.set()
+            self._worker.start()
+
+    def wake(self):
+        """Send queued documents now, rather than waiting for the next poll
+        """
+        self._wakeup.set()
+
+    def _worker_loop(self):
+        while True:
+            self._wakeup.wait(timeout=self.outbox_poll_interval)
+            self._wakeup.clear()
+            try:
+                self.process_outbox()
+            except Exception:
+                log.exception("Processing Xero outbox")
+
+    # A claimed entry is not tried again by another terminal until
+    # this much time has passed
+    outbox_lease = datetime.timedelta(minutes=5)
+
+    @staticmethod
+    def outbox_retry_delay(attempts):
+        """Time to wait before trying again after a temporary failure"""
+        return datetime.timedelta(seconds=min(60 * 2 ** (attempts - 1), 3600))
+
+    def _claim(self, s):
+        """Claim the next entry that is due to be sent
+
+        If the entry was part of a batch that Xero may have received,
+        the whole batch is claimed so it can be sent again with the
+        same idempotency key.  Returns a list of the claimed entries,
+        which is empty if there is nothing to send.
+
+        The claim is committed before the entries are sent, so no
+        database transaction is held open while waiting for Xero.
+        """
+        dependency = aliased(AccountsOutbox)
+        entry = s.query(AccountsOutbox)\
+                 .outerjoin(dependency, AccountsOutbox.depends_on)\
+                 .filter(AccountsOutbox.state == 'pending')\
+                 .filter(AccountsOutbox.next_attempt <= func.now())\
+                 .filter(or_(dependency.id == None,
+                             dependency.state == 'done'))\
+                 .order_by(AccountsOutbox.id)\
+                 .with_for_update(skip_locked=True, of=AccountsOutbox)\
+                 .first()
+        if not entry:
+            return []
+        entries = [entry]
+        if entry.batch_key:
+            batch = s.query(AccountsOutbox)\
+                     .filter(AccountsOutbox.batch_key == entry.batch_key)\
+                     .filter(AccountsOutbox.state == 'pending')
+            entries = batch.filter(AccountsOutbox.next_attempt <= func.now())\
+                           .order_by(AccountsOutbox.id)\
+                           .with_for_update(skip_locked=True)\
+                           .all()
+            if len(entries) != batch.count():
+                # Another terminal is sending part of the batch
+                s.rollback()
+                return []
+        for e in entries:
+            e.attempts += 1
+            e.next_attempt = func.now() + self.outbox_lease
+        s.commit()
+        return entries
+
+    def process_outbox(self):
+        """Send everything in the outbox that is due to be sent
+
+        Uses its own database session, so may be called from a
+        thread other than the one running the user interface.
+        Returns the number of entries processed.
+        """
+        count = 0
+        s = td.sm()
+        try:
+            while True:
+                entries = self._claim(s)
+                if not entries:
+                    return count
+                count += len(entries)
+                if entries[0].batch_key:
+                    self._send_batch(s, entries)
+                else:
+                    self._send_entry(s, entries[0])
+                s.commit()
+        finally:
+            s.close()
+
+    @staticmethod
+    def _entry_document(entry):
+        """The document to send for an outbox entry
+
+        Returns the root element, with the InvoiceID filled in from
+        the entry it depends on if necessary.
+        """
+        root = fromstring(entry.payload)
+        if entry.depends_on:
+            for i in root.iter("InvoiceID"):
+                if not i.text:
+                    i.text = entry.depends_on.result
+        return root
+
+    def _send_entry(self, s, entry):
+        path, record = self._outbox_paths[entry.kind]
+        payload = tostring(self._entry_document(entry))
+        log.info("Sending %s for outbox entry %d, attempt %d",
+                 entry.kind, entry.id, entry.attempts)
+        try:
+            root = self._put(path, payload, entry.kind,
+                             idempotency_key=entry.idempotency_key)
+            result = _invoice_id(root) if entry.kind != 'payments' else None
+        except XeroTemporaryError as e:
+            self._retry_later(entry, e)
+            return
+        except XeroError as e:
+            self._entry_failed(entry, str(e))
+            return
+        self._entry_done(s, entry, result)
+
+    def _send_batch(self, s, entries):
+        """Send a batch of outbox entries again
+
+        The batch is sent exactly as it was by backfill(), with the
+        same idempotency key, so that Xero doesn't create the
+        documents a second time if it received the batch before.
+        """
+        path, record = self._outbox_paths[entries[0].kind]
+        batch = [(entry, list(self._entry_document(entry)))
+                 for entry in entries]
+        tag = self._entry_document(entries[0]).tag
+        log.info("Sending batch of %d outbox entries from %d, attempt %d",
+                 len(entries), entries[0].id, entries[0].attempts)
+        try:
+            result = self._put(path, self._batch_xml(tag, batch), "batch",
+                               idempotency_key=entries[0].batch_key,
+                               params={'summarizeErrors': 'false'})
+        except XeroTemporaryError as e:
+            for entry in entries:
+                self._retry_later(entry, e)
+            return
+        except XeroError as e:
+            result = e
+        self._batch_done(s, tag, batch, result)
+
+    def _retry_later(self, entry, error):
+        """Record a temporary failure to send an outbox entry"""
+        log.info("Outbox entry %d: %s", entry.id, error)
+        entry.last_error = str(error)
+        entry.next_attempt = func.now() + max(
+            self.outbox_retry_delay(entry.attempts),
+            datetime.timedelta(seconds=error.retry_after or 0))
+
+    def _entry_done(self, s, entry, result):
+        """Record that Xero has accepted an outbox entry
+
+        result is the InvoiceID, if the entry was for an invoice or
+        bill.
+        """
+        path, record = self._outbox_paths[entry.kind]
+        entry.result = result
+        entry.state = 'done'
+        entry.last_error = None
+        if record:
+            record(s, entry)
+
+    def _entry_failed(self, entry, error):
+        """Record that an outbox entry can't be sent
+
+        Entries that depend on it can never be sent either, so they
+        fail too.
+        """
+        log.error("Outbox entry %d: %s", entry.id, error)
+        entry.state = 'failed'
+        entry.last_error = error
+        for dependant in entry.dependants:
+            if dependant.state == 'pending':
+                self._entry_failed(
+                    dependant, "Not sent because the {} it depends on "
+                    "failed".format(entry.kind))
+
+    def _outbox_menu(self):
+        entries = td.s.query(AccountsOutbox)\
+                      .order_by(AccountsOutbox.id.desc())\
+                      .limit(100)\
+                      .all()
+        f = ui.tableformatter(' r l l l r L ')
+        lines = [(f(e.id, e.kind,
+                    "Session {}".format(e.sessionid) if e.sessionid
+                    else "Delivery {}".format(e.deliveryid),
+                    e.state, e.attempts, e.last_error or e.result or ""),
+                  self._retry_outbox_entry, (e.id,)) for e in entries]
+        ui.menu(lines, title="Xero queue",
+                blurb="These are the most recent documents queued for "
+                "sending to Xero.  Choose a document that has not been "
+                "sent to try sending it again now.")
+
+    def _retry_outbox_entry(self, entryid):
+        e = td.s.query(AccountsOutbox).get(entryid)
+        if e.state == 'done':
+            ui.toast("Document {} has already been sent".format(e.id))
+            return
+        e.state = 'pending'
+        e.next_attempt = func.now()
+        if e.batch_key:
+            # The rest of its batch must be sent with it
+            td.s.query(AccountsOutbox)\
+                .filter(AccountsOutbox.batch_key == e.batch_key)\
+                .filter(AccountsOutbox.state == 'pending')\
+                .update({AccountsOutbox.next_attempt: func.now()},
+                        synchronize_session=False)
+        # Entries that failed because this one did are retried too
+        for dependant in e.dependants:
+            if dependant.state == 'failed':
+                dependant.state = 'pending'
+                dependant.next_attempt = func.now()
+        td.s.commit()
+        self.wake()
+        ui.toast("Document {} will be sent again".format(e.id))
+
+    # Xero allows 60 calls a minute and 5 calls at once for each
+    # organisation.  Backfills stay under this even when the tills
+    # are sending documents at the same time.
+    backfill_calls_per_minute = 50
+    backfill_workers = 4
+    backfill_retries = 5
+
+    # Entries queued by a backfill are left alone by the tills for
+    # this long; if the backfill is interrupted they are sent one at
+    # a time after that.
+    backfill_lease = datetime.timedelta(days=1)
+
+    def _unsent_sessions(self, start, end):
+        queued = td.s.query(AccountsOutbox.sessionid)\
+                     .filter(AccountsOutbox.kind == 'invoice')\
+                     .filter(AccountsOutbox.state != 'failed')
+        sent = td.s.query(SessionNote.sessionid)\
+                   .filter(SessionNote.ntype == 'xeroinv')
+        q = td.s.query(Session.id)\
+                .filter(Session.date >= start)\
+                .filter(Session.date <= end)\
+                .filter(Session.endtime != None)\
+                .filter(Session.actual_totals.any())\
+                .filter(~Session.id.in_(queued))\
+                .filter(~Session.id.in_(sent))\
+                .order_by(Session.id)
+        if self.start_date:
+            q = q.filter(Session.date >= self.start_date)
+        return [sessionid for sessionid, in q.all()]
+
+    def _unsent_deliveries(self, start, end):
+        queued = td.s.query(AccountsOutbox.deliveryid)\
+                     .filter(AccountsOutbox.kind == 'bill')\
+                     .filter(AccountsOutbox.state != 'failed')
+        q = td.s.query(Delivery.id)\
+                .join(Supplier)\
+                .filter(Delivery.date >= start)\
+                .filter(Delivery.date <= end)\
+                .filter(Delivery.checked)\
+                .filter(Delivery.accinfo == None)\
+                .filter(Supplier.accinfo != None)\
+                .filter(~Delivery.id.in_(queued))\
+                .order_by(Delivery.id)
+        if self.start_date:
+            q = q.filter(Delivery.date >= self.start_date)
+        return [deliveryid for deliveryid, in q.all()]
+
+    def backfill(self, start, end, batch_size=50, workers=None,
+                 calls_per_minute=None):
+        """Send sessions and deliveries that are missing from Xero
+
+        Sessions and deliveries dated between start and end that have
+        not already been sent or queued are added to the outbox as
+        usual, but are then sent by this call in batches of up to
+        batch_size documents per request.  Invoices and bills are sent
+        first, followed by the payments for the invoices that Xero
+        accepted.  Several requests are made at once, but no more
+        than calls_per_minute requests are made in any minute.
+
+        Documents that could not be sent because of temporary
+        failures are left in the outbox, and are sent again in the
+        same batches with the same idempotency keys.
+        Returns a tuple of the number of outbox entries sent, failed
+        and left pending.
+        """
+        workers = workers or self.backfill_workers
+        calls_per_minute = calls_per_minute or self.backfill_calls_per_minute
+        entries = []
+        for sessionid in self._unsent_sessions(start, end):
+            try:
+                entries.extend(self._queue_session(sessionid))
+            except XeroError as e:
+                log.error("Not sending session %d: %s", sessionid, e)
+        for deliveryid in self._unsent_deliveries(start, end):
+            try:
+                entries.append(self._queue(
+                    "bill", self._bill_xml_for_delivery(deliveryid),
+                    deliveryid=deliveryid))
+            except XeroError as e:
+                log.error("Not sending delivery %d: %s", deliveryid, e)
+        for entry in entries:
+            entry.attempts = 1
+            entry.next_attempt = func.now() + self.backfill_lease
+        td.s.commit()
+        log.info("Backfill: %d documents queued", len(entries))
+
+        # Allowing a burst of one request per worker at the start
+        # still keeps us under the limit for the first minute
+        bucket = TokenBucket(calls_per_minute / 60, capacity=workers)
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            self._send_batches(
+                pool, bucket, [e for e in entries if e.kind != 'payments'],
+                batch_size)
+            self._send_batches(
+                pool, bucket, [e for e in entries if e.kind == 'payments'
+                               and e.depends_on.state == 'done'],
+                batch_size)
+
+        for entry in entries:
+            if entry.state == 'pending':
+                entry.next_attempt = func.now()
+        td.s.commit()
+        states = [e.state for e in entries]
+        return (states.count('done'), states.count('failed'),
+                states.count('pending'))
+
+    def _send_batches(self, pool, bucket, entries, batch_size):
+        """Send outbox entries in batches, several batches at once
+
+        Only the requests are made from the pool's threads; the
+        results are recorded in the database from this thread.
+        """
+        batches = {}
+        for entry in entries:
+            root = self._entry_document(entry)
+            documents = list(root)
+            if not documents:
+                # For example, a session where all the payment totals
+                # were zero
+                self._entry_done(td.s, entry, None)
+                continue
+            path, record = self._outbox_paths[entry.kind]
+            batches.setdefault((path, root.tag), []).append(
+                (entry, documents))
+        futures = {}
+        for (path, tag), items in batches.items():
+            for i in range(0, len(items), batch_size):
+                batch = items[i:i + batch_size]
+                # Retries of the same batch use the same key, even
+                # if they are made later from the outbox
+                key = str(uuid.uuid5(uuid.NAMESPACE_OID, ",".join(
+                    entry.idempotency_key for entry, documents in batch)))
+                for entry, documents in batch:
+                    entry.batch_key = key
+                futures[pool.submit(self._put_batch, bucket, path,
+                                    self._batch_xml(tag, batch), key)] = \
+                    (tag, batch)
+        td.s.commit()
+        for f in concurrent.futures.as_completed(futures):
+            tag, batch = futures[f]
+            self._batch_done(td.s, tag, batch, f.result())
+            td.s.commit()
+
+    @staticmethod
+    def _batch_xml(tag, batch):
+        root = Element(tag)
+        for entry, documents in batch:
+            root.extend(documents)
+        return tostring(root)
+
+    def _put_batch(self, bucket, path, xml, key):
+        """Send a batch of documents, retrying temporary failures
+
+        Runs in a worker thread, so must not use the database.
+        Returns the root element of the response, or the exception if
+        the batch could not be sent.
+        """
+        for attempt in range(1, self.backfill_retries + 1):
+            bucket.take()
+            try:
+                return self._put(path, xml, "batch", idempotency_key=key,
+                                 params={'summarizeErrors': 'false'})
+            except XeroTemporaryError as e:
+                log.info("Backfill batch attempt %d: %s", attempt, e)
+                if attempt == self.backfill_retries:
+                    return e
+                time.sleep(e.retry_after or 2 ** attempt)
+            except XeroError as e:
+                return e
+
+    def _batch_done(self, s, tag, batch, result):
+        """Record the results of sending a batch
+
+        With summarizeErrors turned off, Xero returns the documents
+        in the order they were sent, each with its own status.  The
+        entries keep their batch key until Xero has given an answer.
+        """
+        if isinstance(result, XeroTemporaryError):
+            for entry, documents in batch:
+                entry.last_error = str(result)
+            return
+        for entry, documents in batch:
+            entry.batch_key = None
+        if not isinstance(result, XeroError):
+            results = result.find(tag)
+            results = list(results) if results is not None else []
+            expected = sum(len(documents) for entry, documents in batch)
+            if len(results) != expected:
+                result = XeroError("Xero returned {} results for {} "
+                                   "documents".format(len(results), expected))
+        if isinstance(result, XeroError):
+            log.error("Backfill batch: %s", result)
+            for entry, documents in batch:
+                self._entry_failed(entry, str(result))
+            return
+        for entry, documents in batch:
+            mine = results[:len(documents)]
+            results = results[len(documents):]
+            if any(_fieldtext(r, "StatusAttributeString") == "ERROR"
+                   for r in mine):
+                self._entry_failed(entry, "Xero rejected {}: {}".format(
+                    entry.kind, ", ".join(
+                        m.text for r in mine for m in r.findall(
+                            "./ValidationErrors/ValidationError/Message"))))
+                continue
+            self._entry_done(s, entry, None if entry.kind == 'payments'
+                             else _fieldtext(mine[0], "InvoiceID"))
 
     def url_for_invoice(self, id):
         url = "/AccountsReceivable/View.aspx?InvoiceID={}".format(id)
@@ -527,7 +1101,8 @@ class XeroIntegration:
         s = td.s.query(Supplier).get(supplierid)
         # Fetch possible contacts
         w = "Name.ToLower().Contains(\"{}\")".format(s.name.lower())
-        r = requests.get(XERO_ENDPOINT_URL + "Contacts/", params={
+        import requests
+        r = requests.get(self.endpoint_url + "Contacts/", params={
             "where": w, "order": "Name"}, auth=self.oauth)
         if r.status_code != 200:
             ui.infopopup(["Failed to retrieve contacts from Xero: "
@@ -593,7 +1168,8 @@ class XeroIntegration:
                 ["This terminal does not have access to the accounting "
                  "system."], title="Xero not available")
             return True
-        r = requests.get(XERO_ENDPOINT_URL + "Organisation/", auth=self.oauth)
+        import requests
+        r = requests.get(self.endpoint_url + "Organisation/", auth=self.oauth)
         if r.status_code != 200:
             ui.infopopup(["Failed to retrieve organisation details from Xero: "
                           "error code {}".format(r.status_code)],
@@ -622,6 +1198,66 @@ class XeroIntegration:
                      title="Connected to Xero", colour=ui.colour_info,
                      dismiss=keyboard.K_CASH)
 
+def start_workers():
+    """Start sending queued documents to Xero in the background
+
+    Called by the "start" command once the till has connected to the
+    database.
+    """
+    for integration in XeroIntegration.instances:
+        integration._start_worker()
+
+class xerobackfill(cmdline.command):
+    """Send sessions and deliveries that are missing from Xero.
+
+    Sessions and deliveries dated between the start and end dates
+    that have not already been sent to Xero are sent in batches,
+    several batches at a time, while staying within Xero's rate
+    limits.  Anything that can't be sent straight away is left in the
+    queue for the tills to send.
+
+    """
+    command = "xero-backfill"
+    help = "send missing sessions and deliveries to Xero"
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("start", type=cmdline.date,
+                            help="first date to send, as YYYY-MM-DD")
+        parser.add_argument("end", type=cmdline.date,
+                            help="last date to send, as YYYY-MM-DD")
+        parser.add_argument("--batch-size", type=int, default=50,
+                            help="documents per request")
+        parser.add_argument("--workers", type=int,
+                            help="number of requests to make at once")
+        parser.add_argument("--calls-per-minute", type=int,
+                            help="maximum number of requests per minute")
+
+    @staticmethod
+    def run(args):
+        integrations = [h.xero for h in session.SessionHooks.instances
+                        if isinstance(h, XeroSessionHooks) and h.xero.oauth]
+        if not integrations:
+            print("This configuration does not have access to Xero.")
+            return 1
+        td.init(tillconfig.database)
+        with td.orm_session():
+            sent, failed, pending = integrations[0].backfill(
+                args.start, args.end, batch_size=args.batch_size,
+                workers=args.workers, calls_per_minute=args.calls_per_minute)
+        print("{} documents sent, {} rejected by Xero, {} left in the "
+              "queue.".format(sent, failed, pending))
+        return 1 if failed else None
+
+def _invoice_id(root):
+    i = root.find("./Invoices/Invoice")
+    if i is None:
+        raise XeroError("Response did not contain invoice details")
+    invid = _fieldtext(i, "InvoiceID")
+    if not invid:
+        raise XeroError("No invoice ID was returned")
+    return invid
+
 def _textelem(name, text):
     e = Element(name)
     e.text = text